@@ -0,0 +1,174 @@
+import asyncio
+import contextlib
+import os
+import threading
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Requests allowed to work against the database at once, across all routes
+ADMISSION_CAPACITY = int(os.getenv("ADMISSION_CAPACITY", "16"))
+# Part of that capacity only checkouts may use, so reads can never starve them
+CHECKOUT_RESERVE = int(os.getenv("CHECKOUT_RESERVE", "4"))
+CHECKOUT_CONCURRENCY = int(os.getenv("CHECKOUT_CONCURRENCY", "8"))
+CHECKOUT_QUEUE_TIMEOUT_SECONDS = float(os.getenv("CHECKOUT_QUEUE_TIMEOUT_SECONDS", "5"))
+READ_CONCURRENCY = int(os.getenv("READ_CONCURRENCY", "8"))
+READ_QUEUE_TIMEOUT_SECONDS = float(os.getenv("READ_QUEUE_TIMEOUT_SECONDS", "1"))
+# Sent as Retry-After with a 503
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "2"))
+
+
+class Overloaded(Exception):
+    """Raised when a request waited queue_timeout for a slot and got none."""
+
+    def __init__(self, route, retry_after):
+        super().__init__(f"'{route}' is over capacity")
+        self.route = route
+        self.retry_after = retry_after
+
+
+class Route:
+    """Limits and counters for one class of request."""
+
+    def __init__(self, name, limit, queue_timeout, priority=False):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.priority = priority
+        self.active = 0
+        self.peak_active = 0
+        self.accepted = 0
+        self.shed = 0
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "queue_timeout_seconds": self.queue_timeout,
+            "priority": self.priority,
+            "active": self.active,
+            "peak_active": self.peak_active,
+            "accepted": self.accepted,
+            "shed": self.shed,
+        }
+
+
+class AdmissionController:
+    """Bounds how much work waits on the database, per route and in total.
+
+    A request takes a slot from its route and from the shared capacity, and
+    waits up to its route's queue_timeout for one; after that it is shed
+    (Overloaded) instead of queueing behind a slow database. The last
+    `reserve` slots of the capacity are held for priority routes, so
+    balance-affecting checkouts still get through while dashboard reads and
+    menu displays are being shed. Usable from threads (the API's sync
+    endpoints) and from the bot's event loop. The slot bounds the database
+    work itself, so async callers should run it off the loop (asyncio.to_thread)
+    while they hold one.
+    """
+
+    def __init__(self, capacity, reserve=0, retry_after=RETRY_AFTER_SECONDS):
+        self.capacity = capacity
+        self.reserve = reserve
+        self.retry_after = retry_after
+        self.routes = {}
+        self.active = 0
+        self._cond = threading.Condition()
+        # Coroutines waiting for a slot: (loop, asyncio.Event). Slots are freed
+        # from threads too, so _release wakes them through their loop.
+        self._async_waiters = set()
+
+    def add_route(self, name, limit, queue_timeout, priority=False):
+        self.routes[name] = Route(name, limit, queue_timeout, priority)
+
+    def _try_acquire(self, route):
+        # Called with self._cond held
+        free = self.capacity - self.active
+        if route.active >= route.limit or free <= (0 if route.priority else self.reserve):
+            return False
+        route.active += 1
+        route.peak_active = max(route.peak_active, route.active)
+        route.accepted += 1
+        self.active += 1
+        return True
+
+    def _shed(self, route):
+        with self._cond:
+            route.shed += 1
+        return Overloaded(route.name, self.retry_after)
+
+    def _release(self, route):
+        with self._cond:
+            route.active -= 1
+            self.active -= 1
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    @contextlib.contextmanager
+    def admit(self, name):
+        """Holds a slot of route `name` for the block; raises Overloaded if none frees up in time."""
+        route = self.routes[name]
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._try_acquire(route), route.queue_timeout):
+                route.shed += 1
+                raise Overloaded(route.name, self.retry_after)
+        try:
+            yield
+        finally:
+            self._release(route)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, name):
+        """admit() for coroutines: waits for a release without blocking the event loop."""
+        route = self.routes[name]
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        deadline = loop.time() + route.queue_timeout
+        try:
+            while True:
+                with self._cond:
+                    if self._try_acquire(route):
+                        break
+                    # Registered under the lock, so a release cannot slip in unseen
+                    self._async_waiters.add(waiter)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise self._shed(route)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                waiter[1].clear()
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        try:
+            yield
+        finally:
+            self._release(route)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "capacity": self.capacity,
+                "checkout_reserve": self.reserve,
+                "active": self.active,
+                "routes": {name: route.stats() for name, route in self.routes.items()},
+            }
+
+
+def build_controller():
+    controller = AdmissionController(ADMISSION_CAPACITY, CHECKOUT_RESERVE)
+    # Debits coins or records an order
+    controller.add_route("checkout", CHECKOUT_CONCURRENCY, CHECKOUT_QUEUE_TIMEOUT_SECONDS, priority=True)
+    # Dashboard and report reads
+    controller.add_route("read", READ_CONCURRENCY, READ_QUEUE_TIMEOUT_SECONDS)
+    # Bot login, menu and balance displays
+    controller.add_route("menu", READ_CONCURRENCY, READ_QUEUE_TIMEOUT_SECONDS)
+    return controller
+
+
+# Shared by the API and the bot when they run in one process (main.APP_ROLE)
+ADMISSION = build_controller()
@@ -0,0 +1,1325 @@
+import contextlib
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+from memstore import MemoryStore, TXN_DEBIT, TXN_REFUND, TXN_TOPUP, TXN_ADJUSTMENT
+from merchants import DEFAULT_MERCHANT_ID
+
+# Column order of the tuple rows returned by order_rows / member_rows
+ORDER_COLUMNS = ("id", "member_id", "amount", "items", "type", "time", "delivery_date", "status", "merchant_id")
+# What member listings and search may return: everything but the PIN
+MEMBER_PUBLIC_COLUMNS = ("id", "member_id", "name", "coins", "merchant_id")
+MEMBER_COLUMNS = MEMBER_PUBLIC_COLUMNS
+
+# Columns added after the first release: {name: (sqlite_type, mysql_type)}
+ORDER_MIGRATIONS = {
+    "items": ("TEXT", "TEXT"),
+    "merchant_id": ("TEXT", "VARCHAR(40)"),
+    "cancel_deadline": ("TIMESTAMP", "DATETIME"),
+    "chat_id": ("INTEGER", "BIGINT"),
+    "idempotency_key": ("TEXT", "VARCHAR(100)"),
+}
+MEMBER_MIGRATIONS = {
+    "merchant_id": ("TEXT", "VARCHAR(40)"),
+}
+ARCHIVE_MIGRATIONS = MEMBER_MIGRATIONS
+
+# Tables whose change version is kept in data_versions (see database.get_version)
+VERSIONED_TABLES = ("orders", "members")
+
+DEMO_MEMBERS = [
+    ("97011", "1234", "Member 1", 1500),
+    ("77452", "1234", "Member 2", 50),
+]
+
+
+# SQLite has no datetime type. Timestamps are stored as fixed-width
+# 'YYYY-MM-DD HH:MM:SS.ffffff' text, so comparing the text compares the
+# instants, and columns declared TIMESTAMP come back as datetime objects
+# (connect() passes PARSE_DECLTYPES). MySQL and MOCK mode hand out datetime
+# objects natively, so callers never parse times themselves.
+def _encode_timestamp(value):
+    return value.isoformat(" ", timespec="microseconds")
+
+
+def _decode_timestamp(value):
+    return datetime.datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_adapter(datetime.datetime, _encode_timestamp)
+sqlite3.register_converter("TIMESTAMP", _decode_timestamp)
+
+# TIMESTAMP columns, for the SQLite format migration
+TIMESTAMP_COLUMNS = {
+    "orders": ("time",),
+    "orders_archive": ("time", "archived_at"),
+    "coin_transactions": ("created_at",),
+    "member_balance_snapshots": ("taken_at",),
+}
+
+
+# Cancellation rules, fixed when the order is placed
+CANCEL_WINDOW = datetime.timedelta(minutes=15)
+PREORDER_CANCEL_HOUR = 6
+
+
+def cancel_deadline_for(type_label, delivery_date_str, placed_at):
+    """Last moment a customer may cancel, or None if the order cannot be cancelled.
+
+    Immediate and takeaway orders: 15 minutes after placing. Pre-orders:
+    6:00 AM on the delivery date ('dd-mm-YYYY').
+    """
+    type_label = type_label or ""
+    if placed_at is None:
+        return None
+    if "Takeaway" in type_label or type_label == "Immediate":
+        return placed_at + CANCEL_WINDOW
+    if type_label == "Pre-order":
+        try:
+            delivery = datetime.datetime.strptime(delivery_date_str, "%d-%m-%Y")
+        except (TypeError, ValueError):
+            return None
+        return delivery.replace(hour=PREORDER_CANCEL_HOUR)
+    return None
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def _marks(n):
+    return ", ".join("?" for _ in range(n))
+
+
+# What SQLite's NOCASE collation does to a string
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _next_prefix(prefix):
+    """The smallest string after every string that starts with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _padded(ids):
+    """ids with duplicates dropped, padded to a power-of-two length by repeating
+    the last one, so an IN (...) list only ever takes a handful of shapes."""
+    ids = list(dict.fromkeys(ids))
+    size = 1
+    while size < len(ids):
+        size *= 2
+    return ids + ids[-1:] * (size - len(ids))
+
+
+def _dicts(cursor):
+    """Rows of an executed cursor as dicts keyed by column name."""
+    columns = [d[0] for d in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class StorageBackend:
+    """Interface every storage engine implements.
+
+    database.init_db picks one implementation and the module-level functions
+    in database.py delegate to it, so callers never branch on DB_MODE.
+    Methods raise on failure; database.py decides the fallback value.
+    """
+    name = None
+
+    def init_schema(self):
+        pass
+
+    def check_member(self, member_id, pin): raise NotImplementedError
+    def get_balance(self, member_id): raise NotImplementedError
+    def set_coins(self, member_id, new_balance): raise NotImplementedError
+    def list_members(self): raise NotImplementedError
+    def member_rows(self): raise NotImplementedError
+    def search_members(self, field, prefix, after, limit): raise NotImplementedError
+    def insert_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                     idempotency_key): raise NotImplementedError
+    def place_member_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                           idempotency_key): raise NotImplementedError
+    def get_order(self, order_id): raise NotImplementedError
+    def order_by_idempotency_key(self, idempotency_key): raise NotImplementedError
+    def last_active_order(self, member_id): raise NotImplementedError
+    def cancel_refund(self, order_id, member_id, refund_amount, now): raise NotImplementedError
+    def closed_cancel_windows(self, since, until): raise NotImplementedError
+    def transition_orders(self, order_ids, new_status, from_statuses, refund): raise NotImplementedError
+    def lock_preorders(self, delivery_date_str): raise NotImplementedError
+    def preparing_preorders(self, delivery_date_str): raise NotImplementedError
+    def expire_stale(self, cutoff): raise NotImplementedError
+    def orders_in_range(self, start, end, include_archive, fresh=False): raise NotImplementedError
+    def order_rows(self, start, end, include_archive): raise NotImplementedError
+    def archive_orders(self, statuses, cutoff, now, batch_size): raise NotImplementedError
+    def member_transactions(self, member_id, limit): raise NotImplementedError
+    def member_orders(self, member_id, before, limit): raise NotImplementedError
+    def ledger_balance(self, member_id): raise NotImplementedError
+    def snapshot_balances(self, now): raise NotImplementedError
+    def reconcile(self): raise NotImplementedError
+    def bump_versions(self, tables): raise NotImplementedError
+    def data_versions(self): raise NotImplementedError
+    def pending_notifications(self, max_attempts, limit): raise NotImplementedError
+    def finish_notifications(self, sent_ids, failed_ids, now): raise NotImplementedError
+    def prune_notifications(self, before, max_attempts): raise NotImplementedError
+    def load_stock(self, stock_date): raise NotImplementedError
+    def add_stock_sold(self, stock_date, deltas): raise NotImplementedError
+    def set_stock_limits(self, stock_date, limits): raise NotImplementedError
+    def record_login_failure(self, chat_key, member_key, now): raise NotImplementedError
+    def login_failures(self, chat_key, member_key, since): raise NotImplementedError
+    def prune_login_failures(self, before): raise NotImplementedError
+
+    def note_write(self):
+        """Called after every committed write (see database._bump)."""
+        pass
+
+
+# -----------------------------------------------------------------------------
+# IN-MEMORY
+# -----------------------------------------------------------------------------
+
+class MemoryBackend(StorageBackend):
+    """DB_MODE 'MOCK': a thin adapter over memstore.MemoryStore."""
+    name = "MOCK"
+
+    def __init__(self, store=None):
+        self.store = store or MemoryStore()
+
+    def check_member(self, member_id, pin):
+        return self.store.check_member(member_id, pin)
+
+    def get_balance(self, member_id):
+        return self.store.get_balance(member_id)
+
+    def set_coins(self, member_id, new_balance):
+        return self.store.set_coins(member_id, new_balance)
+
+    def list_members(self):
+        return self.store.list_members()
+
+    def member_rows(self):
+        return [tuple(m.get(c) for c in MEMBER_COLUMNS) for m in self.store.list_members()]
+
+    def search_members(self, field, prefix, after, limit):
+        return self.store.search_members(field, prefix, after, limit)
+
+    def insert_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                     idempotency_key):
+        return self.store.insert_order(member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline,
+                                       chat_id, idempotency_key)
+
+    def place_member_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                           idempotency_key):
+        return self.store.place_member_order(member_id, amount, type_label, delivery_date_str, items_summary, now,
+                                             cancel_deadline, chat_id, idempotency_key)
+
+    def get_order(self, order_id):
+        return self.store.get_order(int(order_id))
+
+    def order_by_idempotency_key(self, idempotency_key):
+        return self.store.order_by_idempotency_key(idempotency_key)
+
+    def last_active_order(self, member_id):
+        return self.store.last_active_order(member_id)
+
+    def cancel_refund(self, order_id, member_id, refund_amount, now):
+        return self.store.cancel_refund(order_id, member_id, refund_amount, now)
+
+    def closed_cancel_windows(self, since, until):
+        return self.store.closed_cancel_windows(since, until)
+
+    def transition_orders(self, order_ids, new_status, from_statuses, refund):
+        return self.store.transition_orders([int(i) for i in order_ids], new_status, from_statuses, refund)
+
+    def lock_preorders(self, delivery_date_str):
+        return self.store.lock_preorders(delivery_date_str)
+
+    def preparing_preorders(self, delivery_date_str):
+        return self.store.preparing_preorders(delivery_date_str)
+
+    def expire_stale(self, cutoff):
+        return self.store.expire_stale(cutoff)
+
+    def orders_in_range(self, start, end, include_archive, fresh=False):
+        return self.store.orders_in_range(start, end, include_archive)
+
+    def order_rows(self, start, end, include_archive):
+        return [
+            tuple(_iso(o.get(c)) for c in ORDER_COLUMNS)
+            for o in self.store.orders_in_range(start, end, include_archive)
+        ]
+
+    def archive_orders(self, statuses, cutoff, now, batch_size):
+        return self.store.archive_orders(statuses, cutoff, now)
+
+    def member_transactions(self, member_id, limit):
+        return self.store.member_transactions(member_id, limit)
+
+    def member_orders(self, member_id, before, limit):
+        return self.store.member_orders(member_id, before, limit)
+
+    def ledger_balance(self, member_id):
+        return self.store.ledger_balance(member_id)
+
+    def snapshot_balances(self, now):
+        return self.store.snapshot_balances(now)
+
+    def reconcile(self):
+        return self.store.reconcile()
+
+    def pending_notifications(self, max_attempts, limit):
+        return self.store.pending_notifications(max_attempts, limit)
+
+    def finish_notifications(self, sent_ids, failed_ids, now):
+        return self.store.finish_notifications(sent_ids, failed_ids, now)
+
+    def prune_notifications(self, before, max_attempts):
+        return self.store.prune_notifications(before, max_attempts)
+
+    def load_stock(self, stock_date):
+        return self.store.load_stock(stock_date)
+
+    def add_stock_sold(self, stock_date, deltas):
+        return self.store.add_stock_sold(stock_date, deltas)
+
+    def set_stock_limits(self, stock_date, limits):
+        return self.store.set_stock_limits(stock_date, limits)
+
+    def record_login_failure(self, chat_key, member_key, now):
+        return self.store.record_login_failure(chat_key, member_key, now)
+
+    def login_failures(self, chat_key, member_key, since):
+        return self.store.login_failures(chat_key, member_key, since)
+
+    def prune_login_failures(self, before):
+        return self.store.prune_login_failures(before)
+
+
+# -----------------------------------------------------------------------------
+# SQL
+# -----------------------------------------------------------------------------
+
+class SQLBackend(StorageBackend):
+    """Shared SQL implementation for SQLite and MySQL.
+
+    Statements are written once with '?' placeholders and adapted to the
+    driver's paramstyle when the backend is created, not per call. Each
+    thread keeps one open connection, so the driver-side statement caches
+    (SQLite's statement cache, MySQL prepared cursors) survive between calls.
+    """
+
+    STATEMENTS = {
+        "check_member": "SELECT * FROM members WHERE member_id = ? AND pin = ?",
+        "member_coins": "SELECT coins FROM members WHERE member_id = ?",
+        "set_coins": "UPDATE members SET coins = ? WHERE member_id = ?",
+        "debit": "UPDATE members SET coins = coins - ? WHERE member_id = ? AND coins >= ?",
+        "credit": "UPDATE members SET coins = coins + ? WHERE member_id = ?",
+        "all_members": "SELECT * FROM members",
+        "member_rows": f"SELECT {', '.join(MEMBER_COLUMNS)} FROM members",
+        "insert_order": """
+            INSERT INTO orders (member_id, amount, items, type, time, delivery_date, status, merchant_id, cancel_deadline, chat_id,
+                                idempotency_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        "get_order": "SELECT * FROM orders WHERE id = ?",
+        "order_by_idempotency_key": "SELECT * FROM orders WHERE idempotency_key = ?",
+        "last_active_order": "SELECT * FROM orders WHERE member_id = ? AND status = 'Active' ORDER BY id DESC LIMIT 1",
+        "cancel_order": "UPDATE orders SET status = 'Cancelled' WHERE id = ? AND status = 'Active' AND cancel_deadline > ?",
+        "closed_cancel_windows": """
+            SELECT * FROM orders
+            WHERE status = 'Active' AND cancel_deadline > ? AND cancel_deadline <= ?
+            ORDER BY cancel_deadline
+        """,
+        "open_orders_without_deadline": "SELECT id, type, delivery_date, time FROM orders WHERE status = 'Active' AND cancel_deadline IS NULL",
+        "set_cancel_deadline": "UPDATE orders SET cancel_deadline = ? WHERE id = ?",
+        "transition_order": "UPDATE orders SET status = ? WHERE id = ? AND status = ?",
+        "lock_preorders": "UPDATE orders SET status = 'Preparing' WHERE status = 'Active' AND type = 'Pre-order' AND delivery_date = ?",
+        "preparing_preorders": "SELECT * FROM orders WHERE status = 'Preparing' AND type = 'Pre-order' AND delivery_date = ?",
+        "expire_stale": "UPDATE orders SET status = 'Expired' WHERE status = 'Active' AND type <> 'Pre-order' AND time < ?",
+        # Outbox rows are written in the transaction that changes the status
+        "notify_order": "INSERT INTO notification_outbox (order_id, chat_id, status, created_at) VALUES (?, ?, ?, ?)",
+        "notify_lock_preorders": """
+            INSERT INTO notification_outbox (order_id, chat_id, status, created_at)
+            SELECT id, chat_id, 'Preparing', ? FROM orders
+            WHERE status = 'Active' AND type = 'Pre-order' AND delivery_date = ? AND chat_id IS NOT NULL
+        """,
+        "notify_expire_stale": """
+            INSERT INTO notification_outbox (order_id, chat_id, status, created_at)
+            SELECT id, chat_id, 'Expired', ? FROM orders
+            WHERE status = 'Active' AND type <> 'Pre-order' AND time < ? AND chat_id IS NOT NULL
+        """,
+        "pending_notifications": """
+            SELECT n.id, n.order_id, n.chat_id, n.status, n.attempts, o.items
+            FROM notification_outbox n LEFT JOIN orders o ON o.id = n.order_id
+            WHERE n.sent_at IS NULL AND n.attempts < ?
+            ORDER BY n.id LIMIT ?
+        """,
+        "prune_notifications": """
+            DELETE FROM notification_outbox
+            WHERE created_at < ? AND (sent_at IS NOT NULL OR attempts >= ?)
+        """,
+        "record_txn": """
+            INSERT INTO coin_transactions (member_id, kind, amount, order_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+        "member_transactions": "SELECT * FROM coin_transactions WHERE member_id = ? ORDER BY id DESC LIMIT ?",
+        "ledger_balance": """
+            SELECT COALESCE(s.balance, 0) + COALESCE((
+                SELECT SUM(t.amount) FROM coin_transactions t
+                WHERE t.member_id = m.member_id AND t.id > COALESCE(s.last_txn_id, 0)
+            ), 0)
+            FROM members m LEFT JOIN member_balance_snapshots s ON s.member_id = m.member_id
+            WHERE m.member_id = ?
+        """,
+        "snapshot_deltas": """
+            SELECT t.member_id, COALESCE(MAX(s.balance), 0) + SUM(t.amount), MAX(t.id)
+            FROM coin_transactions t
+            LEFT JOIN member_balance_snapshots s ON s.member_id = t.member_id
+            WHERE t.id > COALESCE(s.last_txn_id, 0)
+            GROUP BY t.member_id
+        """,
+        "save_snapshot": "REPLACE INTO member_balance_snapshots (member_id, balance, last_txn_id, taken_at) VALUES (?, ?, ?, ?)",
+        "reconcile": """
+            SELECT m.member_id, m.coins, COALESCE(s.balance, 0) + COALESCE((
+                SELECT SUM(t.amount) FROM coin_transactions t
+                WHERE t.member_id = m.member_id AND t.id > COALESCE(s.last_txn_id, 0)
+            ), 0) AS ledger_balance
+            FROM members m LEFT JOIN member_balance_snapshots s ON s.member_id = m.member_id
+        """,
+        "open_missing_snapshots": """
+            INSERT INTO member_balance_snapshots (member_id, balance, last_txn_id, taken_at)
+            SELECT m.member_id, m.coins, (SELECT COALESCE(MAX(id), 0) FROM coin_transactions), ?
+            FROM members m
+            WHERE m.member_id NOT IN (SELECT member_id FROM member_balance_snapshots)
+        """,
+        "bump_version": "UPDATE data_versions SET version = version + 1 WHERE name = ?",
+        "data_versions": "SELECT name, version FROM data_versions",
+        "add_version": "INSERT INTO data_versions (name, version) VALUES (?, 0)",
+        "stock_rows": "SELECT item, daily_limit, sold FROM item_stock WHERE stock_date = ?",
+        "add_stock_row": "INSERT INTO item_stock (stock_date, item, daily_limit, sold) VALUES (?, ?, NULL, 0)",
+        "add_stock_sold": "UPDATE item_stock SET sold = sold + ? WHERE stock_date = ? AND item = ?",
+        "set_stock_limit": "UPDATE item_stock SET daily_limit = ? WHERE stock_date = ? AND item = ?",
+        "record_login_failure": "INSERT INTO login_failures (scope, attempt_key, failed_at) VALUES (?, ?, ?)",
+        "login_failures": """
+            SELECT scope, COUNT(*) FROM login_failures
+            WHERE ((scope = 'chat' AND attempt_key = ?) OR (scope = 'member' AND attempt_key = ?)) AND failed_at >= ?
+            GROUP BY scope
+        """,
+        "prune_login_failures": "DELETE FROM login_failures WHERE failed_at < ?",
+        "count_members": "SELECT count(*) FROM members",
+        "seed_member": "INSERT INTO members (member_id, pin, name, coins, merchant_id) VALUES (?, ?, ?, ?, ?)",
+    }
+
+    # Expression that yields orders.time as ISO 8601 text, or None to convert in Python
+    ISO_TIME_SQL = None
+
+    # Member search (search_members): prefix conditions on members.member_id
+    # (case-sensitive) and members.name (case-insensitive), and the name
+    # ordering idx_members_name is built on
+    ID_PREFIX_SQL = "member_id LIKE ?"
+    NAME_PREFIX_SQL = "name LIKE ?"
+    NAME_KEY = "name"
+
+    # Taken by snapshot_balances before it reads the ledger. Every ledger write
+    # first updates its member's row, so locking all member rows waits out the
+    # writers in flight: no transaction with a lower id can commit after the
+    # snapshot has moved last_txn_id past it. None where writers are already
+    # serialised (SQLite has a single writer, so ids commit in order).
+    LEDGER_LOCK_SQL = None
+
+    # How often replica lag is measured; reads in between use the cached value
+    REPLICA_LAG_CHECK_SECONDS = 5
+
+    def __init__(self, merchant_id=None):
+        # Every row this shard writes is stamped with its merchant
+        self.merchant_id = merchant_id or DEFAULT_MERCHANT_ID
+        self._local = threading.local()
+        self.statements = {name: self.adapt(sql) for name, sql in self.STATEMENTS.items()}
+        self.replica = None
+        self.replica_max_lag = 0
+        self._replica_lag = None
+        self._lag_checked_at = None
+        self._last_write = 0.0
+
+    # --- driver hooks -----------------------------------------------------
+
+    def adapt(self, sql):
+        """Rewrites '?' placeholders into the driver's paramstyle."""
+        return sql
+
+    def connect(self):
+        raise NotImplementedError
+
+    def is_alive(self, conn):
+        return True
+
+    def cursor(self, conn, sql):
+        return conn.cursor()
+
+    def table_columns(self, cursor, table):
+        raise NotImplementedError
+
+    # --- connection & statements -------------------------------------------
+
+    def connection(self):
+        """This thread's connection, opened on first use or after it dropped."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or not self.is_alive(conn):
+            conn = self.connect()
+            self._local.conn = conn
+            self._local.cursors = {}
+        return conn
+
+    def discard_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        self._local.cursors = {}
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits on success and rolls back on error. Reads go through here
+        too, so a MySQL connection never holds a stale snapshot between calls."""
+        conn = self.connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                self.discard_connection()
+            raise
+
+    def sql(self, name, *shape):
+        """Named statement text; dynamic ones are built from shape and memoized."""
+        key = (name, shape) if shape else name
+        text = self.statements.get(key)
+        if text is None:
+            text = self.adapt(getattr(self, f"_build_{name}")(*shape))
+            self.statements[key] = text
+        return text
+
+    # --- read replica ---------------------------------------------------------
+
+    def attach_replica(self, replica, max_lag):
+        """Serves dashboard reads from replica (a backend of the same kind)
+        while it is no more than max_lag seconds behind this one."""
+        self.replica = replica
+        self.replica_max_lag = max_lag
+
+    def replication_lag(self):
+        """Seconds this server is behind its source, 0 if it is not a replica,
+        None if replication is broken."""
+        return 0
+
+    def note_write(self):
+        self._last_write = time.monotonic()
+
+    def _replica_for_read(self):
+        """The replica if it may serve a read right now, else None."""
+        if self.replica is None:
+            return None
+        now = time.monotonic()
+        if self._lag_checked_at is None or now - self._lag_checked_at >= self.REPLICA_LAG_CHECK_SECONDS:
+            self._lag_checked_at = now
+            try:
+                self._replica_lag = self.replica.replication_lag()
+            except Exception as e:
+                print(f"Replica lag check failed: {e}")
+                self._replica_lag = None
+        lag = self._replica_lag
+        if lag is None or lag > self.replica_max_lag:
+            return None
+        # Read-your-writes: our last write must have had time to replicate.
+        # Lag is reported in whole seconds, hence the extra second.
+        if now - self._last_write <= lag + 1:
+            return None
+        return self.replica
+
+    def read(self, query, fresh=False):
+        """Runs query(backend, conn) for a read-only dashboard/report call.
+
+        Goes to the replica when one is attached and caught up, otherwise (or
+        with fresh=True, or if the replica fails) to this primary.
+        """
+        replica = None if fresh else self._replica_for_read()
+        if replica is not None:
+            try:
+                with replica.transaction() as conn:
+                    return query(replica, conn)
+            except Exception as e:
+                print(f"Replica read failed, using primary: {e}")
+                # Skip the replica until the next lag check
+                self._replica_lag = None
+        with self.transaction() as conn:
+            return query(self, conn)
+
+    def run(self, conn, name, params=(), shape=()):
+        text = self.sql(name, *shape)
+        cursor = self.cursor(conn, text)
+        cursor.execute(text, params)
+        return cursor
+
+    def _build_orders_range(self, has_start, has_end, include_archive, iso_time):
+        where = []
+        if has_start:
+            where.append("time >= ?")
+        if has_end:
+            where.append("time < ?")
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+        time_column = f"{self.ISO_TIME_SQL} AS time" if iso_time and self.ISO_TIME_SQL else "time"
+        columns = ", ".join(time_column if c == "time" else c for c in ORDER_COLUMNS)
+        query = f"SELECT {columns} FROM orders{where_sql}"
+        if include_archive:
+            query += f" UNION ALL SELECT {columns} FROM orders_archive{where_sql}"
+        return query + " ORDER BY id DESC"
+
+    def _build_member_orders(self, has_before):
+        # Keyset pagination: each table yields at most one page from its
+        # (member_id, id) index, however many orders the member has
+        where = "member_id = ? AND id < ?" if has_before else "member_id = ?"
+        columns = ", ".join(ORDER_COLUMNS)
+        return f"""
+            SELECT * FROM (SELECT {columns} FROM orders WHERE {where} ORDER BY id DESC LIMIT ?) AS live
+            UNION ALL
+            SELECT * FROM (SELECT {columns} FROM orders_archive WHERE {where} ORDER BY id DESC LIMIT ?) AS old
+            ORDER BY id DESC LIMIT ?
+        """
+
+    def _build_member_search(self, field, has_after):
+        # Keyset pagination along an index: member_id's unique index, or
+        # idx_members_name for names. Members whose member_id matches are
+        # listed by the member_id search, so the name search leaves them out.
+        columns = ", ".join(MEMBER_PUBLIC_COLUMNS)
+        if field == "member_id":
+            where = self.ID_PREFIX_SQL + (" AND member_id > ?" if has_after else "")
+            order = "member_id"
+        else:
+            where = f"{self.NAME_PREFIX_SQL} AND NOT ({self.ID_PREFIX_SQL})"
+            if has_after:
+                where += f" AND ({self.NAME_KEY} > ? OR ({self.NAME_KEY} = ? AND member_id > ?))"
+            order = f"{self.NAME_KEY}, member_id"
+        return f"SELECT {columns} FROM members WHERE {where} ORDER BY {order} LIMIT ?"
+
+    def _build_orders_by_ids(self, n_ids):
+        return f"SELECT * FROM orders WHERE id IN ({_marks(n_ids)}) ORDER BY id"
+
+    def _build_notifications_sent(self, n_ids):
+        return f"UPDATE notification_outbox SET sent_at = ? WHERE id IN ({_marks(n_ids)})"
+
+    def _build_notifications_failed(self, n_ids):
+        return f"UPDATE notification_outbox SET attempts = attempts + 1 WHERE id IN ({_marks(n_ids)})"
+
+    def _build_archive_batch(self, n_statuses):
+        return f"SELECT id FROM orders WHERE status IN ({_marks(n_statuses)}) AND time < ? ORDER BY id LIMIT ?"
+
+    def _build_archive_copy(self, n_statuses):
+        return f"""
+            INSERT INTO orders_archive (id, member_id, amount, items, type, time, delivery_date, status, merchant_id, archived_at)
+            SELECT id, member_id, amount, items, type, time, delivery_date, status, merchant_id, ?
+            FROM orders WHERE status IN ({_marks(n_statuses)}) AND time < ? AND id <= ?
+        """
+
+    def _build_archive_delete(self, n_statuses):
+        return f"DELETE FROM orders WHERE status IN ({_marks(n_statuses)}) AND time < ? AND id <= ?"
+
+    # --- schema -------------------------------------------------------------
+
+    SCHEMA = ()
+
+    def ensure_columns(self, cursor, table, columns):
+        """MIGRATION: Adds any of columns ({name: (sqlite_type, mysql_type)}) missing
+        from table. Returns the names added."""
+        existing = self.table_columns(cursor, table)
+        added = []
+        for name, types in columns.items():
+            if name not in existing:
+                print(f"🔄 Migrating DB: Adding '{name}' column to {table} table...")
+                col_type = types[0] if self.name == "SQLITE" else types[1]
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+                added.append(name)
+        return added
+
+    def ensure_index(self, cursor, table, name, columns, unique=False):
+        raise NotImplementedError
+
+    def _backfill_cancel_deadlines(self, cursor):
+        """Gives open orders from before the column existed their deadline."""
+        cursor.execute(self.sql("open_orders_without_deadline"))
+        updates = [
+            (cancel_deadline_for(type_label, delivery_date, placed_at), order_id)
+            for order_id, type_label, delivery_date, placed_at in cursor.fetchall()
+        ]
+        if updates:
+            cursor.executemany(self.sql("set_cancel_deadline"), updates)
+
+    def init_schema(self):
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            for ddl in self.SCHEMA:
+                cursor.execute(ddl)
+            for table, migrations in (("orders", ORDER_MIGRATIONS), ("members", MEMBER_MIGRATIONS),
+                                      ("orders_archive", ARCHIVE_MIGRATIONS)):
+                added = self.ensure_columns(cursor, table, migrations)
+                if "merchant_id" in added:
+                    # Rows from before multi-outlet support belong to this shard's merchant
+                    cursor.execute(self.adapt(f"UPDATE {table} SET merchant_id = ?"), (self.merchant_id,))
+                if "cancel_deadline" in added:
+                    self._backfill_cancel_deadlines(cursor)
+            self.ensure_index(cursor, "orders", "idx_orders_status_deadline", ("status", "cancel_deadline"))
+            # Member order history pages (member_orders) walk these backwards from a cursor
+            self.ensure_index(cursor, "orders", "idx_orders_member", ("member_id", "id DESC"))
+            self.ensure_index(cursor, "orders_archive", "idx_archive_member", ("member_id", "id DESC"))
+            self.ensure_index(cursor, "members", "idx_members_name", (self.NAME_KEY, "member_id"))
+            # A repeated submission finds its order here instead of placing another
+            self.ensure_index(cursor, "orders", "idx_orders_idempotency", ("idempotency_key",), unique=True)
+
+            # Seed Data
+            cursor.execute(self.sql("count_members"))
+            if cursor.fetchall()[0][0] == 0:
+                cursor.executemany(self.sql("seed_member"), [row + (self.merchant_id,) for row in DEMO_MEMBERS])
+            # Existing balances predate the ledger, so they become the opening
+            # balance as of the latest transaction id.
+            cursor.execute(self.sql("open_missing_snapshots"), (datetime.datetime.now(),))
+
+            cursor.execute(self.sql("data_versions"))
+            known = {name for name, _ in cursor.fetchall()}
+            for name in VERSIONED_TABLES:
+                if name not in known:
+                    cursor.execute(self.sql("add_version"), (name,))
+
+    # --- members & ledger ---------------------------------------------------
+
+    def _record(self, conn, member_id, kind, amount, order_id=None, now=None):
+        self.run(conn, "record_txn", (member_id, kind, amount, order_id, now or datetime.datetime.now()))
+
+    def check_member(self, member_id, pin):
+        with self.transaction() as conn:
+            rows = _dicts(self.run(conn, "check_member", (member_id, pin)))
+        return rows[0] if rows else None
+
+    def get_balance(self, member_id):
+        with self.transaction() as conn:
+            rows = self.run(conn, "member_coins", (member_id,)).fetchall()
+        return rows[0][0] if rows else 0
+
+    def set_coins(self, member_id, new_balance):
+        with self.transaction() as conn:
+            rows = self.run(conn, "member_coins", (member_id,)).fetchall()
+            if not rows:
+                return False
+            delta = new_balance - rows[0][0]
+            self.run(conn, "set_coins", (new_balance, member_id))
+            if delta:
+                self._record(conn, member_id, TXN_TOPUP if delta > 0 else TXN_ADJUSTMENT, delta)
+        return bool(delta)
+
+    def list_members(self):
+        return self.read(lambda db, conn: _dicts(db.run(conn, "all_members")))
+
+    def member_rows(self):
+        return self.read(lambda db, conn: db.run(conn, "member_rows").fetchall())
+
+    def prefix_params(self, prefix, nocase):
+        # LIKE 'prefix%', so % and _ typed by the user match themselves
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return (escaped + "%",)
+
+    def search_members(self, field, prefix, after, limit):
+        """Up to limit members whose field ("member_id" or "name") starts with
+        prefix, after the keyset `after` (member_id, or (name, member_id))."""
+        id_params = self.prefix_params(prefix, False)
+        if field == "member_id":
+            params = id_params + ((after,) if after is not None else ())
+        else:
+            params = self.prefix_params(prefix, True) + id_params
+            if after is not None:
+                name, member_id = after
+                params += (name, name, member_id)
+        params += (limit,)
+        return self.read(lambda db, conn: _dicts(db.run(conn, "member_search", params, (field, after is not None))))
+
+    def bump_versions(self, tables):
+        with self.transaction() as conn:
+            for table in tables:
+                self.run(conn, "bump_version", (table,))
+
+    def data_versions(self):
+        # Always the primary: a lagging replica would hand out a stale ETag
+        with self.transaction() as conn:
+            return dict(self.run(conn, "data_versions").fetchall())
+
+    def member_transactions(self, member_id, limit):
+        return self.read(lambda db, conn: _dicts(db.run(conn, "member_transactions", (member_id, limit))))
+
+    def member_orders(self, member_id, before, limit):
+        """Up to limit of a member's orders (archive included) with id < before, newest first."""
+        key = (member_id,) if before is None else (member_id, before)
+        params = key + (limit,) + key + (limit, limit)
+        return self.read(lambda db, conn: _dicts(db.run(conn, "member_orders", params, (before is not None,))))
+
+    def ledger_balance(self, member_id):
+        with self.transaction() as conn:
+            rows = self.run(conn, "ledger_balance", (member_id,)).fetchall()
+        return rows[0][0] if rows else 0
+
+    def snapshot_balances(self, now):
+        with self.transaction() as conn:
+            if self.LEDGER_LOCK_SQL:
+                cursor = conn.cursor()
+                cursor.execute(self.LEDGER_LOCK_SQL)
+                cursor.fetchall()
+            rows = self.run(conn, "snapshot_deltas").fetchall()
+            if rows:
+                conn.cursor().executemany(
+                    self.sql("save_snapshot"),
+                    [(member_id, balance, last_txn_id, now) for member_id, balance, last_txn_id in rows]
+                )
+        return len(rows)
+
+    def reconcile(self):
+        with self.transaction() as conn:
+            rows = self.run(conn, "reconcile").fetchall()
+        return [
+            {"member_id": member_id, "coins": coins, "ledger_balance": ledger}
+            for member_id, coins, ledger in rows if coins != ledger
+        ]
+
+    # --- orders ---------------------------------------------------------------
+
+    def _insert_order(self, conn, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                      idempotency_key):
+        cursor = self.run(conn, "insert_order", (member_id, amount, items_summary, type_label, now, delivery_date_str,
+                                                 "Active", self.merchant_id, cancel_deadline, chat_id, idempotency_key))
+        return {
+            "id": cursor.lastrowid,
+            "member_id": member_id,
+            "amount": amount,
+            "items": items_summary,
+            "type": type_label,
+            "time": now,
+            "delivery_date": delivery_date_str,
+            "status": "Active",
+            "merchant_id": self.merchant_id,
+            "cancel_deadline": cancel_deadline,
+            "chat_id": chat_id,
+            "idempotency_key": idempotency_key,
+        }
+
+    def insert_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                     idempotency_key):
+        with self.transaction() as conn:
+            return self._insert_order(conn, member_id, amount, type_label, delivery_date_str, items_summary, now,
+                                      cancel_deadline, chat_id, idempotency_key)
+
+    def place_member_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline, chat_id,
+                           idempotency_key):
+        # A duplicate idempotency_key fails the insert, which rolls the debit back
+        with self.transaction() as conn:
+            if self.run(conn, "debit", (amount, member_id, amount)).rowcount != 1:
+                return None
+            order = self._insert_order(conn, member_id, amount, type_label, delivery_date_str, items_summary, now,
+                                       cancel_deadline, chat_id, idempotency_key)
+            self._record(conn, member_id, TXN_DEBIT, -amount, order["id"], now)
+        return order
+
+    def get_order(self, order_id):
+        with self.transaction() as conn:
+            rows = _dicts(self.run(conn, "get_order", (order_id,)))
+        return rows[0] if rows else None
+
+    def order_by_idempotency_key(self, idempotency_key):
+        with self.transaction() as conn:
+            rows = _dicts(self.run(conn, "order_by_idempotency_key", (idempotency_key,)))
+        return rows[0] if rows else None
+
+    def last_active_order(self, member_id):
+        with self.transaction() as conn:
+            rows = _dicts(self.run(conn, "last_active_order", (member_id,)))
+        return rows[0] if rows else None
+
+    def cancel_refund(self, order_id, member_id, refund_amount, now):
+        with self.transaction() as conn:
+            # Only an Active order inside its cancel window can be refunded,
+            # so a repeat or late cancel is a no-op
+            if self.run(conn, "cancel_order", (order_id, now)).rowcount != 1:
+                return False
+            # Guests have no members row, so there is nothing to credit
+            if self.run(conn, "credit", (refund_amount, member_id)).rowcount == 1:
+                self._record(conn, member_id, TXN_REFUND, refund_amount, order_id)
+        return True
+
+    def transition_orders(self, order_ids, new_status, from_statuses, refund):
+        """Moves the orders currently in from_statuses to new_status in one
+        transaction, refunding members if asked; returns the changed orders."""
+        if not order_ids:
+            return []
+        ids = _padded(order_ids)
+        changed = []
+        now = datetime.datetime.now()
+        with self.transaction() as conn:
+            for order in _dicts(self.run(conn, "orders_by_ids", ids, (len(ids),))):
+                if order["status"] not in from_statuses:
+                    continue
+                # Guarded on the status we read, so a concurrent change wins cleanly
+                if self.run(conn, "transition_order", (new_status, order["id"], order["status"])).rowcount != 1:
+                    continue
+                # Guests have no members row, so there is nothing to credit
+                if refund and self.run(conn, "credit", (order["amount"], order["member_id"])).rowcount == 1:
+                    self._record(conn, order["member_id"], TXN_REFUND, order["amount"], order["id"])
+                if order["chat_id"] is not None:
+                    self.run(conn, "notify_order", (order["id"], order["chat_id"], new_status, now))
+                order["status"] = new_status
+                changed.append(order)
+        return changed
+
+    def lock_preorders(self, delivery_date_str):
+        with self.transaction() as conn:
+            self.run(conn, "notify_lock_preorders", (datetime.datetime.now(), delivery_date_str))
+            self.run(conn, "lock_preorders", (delivery_date_str,))
+            return _dicts(self.run(conn, "preparing_preorders", (delivery_date_str,)))
+
+    def preparing_preorders(self, delivery_date_str):
+        return self.read(lambda db, conn: _dicts(db.run(conn, "preparing_preorders", (delivery_date_str,))))
+
+    def closed_cancel_windows(self, since, until):
+        return self.read(lambda db, conn: _dicts(db.run(conn, "closed_cancel_windows", (since, until))))
+
+    def expire_stale(self, cutoff):
+        with self.transaction() as conn:
+            self.run(conn, "notify_expire_stale", (datetime.datetime.now(), cutoff))
+            return self.run(conn, "expire_stale", (cutoff,)).rowcount
+
+    # --- customer notifications -----------------------------------------------
+
+    def pending_notifications(self, max_attempts, limit):
+        with self.transaction() as conn:
+            return _dicts(self.run(conn, "pending_notifications", (max_attempts, limit)))
+
+    def finish_notifications(self, sent_ids, failed_ids, now):
+        with self.transaction() as conn:
+            if sent_ids:
+                ids = _padded(sent_ids)
+                self.run(conn, "notifications_sent", [now] + ids, (len(ids),))
+            if failed_ids:
+                ids = _padded(failed_ids)
+                self.run(conn, "notifications_failed", ids, (len(ids),))
+
+    def prune_notifications(self, before, max_attempts):
+        with self.transaction() as conn:
+            return self.run(conn, "prune_notifications", (before, max_attempts)).rowcount
+
+    # --- item stock -------------------------------------------------------------
+
+    def _stock_rows(self, conn, stock_date):
+        return {item: (limit, sold) for item, limit, sold in self.run(conn, "stock_rows", (stock_date,)).fetchall()}
+
+    def _ensure_stock_rows(self, conn, stock_date, items):
+        existing = self._stock_rows(conn, stock_date)
+        for item in items:
+            if item not in existing:
+                self.run(conn, "add_stock_row", (stock_date, item))
+
+    def load_stock(self, stock_date):
+        """{item: (daily_limit, sold)} for one day ('YYYY-MM-DD')."""
+        with self.transaction() as conn:
+            return self._stock_rows(conn, stock_date)
+
+    def add_stock_sold(self, stock_date, deltas):
+        # Increments rather than absolute counts, so every process can add its own sales
+        with self.transaction() as conn:
+            self._ensure_stock_rows(conn, stock_date, deltas)
+            for item, qty in deltas.items():
+                self.run(conn, "add_stock_sold", (qty, stock_date, item))
+
+    def set_stock_limits(self, stock_date, limits):
+        with self.transaction() as conn:
+            self._ensure_stock_rows(conn, stock_date, limits)
+            for item, limit in limits.items():
+                self.run(conn, "set_stock_limit", (limit, stock_date, item))
+
+    # --- login throttling (shared mode, see throttle.py) -------------------------
+
+    def record_login_failure(self, chat_key, member_key, now):
+        with self.transaction() as conn:
+            self.run(conn, "record_login_failure", ("chat", chat_key, now))
+            self.run(conn, "record_login_failure", ("member", member_key, now))
+
+    def login_failures(self, chat_key, member_key, since):
+        """{"chat": n, "member": n}: failures recorded since `since`."""
+        with self.transaction() as conn:
+            return dict(self.run(conn, "login_failures", (chat_key, member_key, since)).fetchall())
+
+    def prune_login_failures(self, before):
+        with self.transaction() as conn:
+            return self.run(conn, "prune_login_failures", (before,)).rowcount
+
+    def _range_params(self, start, end, include_archive):
+        params = [p for p in (start, end) if p is not None]
+        return params * 2 if include_archive else params
+
+    def orders_in_range(self, start, end, include_archive, fresh=False):
+        shape = (start is not None, end is not None, include_archive, False)
+        params = self._range_params(start, end, include_archive)
+        return self.read(lambda db, conn: _dicts(db.run(conn, "orders_range", params, shape)), fresh)
+
+    def order_rows(self, start, end, include_archive):
+        shape = (start is not None, end is not None, include_archive, True)
+        params = self._range_params(start, end, include_archive)
+        rows = self.read(lambda db, conn: db.run(conn, "orders_range", params, shape).fetchall())
+        if self.ISO_TIME_SQL is None:
+            t = ORDER_COLUMNS.index("time")
+            rows = [row[:t] + (_iso(row[t]),) + row[t + 1:] for row in rows]
+        return rows
+
+    def archive_orders(self, statuses, cutoff, now, batch_size):
+        """Moves terminal orders in id-ordered batches, one transaction each."""
+        archived = 0
+        n = len(statuses)
+        while True:
+            with self.transaction() as conn:
+                ids = self.run(conn, "archive_batch", (*statuses, cutoff, batch_size), (n,)).fetchall()
+                if not ids:
+                    break
+                # The batch is exactly the qualifying rows up to its highest id
+                last_id = ids[-1][0]
+                self.run(conn, "archive_copy", (now, *statuses, cutoff, last_id), (n,))
+                self.run(conn, "archive_delete", (*statuses, cutoff, last_id), (n,))
+            archived += len(ids)
+            if len(ids) < batch_size:
+                break
+        return archived
+
+
+class SQLiteBackend(SQLBackend):
+    name = "SQLITE"
+
+    # SQLite keeps timestamps as 'YYYY-MM-DD HH:MM:SS.ffffff' text, so ISO is one REPLACE away
+    ISO_TIME_SQL = "REPLACE(time, ' ', 'T')"
+
+    # SQLite only uses an index for LIKE under conditions this schema does not
+    # meet, so prefixes are matched as ranges: 'ab' <= x < 'ac'
+    ID_PREFIX_SQL = "member_id >= ? AND member_id < ?"
+    NAME_PREFIX_SQL = "name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE"
+    NAME_KEY = "name COLLATE NOCASE"
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            member_id TEXT UNIQUE NOT NULL,
+            pin TEXT NOT NULL,
+            name TEXT,
+            coins INTEGER DEFAULT 0,
+            merchant_id TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            member_id TEXT,
+            amount INTEGER,
+            items TEXT,
+            type TEXT,
+            time TIMESTAMP,
+            delivery_date TEXT,
+            status TEXT,
+            merchant_id TEXT,
+            cancel_deadline TIMESTAMP,
+            chat_id INTEGER,
+            idempotency_key TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_time ON orders (status, time)",
+        """
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            id INTEGER PRIMARY KEY,
+            member_id TEXT,
+            amount INTEGER,
+            items TEXT,
+            type TEXT,
+            time TIMESTAMP,
+            delivery_date TEXT,
+            status TEXT,
+            merchant_id TEXT,
+            archived_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_archive_time ON orders_archive (time)",
+        """
+        CREATE TABLE IF NOT EXISTS coin_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            member_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            order_id INTEGER,
+            created_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_txn_member ON coin_transactions (member_id, id)",
+        """
+        CREATE TABLE IF NOT EXISTS member_balance_snapshots (
+            member_id TEXT PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            last_txn_id INTEGER NOT NULL,
+            taken_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            sent_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox (sent_at, id)",
+        """
+        CREATE TABLE IF NOT EXISTS item_stock (
+            stock_date TEXT NOT NULL,
+            item TEXT NOT NULL,
+            daily_limit INTEGER,
+            sold INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (stock_date, item)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS login_failures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            attempt_key TEXT NOT NULL,
+            failed_at TIMESTAMP NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_login_failures ON login_failures (scope, attempt_key, failed_at)",
+    )
+
+    def __init__(self, path="merchant.db", merchant_id=None):
+        super().__init__(merchant_id)
+        self.path = path
+        # Room for every named statement plus the dynamic shapes built from them
+        self.cache_size = max(64, 2 * len(self.STATEMENTS))
+
+    def connect(self):
+        return sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cache_size,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+
+    # PRAGMA user_version: 1 = every timestamp in the fixed-width format
+    SCHEMA_VERSION = 1
+
+    def init_schema(self):
+        super().init_schema()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= self.SCHEMA_VERSION:
+                return
+            # Older rows may lack microseconds (whole seconds) or use a 'T' separator
+            print("🔄 Migrating DB: Normalizing stored timestamps...")
+            for table, columns in TIMESTAMP_COLUMNS.items():
+                for column in columns:
+                    cursor.execute(f"UPDATE {table} SET {column} = REPLACE({column}, 'T', ' ') WHERE {column} LIKE '%T%'")
+                    cursor.execute(f"UPDATE {table} SET {column} = {column} || '.000000' WHERE length({column}) = 19")
+            cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def table_columns(self, cursor, table):
+        cursor.execute(f"PRAGMA table_info({table})")
+        return [info[1] for info in cursor.fetchall()]
+
+    def ensure_index(self, cursor, table, name, columns, unique=False):
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        cursor.execute(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+    def prefix_params(self, prefix, nocase):
+        if nocase:
+            # NOCASE folds ASCII letters only
+            prefix = prefix.translate(ASCII_LOWER)
+        return (prefix, _next_prefix(prefix))
+
+
+class MySQLBackend(SQLBackend):
+    name = "MYSQL"
+
+    # AUTO_INCREMENT ids are handed out before commit, so without this a
+    # lower id could commit after the snapshot passed it and be skipped
+    LEDGER_LOCK_SQL = "SELECT COUNT(*) FROM members FOR UPDATE"
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS members (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            member_id VARCHAR(20) UNIQUE NOT NULL,
+            pin VARCHAR(10) NOT NULL,
+            name VARCHAR(100),
+            coins INT DEFAULT 0,
+            merchant_id VARCHAR(40)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            member_id VARCHAR(20),
+            amount INT,
+            type VARCHAR(50),
+            time DATETIME,
+            delivery_date VARCHAR(20),
+            status VARCHAR(20),
+            items TEXT,
+            merchant_id VARCHAR(40),
+            cancel_deadline DATETIME,
+            chat_id BIGINT,
+            idempotency_key VARCHAR(100),
+            INDEX idx_orders_status_time (status, time)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            id INT PRIMARY KEY,
+            member_id VARCHAR(20),
+            amount INT,
+            type VARCHAR(50),
+            time DATETIME,
+            delivery_date VARCHAR(20),
+            status VARCHAR(20),
+            items TEXT,
+            merchant_id VARCHAR(40),
+            archived_at DATETIME,
+            INDEX idx_archive_time (time)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS coin_transactions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            member_id VARCHAR(20) NOT NULL,
+            kind VARCHAR(20) NOT NULL,
+            amount INT NOT NULL,
+            order_id INT,
+            created_at DATETIME,
+            INDEX idx_txn_member (member_id, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS member_balance_snapshots (
+            member_id VARCHAR(20) PRIMARY KEY,
+            balance INT NOT NULL,
+            last_txn_id INT NOT NULL,
+            taken_at DATETIME
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name VARCHAR(40) PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            order_id INT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            created_at DATETIME,
+            attempts INT NOT NULL DEFAULT 0,
+            sent_at DATETIME,
+            INDEX idx_outbox_pending (sent_at, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS item_stock (
+            stock_date VARCHAR(10) NOT NULL,
+            item VARCHAR(100) NOT NULL,
+            daily_limit INT,
+            sold INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (stock_date, item)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS login_failures (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            scope VARCHAR(10) NOT NULL,
+            attempt_key VARCHAR(64) NOT NULL,
+            failed_at DATETIME NOT NULL,
+            INDEX idx_login_failures (scope, attempt_key, failed_at)
+        )
+        """,
+    )
+
+    def __init__(self, host=None, user=None, password=None, database=None, connect_timeout=None, port=None, merchant_id=None):
+        super().__init__(merchant_id)
+        self.config = {
+            "host": host or os.getenv("DB_HOST", "localhost"),
+            "port": int(port or os.getenv("DB_PORT", "3306")),
+            "user": user or os.getenv("DB_USER", "root"),
+            "password": password if password is not None else os.getenv("DB_PASS", ""),
+            "database": database or os.getenv("DB_NAME", "nutritious_theory"),
+        }
+        if connect_timeout:
+            self.config["connection_timeout"] = max(1, int(connect_timeout))
+
+    def adapt(self, sql):
+        return sql.replace("?", "%s")
+
+    def connect(self):
+        # Imported here so SQLite and MOCK deployments never load the driver
+        import mysql.connector
+        return mysql.connector.connect(**self.config)
+
+    def create_database(self):
+        import mysql.connector
+        server_config = {k: v for k, v in self.config.items() if k != "database"}
+        conn = mysql.connector.connect(**server_config)
+        try:
+            conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {self.config['database']}")
+        finally:
+            conn.close()
+
+    def is_alive(self, conn):
+        return conn.is_connected()
+
+    def replication_lag(self):
+        with self.transaction() as conn:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except Exception:
+                # Servers older than 8.0.22
+                cursor.execute("SHOW SLAVE STATUS")
+            status = cursor.fetchall()
+        if not status:
+            return 0
+        row = status[0]
+        return row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+
+    def cursor(self, conn, sql):
+        """One prepared cursor per statement text, cached on this thread's connection."""
+        cursors = self._local.cursors
+        cursor = cursors.get(sql)
+        if cursor is None:
+            cursor = cursors[sql] = conn.cursor(prepared=True)
+        return cursor
+
+    def table_columns(self, cursor, table):
+        cursor.execute(f"SHOW COLUMNS FROM {table}")
+        return [info[0] for info in cursor.fetchall()]
+
+    def ensure_index(self, cursor, table, name, columns, unique=False):
+        # MySQL has no CREATE INDEX IF NOT EXISTS
+        cursor.execute(f"SHOW INDEX FROM {table} WHERE Key_name = '{name}'")
+        if not cursor.fetchall():
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            cursor.execute(f"CREATE {kind} {name} ON {table} ({', '.join(columns)})")
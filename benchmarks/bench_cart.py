@@ -0,0 +1,79 @@
+"""Cost of a shopping session on a large cart: plain dict vs. cart.Cart.
+
+Simulates what the bot does per message: one item change, then rendering
+the cart table with its total. Checkout then needs the total twice more
+(delivery option, receipt) and the items summary once.
+
+    python benchmarks/bench_cart.py [N_ITEMS]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cart import Cart
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+REPEAT = 3
+
+MENU = {f"Item {i}": 50 + i % 100 for i in range(N)}
+
+
+def format_cart_table(cart, menu):
+    # What bot.format_cart_table did on every message
+    lines = []
+    lines.append("Item | Qty | Price")
+    lines.append("-" * 25)
+    total = 0
+    for item, qty in cart.items():
+        cost = menu.get(item, 0) * qty
+        total += cost
+        lines.append(f"{item} | {qty} | ₹{cost}")
+    lines.append("-" * 25)
+    return "\n".join(lines), total
+
+
+def dict_session():
+    cart = {}
+    for item in MENU:
+        cart[item] = cart.get(item, 0) + 2
+        format_cart_table(cart, MENU)
+    # ask_member_delivery_option summed the total again, the receipt re-rendered
+    total = sum(MENU[item] * qty for item, qty in cart.items())
+    table, _ = format_cart_table(cart, MENU)
+    summary = ", ".join([f"{k} x{v}" for k, v in cart.items()])
+    return table, total, summary
+
+
+def cart_session():
+    cart = Cart(MENU)
+    for item in MENU:
+        cart.add(item, 2)
+        cart.render()
+    total = cart.total
+    table, _ = cart.render()
+    return table, total, cart.summary()
+
+
+def bench(fn):
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    print(f"{N} distinct items, one change + render per message, best of {REPEAT}")
+    results = {}
+    for name, fn in (("dict", dict_session), ("Cart", cart_session)):
+        elapsed, results[name] = bench(fn)
+        print(f"{name:>6}: {elapsed * 1000:8.1f} ms total  {elapsed / N * 1e6:7.1f} us/message")
+    assert results["dict"] == results["Cart"], "Cart output differs from the dict path"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Per-row cost of serving /orders: generic path vs. the tuple-row fast path.
+
+Builds a throwaway SQLite database with N orders in a temp directory, then
+times both ways of producing the response body.
+
+    python benchmarks/bench_orders_json.py [N]
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import database
+import serialization
+from backends import SQLiteBackend
+from serialization import FastJSONResponse, rows_to_records
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+REPEAT = 3
+
+
+def seed(n):
+    conn = database.BACKEND.connection()
+    now = datetime.datetime.now()
+    conn.executemany(
+        "INSERT INTO orders (member_id, amount, items, type, time, delivery_date, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            ("97011", 120, "Protein Bowl x2, Chia Pudding x1", "Immediate", now - datetime.timedelta(seconds=i), None, "Active")
+            for i in range(n)
+        ],
+    )
+    conn.commit()
+
+
+def generic_path():
+    # What main.get_orders did: dict rows, isoformat loop, jsonable_encoder, JSONResponse
+    orders = database.get_all_orders()
+    for o in orders:
+        if isinstance(o.get("time"), datetime.datetime):
+            o["time"] = o["time"].isoformat()
+    return JSONResponse(jsonable_encoder(orders)).body
+
+
+def fast_path():
+    rows = database.get_all_orders_rows()
+    return FastJSONResponse(rows_to_records(database.ORDER_COLUMNS, rows)).body
+
+
+def bench(fn):
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        body = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        database.use_backend(SQLiteBackend())
+        database.BACKEND.init_schema()
+        seed(N)
+
+        encoder = "orjson" if serialization.orjson else "stdlib json"
+        print(f"{N} orders, best of {REPEAT}, fast path encoder: {encoder}")
+        for name, fn in (("generic", generic_path), ("fast", fast_path)):
+            elapsed, size = bench(fn)
+            print(f"{name:>8}: {elapsed * 1000:8.1f} ms total  {elapsed / N * 1e6:6.2f} us/row  {size / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
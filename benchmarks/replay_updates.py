@@ -0,0 +1,358 @@
+"""Replays recorded Telegram traffic against the bot and reports where time goes.
+
+Record on the live bot with RECORD_UPDATES_FILE=updates.jsonl (see
+traffic.py), then replay a window of it, e.g. last week's morning rush:
+
+    python benchmarks/replay_updates.py updates.jsonl --speed 10 --from 07:00 --to 10:00
+    python benchmarks/replay_updates.py updates.jsonl --speed max --save this-release.json
+    python benchmarks/replay_updates.py updates.jsonl --speed max --compare last-release.json
+
+Messages are fed to bot.get_application() at their recorded pace (1x),
+sped up (10x) or back to back (max). Each merchant's bot replays its own
+messages, one at a time as python-telegram-bot does by default. Replies
+go to a fake Bot API inside this process, so nothing reaches Telegram.
+
+Storage is MOCK by default, with one well-funded member per recorded
+membership ID, so member orders never fail for lack of coins. With
+--storage SQLITE/MYSQL the configured databases are used as they are (point
+them at a copy!) and every login uses --member/--pin.
+
+Reports per-update latency (from when the message was due to when the bot
+finished with it), time spent in each handler, and database calls per
+handler. The bot reads the wall clock for cutoffs and cancel windows, so
+replies can differ from the original run; compare like with like.
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+import traffic
+
+# Recording while replaying would append the replay to its own input
+traffic.RECORD_UPDATES_FILE = None
+
+import bot
+import database
+import merchants
+import stock
+from backends import MemoryBackend
+from memstore import MemoryStore
+
+REPLAY_PIN = "1234"
+REPLAY_COINS = 10 ** 9
+FAKE_TOKEN = "123456:REPLAY"
+
+# Name of the handler running in this task, for attributing database calls
+CURRENT_HANDLER = contextvars.ContextVar("current_handler", default="(no handler)")
+# Set while inside a counted database call, so nested calls count once
+IN_DB_CALL = contextvars.ContextVar("in_db_call", default=False)
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls locally, as Telegram would for a private chat."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        elif api_method.startswith("send"):
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class ReplayStats:
+    def __init__(self):
+        self.update_latency = []
+        self.handler_time = {}  # handler -> [seconds, ...]
+        self.db_calls = {}      # handler -> {database function: calls}
+        self.errors = 0
+
+    def handler_done(self, name, elapsed):
+        self.handler_time.setdefault(name, []).append(elapsed)
+
+    def db_call(self, function):
+        counts = self.db_calls.setdefault(CURRENT_HANDLER.get(), {})
+        counts[function] = counts.get(function, 0) + 1
+
+    def summary(self, wall_seconds, api_calls):
+        handlers = {}
+        for name, times in sorted(self.handler_time.items()):
+            db = self.db_calls.get(name, {})
+            handlers[name] = {
+                "calls": len(times),
+                "p50_ms": percentile(times, 50) * 1000,
+                "p95_ms": percentile(times, 95) * 1000,
+                "max_ms": max(times) * 1000,
+                "db_calls": sum(db.values()),
+                "db_calls_per_call": sum(db.values()) / len(times),
+                "db_functions": dict(sorted(db.items())),
+            }
+        latency = self.update_latency
+        return {
+            "updates": len(latency),
+            "wall_seconds": wall_seconds,
+            "errors": self.errors,
+            "update_latency_ms": {
+                "p50": percentile(latency, 50) * 1000,
+                "p95": percentile(latency, 95) * 1000,
+                "p99": percentile(latency, 99) * 1000,
+                "max": max(latency, default=0) * 1000,
+            },
+            "handlers": handlers,
+            "bot_api_calls": dict(sorted(api_calls.items())),
+            "db_calls_outside_handlers": self.db_calls.get("(no handler)", {}),
+        }
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def count_db_calls(stats):
+    """Wraps database's public functions to count calls per handler."""
+    for name, function in list(vars(database).items()):
+        if name.startswith("_") or not inspect.isfunction(function) or function.__module__ != database.__name__:
+            continue
+
+        def counted(*args, _name=name, _function=function, **kwargs):
+            if IN_DB_CALL.get():
+                return _function(*args, **kwargs)
+            stats.db_call(_name)
+            token = IN_DB_CALL.set(True)
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                IN_DB_CALL.reset(token)
+
+        setattr(database, name, functools.wraps(function)(counted))
+
+
+def instrument(handler, stats):
+    """Times a handler's callback (recursing into ConversationHandlers)."""
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            instrument(inner, stats)
+        return
+    callback = handler.callback
+    name = callback.__name__
+
+    async def timed(update, context):
+        token = CURRENT_HANDLER.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            stats.handler_done(name, time.perf_counter() - started)
+            CURRENT_HANDLER.reset(token)
+
+    handler.callback = timed
+
+
+def seed_members(member_count):
+    """MOCK storage where {member:N} logs in as R<N> with REPLAY_PIN."""
+    members = [
+        {"member_id": f"R{n}", "pin": REPLAY_PIN, "name": f"Replay Member {n}", "coins": REPLAY_COINS}
+        for n in range(1, member_count + 1)
+    ]
+    for merchant_id in merchants.MERCHANTS:
+        database.use_backend(MemoryBackend(MemoryStore(members, merchant_id=merchant_id)), merchant_id)
+
+
+def replayed_text(text, member_id=None, pin=None):
+    """Fills in the login placeholders traffic.UpdateRecorder wrote."""
+    if text == traffic.PIN_PLACEHOLDER:
+        return pin or REPLAY_PIN
+    match = traffic.MEMBER_PLACEHOLDER_RE.fullmatch(text)
+    if match:
+        return member_id or f"R{match.group(1)}"
+    return text
+
+
+# Checkout idempotency keys are built from chat and message ids, so message
+# ids must not repeat across runs against the same SQLite/MySQL database
+MESSAGE_ID_BASE = int(time.time()) * 1_000_000
+
+
+def make_update(update_id, entry, text):
+    message = {
+        "message_id": MESSAGE_ID_BASE + update_id,
+        "date": int(time.time()),
+        "chat": {"id": entry["c"], "type": "private"},
+        "from": {"id": entry["u"], "is_bot": False, "first_name": "Replay"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+async def replay_merchant(application, entries, speed, first_t, started, stats, member_id, pin):
+    for entry in entries:
+        due = started + (entry["t"] - first_t) / speed if speed else time.monotonic()
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = replayed_text(entry["x"], member_id, pin)
+        update = Update.de_json(make_update(entry["id"], entry, text), application.bot)
+        await application.process_update(update)
+        stats.update_latency.append(time.monotonic() - due)
+
+
+async def replay(entries, speed, stats, api, member_id, pin):
+    applications = {}
+    for merchant in merchants.MERCHANTS.values():
+        merchant.token = FAKE_TOKEN
+        application = bot.get_application(merchant, request=api)
+        for group in application.handlers.values():
+            for handler in group:
+                instrument(handler, stats)
+
+        async def on_error(update, context):
+            stats.errors += 1
+            print(f"Handler error: {context.error!r}")
+
+        application.add_error_handler(on_error)
+        await application.initialize()
+        applications[merchant.merchant_id] = application
+
+    by_merchant = {}
+    for entry in entries:
+        merchant_id = entry["m"] if entry["m"] in applications else merchants.DEFAULT_MERCHANT_ID
+        by_merchant.setdefault(merchant_id, []).append(entry)
+
+    first_t = entries[0]["t"]
+    started = time.monotonic()
+    await asyncio.gather(*(
+        replay_merchant(applications[merchant_id], merchant_entries, speed, first_t, started, stats, member_id, pin)
+        for merchant_id, merchant_entries in by_merchant.items()
+    ))
+    wall = time.monotonic() - started
+    for application in applications.values():
+        await application.shutdown()
+    return wall
+
+
+def print_summary(summary, baseline=None):
+    def delta(value, old):
+        if old is None:
+            return ""
+        return f" ({value - old:+.1f})"
+
+    old_latency = (baseline or {}).get("update_latency_ms", {})
+    print(f"{summary['updates']} updates in {summary['wall_seconds']:.2f} s, {summary['errors']} handler errors")
+    print("update latency ms: " + "  ".join(
+        f"{key}={value:.1f}{delta(value, old_latency.get(key))}" for key, value in summary["update_latency_ms"].items()))
+    print(f"{'handler':<30} {'calls':>6} {'p50 ms':>14} {'p95 ms':>14} {'max ms':>9} {'db/call':>12}")
+    old_handlers = (baseline or {}).get("handlers", {})
+    for name, h in summary["handlers"].items():
+        old = old_handlers.get(name, {})
+        print(f"{name:<30} {h['calls']:>6} "
+              f"{h['p50_ms']:>6.2f}{delta(h['p50_ms'], old.get('p50_ms')):>8} "
+              f"{h['p95_ms']:>6.2f}{delta(h['p95_ms'], old.get('p95_ms')):>8} "
+              f"{h['max_ms']:>9.2f} "
+              f"{h['db_calls_per_call']:>5.2f}{delta(h['db_calls_per_call'], old.get('db_calls_per_call')):>7}")
+    for name, h in summary["handlers"].items():
+        if h["db_functions"]:
+            print(f"  {name}: " + ", ".join(f"{fn} x{n}" for fn, n in h["db_functions"].items()))
+    print("bot api: " + ", ".join(f"{method} x{n}" for method, n in summary["bot_api_calls"].items()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", help="file written with RECORD_UPDATES_FILE")
+    parser.add_argument("--speed", default="1", help="1, 10, ... times the recorded pace, or 'max'")
+    parser.add_argument("--from", dest="start", type=datetime.time.fromisoformat,
+                        help="only messages recorded at or after this time of day (HH:MM)")
+    parser.add_argument("--to", dest="end", type=datetime.time.fromisoformat,
+                        help="only messages recorded before this time of day (HH:MM)")
+    parser.add_argument("--storage", default="MOCK", choices=("MOCK", "SQLITE", "MYSQL"))
+    parser.add_argument("--member", help="membership ID for every login (needed unless MOCK)")
+    parser.add_argument("--pin", help="PIN for --member")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument("--save", help="write the summary as JSON, to --compare against later")
+    parser.add_argument("--compare", help="summary JSON of a previous run to show deltas against")
+    args = parser.parse_args()
+    if args.storage != "MOCK" and not (args.member and args.pin):
+        parser.error("--storage SQLITE/MYSQL needs --member and --pin")
+    return args
+
+
+def main():
+    args = parse_args()
+    speed = 0 if args.speed == "max" else float(args.speed)
+
+    entries = list(traffic.read_recording(args.recording, args.start, args.end))
+    if not entries:
+        sys.exit("No recorded messages in that window.")
+    for update_id, entry in enumerate(entries, 1):
+        entry["id"] = update_id
+
+    database.init_db(args.storage)
+    if args.storage == "MOCK":
+        placeholders = [traffic.MEMBER_PLACEHOLDER_RE.fullmatch(entry["x"]) for entry in entries]
+        seed_members(max((int(match.group(1)) for match in placeholders if match), default=0))
+    stock.start(merchants.MERCHANTS)
+
+    stats = ReplayStats()
+    count_db_calls(stats)
+    api = FakeBotAPI(args.api_latency_ms / 1000)
+    wall = asyncio.run(replay(entries, speed, stats, api, args.member, args.pin))
+
+    summary = stats.summary(wall, api.calls)
+    summary["speed"] = args.speed
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print(f"Replayed {args.recording} at {args.speed}x" if speed else f"Replayed {args.recording} at max speed")
+    print_summary(summary, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
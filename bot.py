@@ -1,7 +1,10 @@
 
+import asyncio
+import collections
 import logging
 import os
 import re
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -13,8 +16,15 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ConversationHandler,
+    TypeHandler,
 )
 import database
+import merchants
+import stock
+import traffic
+from admission import ADMISSION, Overloaded
+from cart import Cart
+from throttle import LOGIN_THROTTLE
 
 # -----------------------------------------------------------------------------
 # CONFIGURATION
@@ -27,6 +37,29 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Chats idle longer than this lose their conversation and user_data (cart,
+# member session). The sweep runs on incoming updates, at most this often.
+SESSION_IDLE_TIMEOUT_SECONDS = int(os.getenv("SESSION_IDLE_TIMEOUT_SECONDS", "1800"))
+SESSION_SWEEP_INTERVAL_SECONDS = int(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "60"))
+# Chats the sweep ended a conversation for, remembered (oldest dropped first)
+# so their next message still gets the session-expired notice
+MAX_SWEPT_SESSIONS = int(os.getenv("MAX_SWEPT_SESSIONS", "10000"))
+
+# Per-chat bound on what user input can make us store (cart.MAX_ITEM_QTY caps quantities)
+MAX_MEMBER_ID_LENGTH = 20
+
+# Sent when admission control sheds a request (see admission.py); the chat
+# stays in the same step so resending the message retries it
+BUSY_REPLY = "⏳ We're very busy right now. Please send that again in a few seconds."
+
+# Orders shown per /history message
+HISTORY_PAGE_SIZE = 10
+
+# Order status notifications (notification_outbox) are sent in batches of at
+# most NOTIFY_BATCH_SIZE per bot, every NOTIFY_INTERVAL_SECONDS
+NOTIFY_INTERVAL_SECONDS = int(os.getenv("NOTIFY_INTERVAL_SECONDS", "5"))
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "25"))
+
 
 # Initialize Database is now handled in main.py lifespan
 # try:
@@ -35,35 +68,6 @@ load_dotenv()
 #     logger.error(f"DB Init Failed: {e}")
 
 
-# MEMBER MENU (Coins)
-# MEMBER MENU (Rupees)
-MENU_MEMBER = {
-    "Sprouts Salad": 50,
-    "Protein Bowl": 55,
-    "Chia Pudding": 65,
-    "Oats + Chia": 65,
-    "Papaya Bowl": 50,
-    "Pineapple Bowl": 50,
-    "Muskmelon Bowl": 50,
-    "Watermelon Bowl": 50,
-    "Mixed Fruit Bowl": 65,
-    "Protein Veg Salad": 155
-}
-
-# NON-MEMBER MENU (Rupees)
-MENU_NON_MEMBER = {
-    "Sprouts Salad": 50,
-    "Protein Bowl": 55,
-    "Chia Pudding": 65,
-    "Oats + Chia": 65,
-    "Papaya Bowl": 50,
-    "Pineapple Bowl": 50,
-    "Muskmelon Bowl": 50,
-    "Watermelon Bowl": 50,
-    "Mixed Fruit Bowl": 65,
-    "Protein Veg Salad": 155
-}
-
 # STATES
 PLAN_SELECTION = 1
 MEMBER_LOGIN = 2
@@ -73,6 +77,144 @@ TAKEAWAY_SELECTION = 5
 MEMBER_DELIVERY_CHOICE = 6
 MEMBER_PREORDER_DATE = 7
 
+# -----------------------------------------------------------------------------
+# SESSIONS
+# -----------------------------------------------------------------------------
+
+class SessionTracker:
+    """Tracks when each chat was last active and evicts idle ones.
+
+    python-telegram-bot's own conversation_timeout needs the JobQueue, which
+    this bot runs without, so idle chats are found by a sweep instead. An
+    evicted chat loses its user_data and its place in the conversation.
+
+    Ending a conversation from outside uses ConversationHandler._conversations,
+    which is private: requirements.txt pins python-telegram-bot to the version
+    this was written against (21.0.1); re-check it before upgrading.
+    """
+
+    def __init__(self, application, conversation, idle_timeout=SESSION_IDLE_TIMEOUT_SECONDS):
+        self.application = application
+        self.conversation = conversation
+        self.idle_timeout = idle_timeout
+        self.last_seen = {}  # (chat_id, user_id) -> monotonic time of last update
+        self.last_sweep = time.monotonic()
+        self.evicted = 0
+        self.swept = collections.OrderedDict()  # (chat_id, user_id) -> None, not yet told
+
+    def evict(self, key):
+        chat_id, user_id = key
+        self.last_seen.pop(key, None)
+        # An abandoned cart's items go back on sale
+        cart = self.application.user_data.get(user_id, {}).get("cart")
+        if cart is not None:
+            cart.release_stock()
+        self.application.drop_user_data(user_id)
+        # No public API ends a conversation from outside; this is the dict
+        # ConversationHandler keeps its state in (python-telegram-bot 21.0.1).
+        had_conversation = self.conversation._conversations.pop(key, None) is not None
+        self.evicted += 1
+        return had_conversation
+
+    def sweep(self, now):
+        self.last_sweep = now
+        for key, seen in list(self.last_seen.items()):
+            if now - seen > self.idle_timeout and self.evict(key):
+                self.swept[key] = None
+                self.swept.move_to_end(key)
+                while len(self.swept) > MAX_SWEPT_SESSIONS:
+                    self.swept.popitem(last=False)
+
+    def touch(self, chat_id, user_id):
+        """Records activity; returns True if this chat's session had expired."""
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        seen = self.last_seen.get(key)
+        # Ended by an earlier sweep: this is the chat's first message since
+        expired = key in self.swept
+        self.swept.pop(key, None)
+        if seen is not None and now - seen > self.idle_timeout:
+            expired = self.evict(key)
+        self.last_seen[key] = now
+        if now - self.last_sweep > SESSION_SWEEP_INTERVAL_SECONDS:
+            self.sweep(now)
+        return expired
+
+    def stats(self):
+        return {
+            "live_sessions": len(self.last_seen),
+            "user_data_entries": len(self.application.user_data),
+            "evicted": self.evicted,
+            "swept_not_yet_notified": len(self.swept),
+            "idle_timeout_seconds": self.idle_timeout,
+        }
+
+async def track_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every other handler (group -1) to keep sessions fresh."""
+    if not update.effective_chat or not update.effective_user:
+        return
+    sessions = context.bot_data["sessions"]
+    if sessions.touch(update.effective_chat.id, update.effective_user.id) and update.effective_message:
+        await update.effective_message.reply_text("⌛ Your session expired due to inactivity. Send /start to begin again.")
+
+def session_stats(application):
+    """Live-session gauge for one bot application."""
+    return application.bot_data["sessions"].stats()
+
+def login_input(update, context):
+    """For the update recorder: "member_id" or "pin" if this message is login input."""
+    conversation = context.bot_data["sessions"].conversation
+    # Private state, see SessionTracker
+    if conversation._conversations.get((update.effective_chat.id, update.effective_user.id)) != MEMBER_LOGIN:
+        return None
+    if update.message.text.startswith("/"):
+        return None
+    return "pin" if "temp_id" in context.user_data else "member_id"
+
+# -----------------------------------------------------------------------------
+# NOTIFICATIONS
+# -----------------------------------------------------------------------------
+
+STATUS_MESSAGES = {
+    "Preparing": "👩‍🍳 Your order #{order_id} is being prepared.",
+    "Ready": "🛎️ Your order #{order_id} is ready!",
+    "Completed": "✅ Your order #{order_id} is complete. Enjoy your meal!",
+    "Cancelled": "🚫 Your order #{order_id} was cancelled. Any coins paid have been refunded.",
+    "Expired": "⌛ Your order #{order_id} expired without being collected.",
+}
+
+def notification_text(note):
+    text = STATUS_MESSAGES.get(note["status"], "🔔 Your order #{order_id} is now {status}.").format(**note)
+    if note.get("items"):
+        text += f"\n🧾 {note['items']}"
+    return text
+
+async def drain_outbox(bot_apps):
+    """Sends one batch of pending order notifications per merchant bot.
+
+    Runs as a scheduler job in the process that owns the bots. Sends in a
+    batch go out concurrently and are marked sent together afterwards, so a
+    crash in between can repeat a message but never loses one.
+    """
+    sent = failed = 0
+    for merchant_id, application in list(bot_apps.items()):
+        pending = await asyncio.to_thread(database.get_pending_notifications, NOTIFY_BATCH_SIZE, merchant_id)
+        if not pending:
+            continue
+        results = await asyncio.gather(
+            *(application.bot.send_message(note["chat_id"], notification_text(note)) for note in pending),
+            return_exceptions=True,
+        )
+        sent_ids = [note["id"] for note, result in zip(pending, results) if not isinstance(result, Exception)]
+        failed_ids = [note["id"] for note, result in zip(pending, results) if isinstance(result, Exception)]
+        for note, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Notification {note['id']} to chat {note['chat_id']} failed: {result}")
+        await asyncio.to_thread(database.finish_notifications, sent_ids, failed_ids, merchant_id)
+        sent += len(sent_ids)
+        failed += len(failed_ids)
+    return {"sent": sent, "failed": failed}
+
 # -----------------------------------------------------------------------------
 # HELPER FUNCTIONS
 # -----------------------------------------------------------------------------
@@ -84,33 +226,34 @@ def get_greeting():
     elif 17 <= h < 21: return "Good Evening 🌆"
     else: return "Good Night 🌙"
 
-def format_cart_table(cart, is_member):
-    lines = []
-    lines.append("Item | Qty | Price")
-    lines.append("-" * 25)
-    
-    total = 0
-    menu = MENU_MEMBER if is_member else MENU_NON_MEMBER
-    
-    for item, qty in cart.items():
-        cost = menu.get(item, 0) * qty
-        total += cost
-        lines.append(f"{item} | {qty} | ₹{cost}")
-    
-    lines.append("-" * 25)
-    return "\n".join(lines), total
+def get_merchant(context):
+    """The outlet this bot application serves (see get_application)."""
+    return context.bot_data.get("merchant") or merchants.get_merchant()
+
+def new_cart(context, menu):
+    """Replaces the chat's cart with an empty one, releasing the old one's stock."""
+    discard_cart(context)
+    cart = context.user_data["cart"] = Cart(menu, stock.get_counter(get_merchant(context).merchant_id))
+    return cart
+
+def discard_cart(context):
+    cart = context.user_data.pop("cart", None)
+    if cart is not None:
+        cart.release_stock()
 
 # -----------------------------------------------------------------------------
 # HANDLERS
 # -----------------------------------------------------------------------------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    discard_cart(context)
     context.user_data.clear()
+    merchant = get_merchant(context)
     
     greeting = get_greeting()
     msg = (
         f"🌟 {greeting}\n\n"
-        "Welcome to *Neutrious Theory* 🥗💪\n"
+        f"Welcome to *{merchant.name}* 🥗💪\n"
         "Your health, our priority.\n\n"
         "Please select your plan:\n"
         "1️⃣ Membership\n"
@@ -128,7 +271,7 @@ async def handle_plan_selection(update: Update, context: ContextTypes.DEFAULT_TY
         return MEMBER_LOGIN
     elif text == "2":
         context.user_data["is_member"] = False
-        context.user_data["cart"] = {}
+        new_cart(context, get_merchant(context).menu_non_member)
         await show_non_member_menu(update, context)
         return NON_MEMBER_SHOPPING
     else:
@@ -150,6 +293,9 @@ async def handle_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     # Store ID temporarily
     if "temp_id" not in context.user_data:
+        if len(text) > MAX_MEMBER_ID_LENGTH:
+            await update.message.reply_text("❌ Invalid Membership ID. Try again.")
+            return MEMBER_LOGIN
         context.user_data["temp_id"] = text
         await update.message.reply_text("🔐 Enter your 4-digit PIN:")
         return MEMBER_LOGIN
@@ -157,12 +303,30 @@ async def handle_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         # Validate ID + PIN
         member_id = context.user_data["temp_id"]
         pin = text
-        
-        member = database.check_member(member_id, pin)
+        merchant = get_merchant(context)
+        chat_id = update.effective_chat.id
+
+        # Guessing PINs is throttled before it costs a query
+        wait = LOGIN_THROTTLE.check(chat_id, member_id, merchant.merchant_id)
+        if wait:
+            del context.user_data["temp_id"]
+            minutes = max(1, round(wait / 60))
+            await update.message.reply_text(f"🚫 Too many wrong PINs. Please try again in {minutes} min.")
+            return MEMBER_LOGIN
+
+        try:
+            async with ADMISSION.admit_async("menu"):
+                member = await asyncio.to_thread(database.check_member, member_id, pin, merchant_id=merchant.merchant_id)
+        except Overloaded:
+            await update.message.reply_text(BUSY_REPLY)
+            return MEMBER_LOGIN
         if member:
-            context.user_data["member_data"] = member
+            LOGIN_THROTTLE.succeeded(chat_id, member_id, merchant.merchant_id)
+            del context.user_data["temp_id"]
+            # The session never needs the PIN again, so it is not kept
+            context.user_data["member_data"] = {k: v for k, v in member.items() if k != "pin"}
             context.user_data["is_member"] = True
-            context.user_data["cart"] = {}
+            new_cart(context, merchant.menu_member)
             
             coins = member['coins']
             
@@ -173,7 +337,7 @@ async def handle_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
                 "🍽️ Today’s Menu:\n"
             )
             i = 1
-            for item, price in MENU_MEMBER.items():
+            for item, price in merchant.menu_member.items():
                 msg += f"{i}. {item} – ₹{price}\n"
                 i += 1
             
@@ -186,6 +350,7 @@ async def handle_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             await update.message.reply_text(msg, reply_markup=reply_markup)
             return MEMBER_SHOPPING
         else:
+            LOGIN_THROTTLE.failed(chat_id, member_id, merchant.merchant_id)
             del context.user_data["temp_id"]
             await update.message.reply_text("❌ Invalid ID or PIN. Try again from ID.")
             return MEMBER_LOGIN
@@ -195,7 +360,7 @@ async def show_non_member_menu(update: Update, context: ContextTypes.DEFAULT_TYP
         "🍽️ Today’s Menu (Non-Member):\n\n"
     )
     i = 1
-    for item, price in MENU_NON_MEMBER.items():
+    for item, price in get_merchant(context).menu_non_member.items():
         msg += f"{i}. {item} – ₹{price}\n"
         i += 1
         
@@ -207,8 +372,10 @@ async def show_non_member_menu(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text.strip()
-    cart = context.user_data.get("cart", {})
     is_member = context.user_data.get("is_member", False)
+    merchant = get_merchant(context)
+    menu = merchant.menu_member if is_member else merchant.menu_non_member
+    cart = context.user_data["cart"] if "cart" in context.user_data else new_cart(context, menu)
     
     # Check for keywords
     # Check for keywords
@@ -218,7 +385,10 @@ async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
             await update.message.reply_text("❌ Cart is empty.", reply_markup=markup)
             return MEMBER_SHOPPING if is_member else NON_MEMBER_SHOPPING
-        
+
+        # One order per checkout: a repeated or retried confirmation of this
+        # checkout gets the order already placed instead of a second one
+        context.user_data["checkout_key"] = f"tg:{update.effective_chat.id}:{update.message.message_id}"
         if is_member:
             return await ask_member_delivery_option(update, context)
         else:
@@ -226,7 +396,12 @@ async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
     if is_member and text.lower() in ["balance", "coins", "membership balance"]:
         member_id = context.user_data["member_data"]["member_id"]
-        coins = database.get_member_balance(member_id)
+        try:
+            async with ADMISSION.admit_async("menu"):
+                coins = await asyncio.to_thread(database.get_member_balance, member_id, merchant_id=merchant.merchant_id)
+        except Overloaded:
+            await update.message.reply_text(BUSY_REPLY)
+            return MEMBER_SHOPPING
         msg = (
             "💳 *Membership Balance*\n\n"
             f"Available: ₹{coins}\n"
@@ -255,7 +430,6 @@ async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             input_identifier = match.group(1).strip()
             qty = int(match.group(2))
             
-            menu = MENU_MEMBER if is_member else MENU_NON_MEMBER
             valid_item = None
             
             # Check if input is a number (Menu Index)
@@ -275,24 +449,27 @@ async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 if is_removal:
                     # Remove Logic
                     if valid_item in cart:
-                        current_qty = cart[valid_item]
-                        new_qty = current_qty - qty
+                        new_qty = cart.remove(valid_item, qty)
                         if new_qty <= 0:
-                            del cart[valid_item]
                             items_updates.append(f"❌ Removed: {valid_item}")
                         else:
-                            cart[valid_item] = new_qty
                             items_updates.append(f"📉 Decreased: {valid_item} (Now x{new_qty})")
                     else:
                         items_updates.append(f"⚠️ Not in cart: {valid_item}")
                 else:
                     # Add Logic
                     if qty > 0:
-                        cart[valid_item] = cart.get(valid_item, 0) + qty 
-                        items_updates.append(f"✅ Added: {valid_item} x {qty}")
+                        old_qty = cart.qty(valid_item)
+                        added = cart.add(valid_item, qty) - old_qty
+                        if added == qty:
+                            items_updates.append(f"✅ Added: {valid_item} x {qty}")
+                        elif added > 0:
+                            items_updates.append(f"⚠️ Only {added} more {valid_item} available: added x {added}")
+                        else:
+                            items_updates.append(f"🚫 Sold out: {valid_item}")
                     elif qty == 0:
                         if valid_item in cart: 
-                            del cart[valid_item]
+                            cart.remove(valid_item)
                             items_updates.append(f"❌ Removed: {valid_item}")
             else:
                 items_updates.append(f"⚠️ Not Found: {input_identifier}")
@@ -302,10 +479,8 @@ async def handle_shopping(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
     if items_updates:
-        context.user_data["cart"] = cart
-        
         # Show dynamic table
-        table_str, total = format_cart_table(cart, is_member)
+        table_str, total = cart.render()
         
         update_summary = "\n".join(items_updates)
         msg = (
@@ -336,13 +511,18 @@ async def ask_member_delivery_option(update: Update, context: ContextTypes.DEFAU
     cart = context.user_data["cart"]
     member_data = context.user_data["member_data"]
     member_id = member_data["member_id"]
+    merchant = get_merchant(context)
     
-    # Calculate Total
-    total_coins = 0
-    for item, qty in cart.items():
-        total_coins += MENU_MEMBER[item] * qty
+    # Running total kept by the cart
+    total_coins = cart.total
         
-    current_balance = database.get_member_balance(member_id)
+    try:
+        async with ADMISSION.admit_async("checkout"):
+            current_balance = await asyncio.to_thread(database.get_member_balance, member_id,
+                                                      merchant_id=merchant.merchant_id)
+    except Overloaded:
+        await update.message.reply_text(BUSY_REPLY)
+        return MEMBER_SHOPPING
     
     # Pre-check funds
     if total_coins > current_balance:
@@ -434,7 +614,7 @@ async def handle_member_preorder_date(update: Update, context: ContextTypes.DEFA
     elif text in ["cancel", "no", "stop"]:
         await update.message.reply_text(
             "🚫 Your Order Cancelled!\n\n"
-            "Thank you for visiting *Neutrious Theory* 🙏",
+            f"Thank you for visiting *{get_merchant(context).name}* 🙏",
             parse_mode="Markdown"
         )
         return MEMBER_SHOPPING
@@ -447,20 +627,9 @@ async def process_member_transaction(update: Update, context: ContextTypes.DEFAU
     cart = context.user_data["cart"]
     member_id = context.user_data["member_data"]["member_id"]
     total_coins = context.user_data["final_coins"]
+    merchant = get_merchant(context)
     
-    # Re-read balance just in case
-    current_balance = database.get_member_balance(member_id)
-    new_balance = current_balance - total_coins
-    
-    # Verify again (race condition minimal in this demo)
-    if new_balance < 0:
-        await update.message.reply_text("❌ Insufficient coins.")
-        return MEMBER_SHOPPING
-        
-    # Update DB
-    database.update_member_coins(member_id, new_balance)
-    
-    table_str, _ = format_cart_table(cart, True)
+    table_str, _ = cart.render()
     
     order_type = "Immediate"
     del_date = None
@@ -485,8 +654,26 @@ async def process_member_transaction(update: Update, context: ContextTypes.DEFAU
     
     # SAVE ORDER
     # Create Item Summary
-    items_summary = ", ".join([f"{k} x{v}" for k, v in cart.items()])
-    database.save_order(member_id, total_coins, order_type, del_date, items_summary)
+    items_summary = cart.summary()
+    try:
+        async with ADMISSION.admit_async("checkout"):
+            # Debit is conditional on the balance, so this is also the final funds check
+            # Run off the event loop, so other chats are served (or shed) meanwhile
+            order = await asyncio.to_thread(database.place_member_order, member_id, total_coins, order_type, del_date,
+                                            items_summary, chat_id=update.effective_chat.id,
+                                            merchant_id=merchant.merchant_id,
+                                            idempotency_key=context.user_data.get("checkout_key"))
+            new_balance = (await asyncio.to_thread(database.get_member_balance, member_id, merchant_id=merchant.merchant_id)
+                           if order else None)
+    except Overloaded:
+        # Nothing was debited; the cart is kept so "Place Order" retries
+        await update.message.reply_text(BUSY_REPLY)
+        return MEMBER_SHOPPING
+    if not order:
+        await update.message.reply_text("❌ Insufficient coins.")
+        return MEMBER_SHOPPING
+    if not order.get("replayed"):
+        cart.commit_stock()
     
     msg = (
         "✅ Thank you for your Order! 🙏\n\n"
@@ -496,14 +683,14 @@ async def process_member_transaction(update: Update, context: ContextTypes.DEFAU
         f"💳 Remaining Balance: ₹{new_balance}\n\n"
         f"{pickup_msg}\n\n"
         "To cancel, type: */cancel_order*\n\n"
-        "🌟 *Neutrious Theory* 🌟"
+        f"🌟 *{merchant.name}* 🌟"
     )
     await update.message.reply_text(msg)
     return ConversationHandler.END
 
 async def finalize_non_member_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     cart = context.user_data["cart"]
-    table_str, total = format_cart_table(cart, False)
+    table_str, total = cart.render()
     
     context.user_data["final_total"] = total
     
@@ -538,25 +725,92 @@ async def handle_takeaway(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Save Order
     # Create Item Summary
-    cart = context.user_data.get("cart", {})
-    items_summary = ", ".join([f"{k} x{v}" for k, v in cart.items()])
+    items_summary = context.user_data["cart"].summary()
     
-    database.save_order(db_id, total, "Takeaway", None, items_summary)
+    merchant = get_merchant(context)
+    try:
+        async with ADMISSION.admit_async("checkout"):
+            order = await asyncio.to_thread(database.save_order, db_id, total, "Takeaway", None, items_summary,
+                                            chat_id=update.effective_chat.id, merchant_id=merchant.merchant_id,
+                                            idempotency_key=context.user_data.get("checkout_key"))
+    except Overloaded:
+        await update.message.reply_text(BUSY_REPLY)
+        return TAKEAWAY_SELECTION
+    if not order:
+        # Nothing was saved; the cart keeps its reservation so a retry can use it
+        await update.message.reply_text("❌ Could not place the order. Please reply 1, 2, or 3 to try again.")
+        return TAKEAWAY_SELECTION
+    if order.get("replayed"):
+        # Same checkout confirmed again: show the guest ID it already has
+        db_id = order["member_id"]
+        guest_id = db_id.split("-", 1)[-1]
+    else:
+        context.user_data["cart"].commit_stock()
     
     msg = (
         "✅ Order Confirmed!\n\n"
         f"🔢 **Your Order ID: {guest_id}**\n"
         f"📍 Please pay ₹{total} at the shop counter\n"
         f"⏰ Pickup Time: {pickup_time}\n\n"
-        "Thank you for visiting *Neutrious Theory* 🥗"
+        f"Thank you for visiting *{merchant.name}* 🥗"
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    discard_cart(context)
     await update.message.reply_text("🚫 Operation cancelled. /start to reset.")
     return ConversationHandler.END
 
+def find_and_cancel_order(target_order_id, member_id, merchant_id):
+    """The blocking part of handle_cancel_last_order, run in a worker thread.
+
+    Finds the order (by id, else the member's last active one), checks the
+    cancel rules and cancels it with a refund. Returns (order, member_id,
+    error reply or None, new balance).
+    """
+    order_to_cancel = None
+
+    # Strategy 1: Look up by Order ID if provided
+    if target_order_id:
+        order_to_cancel = database.get_order(target_order_id, merchant_id=merchant_id)
+        if order_to_cancel:
+            member_id = order_to_cancel['member_id'] # found owner
+
+    # Strategy 2: Look up last active order for cached member
+    elif member_id:
+        order_to_cancel = database.get_last_active_order(member_id, merchant_id=merchant_id)
+
+    if not order_to_cancel:
+        return None, member_id, "❌ No active order found to cancel.", None
+
+    # Check status
+    if order_to_cancel['status'] != 'Active':
+        return None, member_id, "❌ Order is already processed or cancelled.", None
+
+    # Check Rules: the deadline was fixed when the order was placed
+    # (backends.cancel_deadline_for), so this is one comparison
+    now = datetime.now()
+    order_type = order_to_cancel["type"]
+    deadline = order_to_cancel.get("cancel_deadline")
+
+    if deadline is None or now >= deadline:
+        if "Takeaway" in order_type or order_type == "Immediate":
+            fail_reason = "Cancellation time (15 mins) exceeded."
+        elif order_type == "Pre-order" and deadline is not None:
+            if now.date() == deadline.date():
+                fail_reason = "Cannot cancel on Delivery Day after 6:00 AM."
+            else:
+                fail_reason = "Order date passed."
+        else:
+            fail_reason = "Date error."
+        return None, member_id, f"❌ Cancel Failed: {fail_reason}", None
+
+    if not database.cancel_order_refund(order_to_cancel["id"], member_id, order_to_cancel["amount"],
+                                        merchant_id=merchant_id):
+        return None, member_id, "❌ Database Error: Could not cancel.", None
+    return order_to_cancel, member_id, None, database.get_member_balance(member_id, merchant_id=merchant_id)
+
 async def handle_cancel_last_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles logic to cancel the last active order."""
     try:
@@ -568,6 +822,8 @@ async def handle_cancel_last_order(update: Update, context: ContextTypes.DEFAULT
             if args[0].isdigit():
                 target_order_id = int(args[0])
         
+        merchant = get_merchant(context)
+
         # Determine Member ID or identifying info
         member_id = None
         if "member_data" in context.user_data:
@@ -584,121 +840,96 @@ async def handle_cancel_last_order(update: Update, context: ContextTypes.DEFAULT
             )
             return
 
-        order_to_cancel = None
-        
-        # Strategy 1: Look up by Order ID if provided
-        if target_order_id:
-            # We need a db function to get order by ID
-            # Currently we primarily have get_last_active_order. 
-            # I'll rely on a manual search since I can't easily change DB interface right now without risk.
-            # Actually, let's use a quick search similar to update_order_status
-             all_orders = database.get_all_orders() # efficient enough for demo
-             for o in all_orders:
-                 if o['id'] == target_order_id:
-                     order_to_cancel = o
-                     member_id = o['member_id'] # found owner
-                     break
-                     
-        # Strategy 2: Look up last active order for cached member
-        elif member_id:
-            order_to_cancel = database.get_last_active_order(member_id)
-
-        if not order_to_cancel:
-            await update.message.reply_text("❌ No active order found to cancel.")
+        try:
+            async with ADMISSION.admit_async("checkout"):
+                # Lookup, cancel and new balance in one worker thread, off the event loop
+                order_to_cancel, member_id, error, new_bal = await asyncio.to_thread(
+                    find_and_cancel_order, target_order_id, member_id, merchant.merchant_id)
+        except Overloaded:
+            await update.message.reply_text(BUSY_REPLY)
+            return
+        if error:
+            await update.message.reply_text(error)
             return
-            
-        # Check status
-        if order_to_cancel['status'] != 'Active':
-             await update.message.reply_text("❌ Order is already processed or cancelled.")
-             return
 
-        # Check Rules
-        now = datetime.now()
-        
-        # Parse Time
-        # DB 'time' might be str or datetime depending on DB mode. 
-        # get_last_active_order handles conversion, but let's be safe.
-        order_time = order_to_cancel["time"]
-        if isinstance(order_time, str):
-            try:
-                # Attempt common formats
-                order_time = datetime.strptime(order_time, "%Y-%m-%d %H:%M:%S.%f")
-            except:
-                try:
-                    order_time = datetime.strptime(order_time, "%Y-%m-%d %H:%M:%S")
-                except:
-                    order_time = now # Fallback
-
-        order_type = order_to_cancel["type"]
         refund_amt = order_to_cancel["amount"]
-        
-        can_cancel = False
-        fail_reason = ""
-        
-        if "Takeaway" in order_type or order_type == "Immediate":
-            # Rule: Within 15 mins
-            elapsed = (now - order_time).total_seconds()
-            if elapsed < 900: # 15 * 60
-                can_cancel = True
-            else:
-                fail_reason = "Cancellation time (15 mins) exceeded."
-                
-        elif order_type == "Pre-order":
-            # Rule: Next day before 6 AM
-            del_date_str = order_to_cancel["delivery_date"]
-            try:
-                del_date = datetime.strptime(del_date_str, "%d-%m-%Y")
-                if now.date() == del_date.date():
-                    if now.hour < 6:
-                        can_cancel = True
-                    else:
-                        fail_reason = "Cannot cancel on Delivery Day after 6:00 AM."
-                elif now.date() < del_date.date():
-                    can_cancel = True
-                else:
-                    fail_reason = "Order date passed."
-            except:
-                can_cancel = False
-                fail_reason = "Date error."
-
-        if can_cancel:
-            success = database.cancel_order_refund(order_to_cancel["id"], member_id, refund_amt)
-            if success:
-                # Update coins in local session if possible
-                if "member_data" in context.user_data and context.user_data["member_data"]["member_id"] == member_id:
-                     context.user_data["member_data"]["coins"] += refund_amt
-                     
-                new_bal = database.get_member_balance(member_id)
-                await update.message.reply_text(
-                    "✅ **Order Cancelled Successfully**\n\n"
-                    f"🔢 Order ID: {order_to_cancel['id']}\n"
-                    f"💰 Refunded: ₹{refund_amt}\n"
-                    f"💳 Wallet Balance: ₹{new_bal}\n\n"
-                    "Thank you for visiting *Neutrious Theory* 🙏",
-                    parse_mode="Markdown"
-                )
-            else:
-                await update.message.reply_text("❌ Database Error: Could not cancel.")
-        else:
-            await update.message.reply_text(f"❌ Cancel Failed: {fail_reason}")
-            
+        stock.record_cancel(merchant.merchant_id, order_to_cancel["items"], order_to_cancel["time"])
+        # Update coins in local session if possible
+        if "member_data" in context.user_data and context.user_data["member_data"]["member_id"] == member_id:
+             context.user_data["member_data"]["coins"] += refund_amt
+
+        await update.message.reply_text(
+            "✅ **Order Cancelled Successfully**\n\n"
+            f"🔢 Order ID: {order_to_cancel['id']}\n"
+            f"💰 Refunded: ₹{refund_amt}\n"
+            f"💳 Wallet Balance: ₹{new_bal}\n\n"
+            f"Thank you for visiting *{merchant.name}* 🙏",
+            parse_mode="Markdown"
+        )
+
     except Exception as e:
         logger.error(f"Cancel Error: {e}")
         await update.message.reply_text("❌ An error occurred while processing cancellation.")
 
 
+async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history [before_id]: one page of the logged-in member's past orders."""
+    if "member_data" not in context.user_data:
+        await update.message.reply_text("🔐 Please /start and log in as a member to see your order history.")
+        return
+    member_id = context.user_data["member_data"]["member_id"]
+    merchant = get_merchant(context)
+    args = context.args or []
+    before = int(args[0]) if args and args[0].isdigit() else None
+
+    try:
+        async with ADMISSION.admit_async("menu"):
+            page = await asyncio.to_thread(database.get_member_orders, member_id, before, HISTORY_PAGE_SIZE,
+                                           merchant_id=merchant.merchant_id)
+    except Overloaded:
+        await update.message.reply_text(BUSY_REPLY)
+        return
+
+    if not page["orders"]:
+        await update.message.reply_text("📭 No orders found." if before is None else "📭 No older orders.")
+        return
+    lines = ["🧾 Your Orders", ""]
+    for order in page["orders"]:
+        placed = order["time"].strftime("%d-%m-%Y %H:%M") if order["time"] else "-"
+        lines.append(f"#{order['id']} · {placed} · ₹{order['amount']} · {order['status']}")
+        if order["items"]:
+            lines.append(f"   {order['items']}")
+    if page["next_before"]:
+        lines += ["", f"Older orders: /history {page['next_before']}"]
+    await update.message.reply_text("\n".join(lines))
+
+
 # -----------------------------------------------------------------------------
 # MAIN
 # -----------------------------------------------------------------------------
 
 
-def get_application():
-    TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+async def post_shutdown(application):
+    """Runs when run_polling stops (main.py's lifespan does the same itself)."""
+    database.save_mock_store()
+    # Writes out whatever the recorder still has buffered
+    traffic.close_recorders()
+
+def get_application(merchant=None, request=None):
+    """Builds the bot for one merchant (default merchant if None); each
+    merchant's token gets its own Application. request replaces the HTTP
+    client that talks to the Bot API (the replay benchmark passes a fake)."""
+    merchant = merchant or merchants.get_merchant()
+    TOKEN = merchant.token
     if not TOKEN:
-        print("Error: TELEGRAM_BOT_TOKEN not found.")
+        print(f"Error: No bot token configured for merchant '{merchant.merchant_id}'.")
         return None
 
-    application = ApplicationBuilder().token(TOKEN).job_queue(None).build()
+    builder = ApplicationBuilder().token(TOKEN).job_queue(None).post_shutdown(post_shutdown)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    application.bot_data["merchant"] = merchant
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -718,10 +949,17 @@ def get_application():
     )
 
     application.add_handler(conv_handler)
+    application.bot_data["sessions"] = SessionTracker(application, conv_handler)
+    application.add_handler(TypeHandler(Update, track_session), group=-1)
+    if traffic.RECORD_UPDATES_FILE:
+        # Ahead of track_session, so it sees each message before anything acts on it
+        recorder = traffic.get_recorder(traffic.RECORD_UPDATES_FILE, login_input)
+        application.add_handler(TypeHandler(Update, recorder.record), group=-2)
     
     # Global Handler for Order Cancellation (Outside Conversation)
     application.add_handler(CommandHandler("cancel_order", handle_cancel_last_order))
     application.add_handler(MessageHandler(filters.Regex(r"(?i)cancel order"), handle_cancel_last_order))
+    application.add_handler(CommandHandler("history", handle_history))
 
     return application
 
@@ -0,0 +1,116 @@
+# Most of one item a cart will hold; keeps per-chat state bounded
+MAX_ITEM_QTY = 99
+
+TABLE_HEADER = "Item | Qty | Price"
+TABLE_RULE = "-" * 25
+
+
+def parse_summary(summary):
+    """Inverse of Cart.summary(): 'Protein Bowl x2, Chia Pudding x1' -> {name: qty}."""
+    items = {}
+    for part in (summary or "").split(","):
+        name, sep, qty = part.strip().rpartition(" x")
+        if sep and qty.isdigit():
+            items[name] = items.get(name, 0) + int(qty)
+    return items
+
+
+class Cart:
+    """A shopping cart priced against one menu tier (member or non-member).
+
+    Unit prices are looked up once, when an item is first added, and the
+    total is kept up to date on every change instead of being summed again
+    for each message. Each line's text is cached and the rendered table is
+    rebuilt only after the cart changes.
+
+    With a stock counter (stock.StockCounter), the cart holds a reservation
+    for exactly what is in it: adding reserves, removing releases, and the
+    reservation ends with commit_stock() at checkout or release_stock() when
+    the cart is thrown away.
+    """
+    __slots__ = ("menu", "stock", "lines", "total", "_line_text", "_table")
+
+    def __init__(self, menu, stock=None):
+        self.menu = menu
+        self.stock = stock
+        self.lines = {}       # item -> [qty, unit_price], in the order items were added
+        self.total = 0
+        self._line_text = {}  # item -> rendered table line
+        self._table = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __contains__(self, item):
+        return item in self.lines
+
+    def qty(self, item):
+        line = self.lines.get(item)
+        return line[0] if line else 0
+
+    def _set(self, item, qty):
+        line = self.lines.get(item)
+        if line is None:
+            line = self.lines[item] = [0, self.menu[item]]
+        self.total += (qty - line[0]) * line[1]
+        line[0] = qty
+        self._line_text[item] = f"{item} | {qty} | ₹{qty * line[1]}"
+        self._table = None
+
+    def add(self, item, qty):
+        """Adds qty of a menu item (capped at MAX_ITEM_QTY and by stock); returns the new quantity."""
+        old_qty = self.qty(item)
+        added = min(old_qty + qty, MAX_ITEM_QTY) - old_qty
+        if self.stock is not None and added > 0:
+            added = self.stock.reserve(item, added)
+        if old_qty + added == 0:
+            return 0
+        self._set(item, old_qty + added)
+        return old_qty + added
+
+    def remove(self, item, qty=None):
+        """Takes qty (all if None) of an item out; returns the quantity left."""
+        line = self.lines.get(item)
+        if line is None:
+            return 0
+        left = 0 if qty is None else line[0] - qty
+        if self.stock is not None:
+            self.stock.release(item, line[0] - max(left, 0))
+        if left > 0:
+            self._set(item, left)
+            return left
+        self.total -= line[0] * line[1]
+        del self.lines[item]
+        del self._line_text[item]
+        self._table = None
+        return 0
+
+    def commit_stock(self):
+        """Checkout: the reserved items become sold."""
+        if self.stock is not None:
+            self.stock.commit(dict(self.items()))
+            self.stock = None
+
+    def release_stock(self):
+        """The cart is abandoned: its items go back on sale."""
+        if self.stock is not None:
+            for item, line in self.lines.items():
+                self.stock.release(item, line[0])
+            self.stock = None
+
+    def items(self):
+        """(item, qty) pairs in the order they were added."""
+        return [(item, line[0]) for item, line in self.lines.items()]
+
+    def summary(self):
+        """The order's items column, e.g. 'Protein Bowl x2, Chia Pudding x1'."""
+        return ", ".join(f"{item} x{line[0]}" for item, line in self.lines.items())
+
+    def render(self):
+        """Returns (table_text, total); the text is cached until the next change."""
+        if self._table is None:
+            self._table = "\n".join([TABLE_HEADER, TABLE_RULE, *self._line_text.values(), TABLE_RULE])
+        return self._table, self.total
@@ -4,11 +4,20 @@ import './App.css';
 
 const API_URL = "http://localhost:8000";
 
+// crypto.randomUUID only exists in secure contexts (https or localhost); the
+// dashboard is often opened over plain http from a LAN address
+function newIdempotencyKey() {
+  if (crypto.randomUUID) return crypto.randomUUID();
+  const bytes = crypto.getRandomValues(new Uint8Array(16));
+  return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
 function App() {
   const [orders, setOrders] = useState([]);
   const [filter, setFilter] = useState('ALL'); // ALL, MEMBER, NON-MEMBER
   const [showOrderModal, setShowOrderModal] = useState(false);
   const [loading, setLoading] = useState(true);
+  const [selected, setSelected] = useState([]);
 
   // Poll for updates
   useEffect(() => {
@@ -49,15 +58,24 @@ function App() {
     }, 0)
   };
 
-  const handleComplete = async (orderId) => {
+  // Patch the changed rows in place instead of refetching every order
+  const updateStatus = async (orderIds, status) => {
     try {
-      await axios.post(`${API_URL}/complete-order/${orderId}`);
-      fetchOrders(); // Refresh to make it disappear
+      const res = await axios.post(`${API_URL}/orders/status`, { order_ids: orderIds, status });
+      const changed = Object.fromEntries(res.data.changed.map(o => [o.id, o]));
+      setOrders(prev => prev.map(o => changed[o.id] ? { ...o, status: changed[o.id].status } : o));
+      setSelected(prev => prev.filter(id => !changed[id]));
     } catch (err) {
-      console.error("Error completing order", err);
+      console.error("Error updating orders", err);
     }
   };
 
+  const handleComplete = (orderId) => updateStatus([orderId], 'Completed');
+
+  const toggleSelected = (orderId) => {
+    setSelected(prev => prev.includes(orderId) ? prev.filter(id => id !== orderId) : [...prev, orderId]);
+  };
+
   return (
     <div className="container">
       <header className="header">
@@ -97,6 +115,16 @@ function App() {
           ))}
         </div>
 
+        {selected.length > 0 && (
+          <div className="bulk-bar">
+            <span>{selected.length} selected</span>
+            <button className="tab-btn" onClick={() => updateStatus(selected, 'Ready')}>🔔 Ready</button>
+            <button className="tab-btn" onClick={() => updateStatus(selected, 'Completed')}>✅ Complete</button>
+            <button className="tab-btn" onClick={() => updateStatus(selected, 'Cancelled')}>🚫 Cancel</button>
+            <button className="tab-btn" onClick={() => setSelected([])}>Clear</button>
+          </div>
+        )}
+
         <div className="orders-grid">
           {loading ? (
             <p>Loading orders...</p>
@@ -104,7 +132,13 @@ function App() {
             <div className="empty-state">No orders found in this category.</div>
           ) : (
             getFilteredOrders().map(order => (
-              <OrderCard key={order.id} order={order} onComplete={handleComplete} />
+              <OrderCard
+                key={order.id}
+                order={order}
+                onComplete={handleComplete}
+                selected={selected.includes(order.id)}
+                onToggle={toggleSelected}
+              />
             ))
           )}
         </div>
@@ -117,7 +151,9 @@ function App() {
   );
 }
 
-function OrderCard({ order, onComplete }) {
+const OPEN_STATUSES = ['Active', 'Preparing', 'Ready'];
+
+function OrderCard({ order, onComplete, selected, onToggle }) {
   const isGuest = order.member_id === 'NON-MEMBER' || (order.member_id && order.member_id.toString().startsWith('Guest-'));
   const isMember = !isGuest;
 
@@ -131,6 +167,9 @@ function OrderCard({ order, onComplete }) {
     <div className={`order-card ${order.status === 'Cancelled' ? 'cancelled' : ''}`}>
       <div className="card-header">
         <span className={`badge ${isMember ? 'badge-member' : 'badge-guest'}`}>
+          {OPEN_STATUSES.includes(order.status) && (
+            <input type="checkbox" checked={selected} onChange={() => onToggle(order.id)} />
+          )}
           {isMember ? 'MEMBER' : 'GUEST'}
         </span>
         <span className="order-time">
@@ -166,7 +205,7 @@ function OrderCard({ order, onComplete }) {
           </div>
         </div>
 
-        {order.status === 'Active' && (
+        {OPEN_STATUSES.includes(order.status) && (
           <button className="done-btn" onClick={() => onComplete(order.id)}>
             ✅ Done
           </button>
@@ -185,6 +224,32 @@ function PlaceOrderModal({ onClose, refresh }) {
     isMember: false
   });
   const [submitting, setSubmitting] = useState(false);
+  const [memberMatches, setMemberMatches] = useState([]);
+  // One key per order as filled in: a double-submit or retry of the same
+  // form places it once; editing the form makes it a new order
+  const [idempotencyKey, setIdempotencyKey] = useState(newIdempotencyKey);
+
+  useEffect(() => {
+    setIdempotencyKey(newIdempotencyKey());
+  }, [formData]);
+
+  // Suggest members by ID or name prefix once typing pauses
+  useEffect(() => {
+    const q = formData.member_id.trim();
+    if (!formData.isMember || !q) {
+      setMemberMatches([]);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const res = await axios.get(`${API_URL}/members/search`, { params: { q, limit: 8, fields: 'member_id,name,coins' } });
+        setMemberMatches(res.data.members);
+      } catch (err) {
+        console.error("Error searching members:", err);
+      }
+    }, 200);
+    return () => clearTimeout(timer);
+  }, [formData.member_id, formData.isMember]);
 
   const handleSubmit = async (e) => {
     e.preventDefault();
@@ -197,8 +262,16 @@ function PlaceOrderModal({ onClose, refresh }) {
       type: formData.type
     };
 
+    const config = { headers: { 'Idempotency-Key': idempotencyKey } };
     try {
-      await axios.post(`${API_URL}/place-order`, payload);
+      try {
+        await axios.post(`${API_URL}/place-order`, payload, config);
+      } catch (err) {
+        // No response: the order may or may not have been placed, and the key
+        // makes retrying safe either way
+        if (err.response) throw err;
+        await axios.post(`${API_URL}/place-order`, payload, config);
+      }
       refresh();
       onClose();
     } catch (err) {
@@ -235,8 +308,14 @@ function PlaceOrderModal({ onClose, refresh }) {
                 required
                 value={formData.member_id}
                 onChange={e => setFormData({ ...formData, member_id: e.target.value })}
-                placeholder="e.g. 97011"
+                placeholder="e.g. 97011 or a name"
+                list="member-matches"
               />
+              <datalist id="member-matches">
+                {memberMatches.map(m => (
+                  <option key={m.member_id} value={m.member_id}>{`${m.name || ''} · ₹${m.coins}`}</option>
+                ))}
+              </datalist>
             </div>
           )}
 
@@ -1,420 +1,665 @@
-import mysql.connector
-from mysql.connector import Error
-import sqlite3
+import base64
+import json
 import os
+import socket
+import threading
+import datetime
 from dotenv import load_dotenv
+import merchants
+from memstore import MemoryStore
+from backends import (MemoryBackend, SQLiteBackend, MySQLBackend, ORDER_COLUMNS, MEMBER_COLUMNS,
+                      MEMBER_PUBLIC_COLUMNS, cancel_deadline_for)
 
 load_dotenv()
 
 # Global flag to track DB status
 # Modes: 'MYSQL', 'SQLITE', 'MOCK'
-DB_MODE = "MOCK" 
+DB_MODE = "MOCK"
 
-MOCK_MEMBERS = {
-    "97011": {"member_id": "97011", "pin": "1234", "name": "Demo Member", "coins": 1500},
-    "77452": {"member_id": "77452", "pin": "1234", "name": "Demo Member 2", "coins": 1500},
+# Requested mode from the environment: AUTO (MySQL if reachable, else SQLite),
+# MYSQL, SQLITE or MOCK. SQLITE never touches the MySQL driver.
+DB_MODE_SETTING = os.getenv("DB_MODE", "AUTO").upper()
+# Upper bound on how long startup may spend finding out MySQL is not there
+MYSQL_CONNECT_TIMEOUT = float(os.getenv("MYSQL_CONNECT_TIMEOUT", "1.0"))
+# Optional MySQL read replica for dashboard/report reads (same credentials as
+# the primary). Balance checks, checkout and every write stay on the primary.
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT")
+# Reads fall back to the primary while the replica is further behind than this
+REPLICA_MAX_LAG_SECONDS = int(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+
+MOCK_MEMBERS = [
+    {"member_id": "97011", "pin": "1234", "name": "Demo Member", "coins": 1500},
+    {"member_id": "77452", "pin": "1234", "name": "Demo Member 2", "coins": 1500},
+]
+# In-memory engine for MOCK mode (default merchant). Set MOCK_SNAPSHOT_PATH to
+# persist it across runs: startup loads it, save_mock_store() writes it (every
+# MOCK_SNAPSHOT_SECONDS from the scheduler, and at shutdown).
+MOCK_SNAPSHOT_SECONDS = int(os.getenv("MOCK_SNAPSHOT_SECONDS", "60"))
+MOCK_STORE = MemoryStore(MOCK_MEMBERS, snapshot_path=os.getenv("MOCK_SNAPSHOT_PATH"),
+                         merchant_id=merchants.DEFAULT_MERCHANT_ID)
+MOCK_STORE.load()
+
+# Active storage backend of the default merchant (see backends.py), and of
+# every merchant by id. Chosen once by init_db; each merchant is its own shard.
+BACKEND = MemoryBackend(MOCK_STORE)
+BACKENDS = {merchants.DEFAULT_MERCHANT_ID: BACKEND}
+
+# Terminal orders older than this many days are moved to orders_archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_STATUSES = ("Completed", "Cancelled", "Expired")
+# Longest idempotency key orders.idempotency_key holds. Keys are only
+# remembered while their order is in the live orders table.
+MAX_IDEMPOTENCY_KEY_LENGTH = 100
+
+# Order lifecycle: status -> statuses it may move to. Completed, Cancelled
+# and Expired are final. Cancelling a member's order refunds it.
+ORDER_TRANSITIONS = {
+    "Active": ("Preparing", "Ready", "Completed", "Cancelled", "Expired"),
+    "Preparing": ("Ready", "Completed", "Cancelled"),
+    "Ready": ("Completed", "Cancelled"),
+    "Completed": (),
+    "Cancelled": (),
+    "Expired": (),
 }
-MOCK_ORDERS = [] # List of dicts: {id, member_id, amount, type, time, delivery_date, status}
+# Largest id list transition_orders accepts in one call
+MAX_BULK_ORDERS = int(os.getenv("MAX_BULK_ORDERS", "500"))
+# Largest page get_member_orders returns
+MAX_HISTORY_PAGE = int(os.getenv("MAX_HISTORY_PAGE", "100"))
+# Largest page search_members returns
+MAX_SEARCH_PAGE = int(os.getenv("MAX_SEARCH_PAGE", "100"))
+# A customer notification that failed this many sends is given up on
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+
+# Change versions for dashboard polling (ETag), per (merchant_id, table).
+# Bumped after every committed write so an unchanged version means the
+# corresponding rows are unchanged.
+_versions = {}
+_versions_lock = threading.Lock()
+# When the API and the bot run as separate processes (main.APP_ROLE), a
+# write in one must change the ETag served by the others, so the versions
+# are kept in each shard's data_versions table instead of in this process.
+VERSIONS_IN_DB = False
+
+def _backend(merchant_id):
+    return BACKENDS[merchant_id or merchants.DEFAULT_MERCHANT_ID]
+
+def _bump(merchant_id, *tables):
+    merchant_id = merchant_id or merchants.DEFAULT_MERCHANT_ID
+    with _versions_lock:
+        for table in tables:
+            _versions[(merchant_id, table)] = _versions.get((merchant_id, table), 0) + 1
+    backend = BACKENDS.get(merchant_id)
+    if backend is None:
+        return
+    if VERSIONS_IN_DB:
+        try:
+            backend.bump_versions(tables)
+        except Exception as e:
+            print(f"Error bumping data versions: {e}")
+    # Lets the backend keep reads on the primary until the write has replicated
+    backend.note_write()
+
+def get_version(table, merchant_id=None):
+    """Current change version of a merchant's 'orders' or 'members'."""
+    merchant_id = merchant_id or merchants.DEFAULT_MERCHANT_ID
+    if VERSIONS_IN_DB:
+        try:
+            return _backend(merchant_id).data_versions().get(table, 0)
+        except Exception as e:
+            print(f"Error reading data versions: {e}")
+    return _versions.get((merchant_id, table), 0)
 
-def create_connection():
-    """Create a database connection to the MySQL database."""
-    connection = None
+def use_backend(backend, merchant_id=None):
+    """Switches a merchant's storage (default merchant if None) to backend.
+    DB_MODE follows the default merchant's backend."""
+    global BACKEND, DB_MODE
+    merchant_id = merchant_id or merchants.DEFAULT_MERCHANT_ID
+    BACKENDS[merchant_id] = backend
+    if merchant_id == merchants.DEFAULT_MERCHANT_ID:
+        BACKEND = backend
+        DB_MODE = backend.name
+
+def _mysql_reachable(timeout):
+    """Cheap TCP probe, so an absent server costs at most `timeout` seconds."""
+    try:
+        socket.create_connection(
+            (os.getenv("DB_HOST", "localhost"), int(os.getenv("DB_PORT", "3306"))), timeout
+        ).close()
+        return True
+    except OSError:
+        return False
+
+def _init_mysql(merchant):
+    from mysql.connector import Error, errorcode
+
+    backend = MySQLBackend(database=merchant.mysql_database, connect_timeout=MYSQL_CONNECT_TIMEOUT,
+                           merchant_id=merchant.merchant_id)
     try:
-        connection = mysql.connector.connect(
-            host=os.getenv("DB_HOST", "localhost"),
-            user=os.getenv("DB_USER", "root"),
-            password=os.getenv("DB_PASS", ""),
-            database=os.getenv("DB_NAME", "nutritious_theory")
+        backend.connection()
+    except Error as e:
+        if e.errno != errorcode.ER_BAD_DB_ERROR:
+            raise
+        # First run against this server
+        backend.create_database()
+        backend.connection()
+    use_backend(backend, merchant.merchant_id)
+    print(f"✅ Using MySQL Database '{merchant.mysql_database}' for {merchant.name}.")
+    if DB_REPLICA_HOST:
+        backend.attach_replica(
+            MySQLBackend(host=DB_REPLICA_HOST, port=DB_REPLICA_PORT, database=merchant.mysql_database,
+                         connect_timeout=MYSQL_CONNECT_TIMEOUT, merchant_id=merchant.merchant_id),
+            REPLICA_MAX_LAG_SECONDS,
         )
-        return connection
+        print(f"✅ Dashboard reads routed to replica {DB_REPLICA_HOST}.")
+    try:
+        backend.init_schema()
     except Error as e:
-        return None
+        print(f"Error init MySQL: {e}")
 
-def create_sqlite_connection():
-    """Creates a connection to the SQLite database."""
-    try:
-        conn = sqlite3.connect("merchant.db", check_same_thread=False)
-        return conn
-    except Exception as e:
-        print(f"SQLite Connection Error: {e}")
-        return None
+def _mock_store(merchant):
+    if merchant.merchant_id == merchants.DEFAULT_MERCHANT_ID:
+        return MOCK_STORE
+    return MemoryStore(MOCK_MEMBERS, merchant_id=merchant.merchant_id)
 
-def get_db_connection():
-    """Returns a connection based on the active mode."""
-    if DB_MODE == "MYSQL":
-        return create_connection()
-    elif DB_MODE == "SQLITE":
-        return create_sqlite_connection()
-    return None
+def init_db(mode=None):
+    """Initializes the database and tables of every merchant.
+
+    mode overrides DB_MODE_SETTING. Returns the DB_MODE that was selected.
+    """
+    mode = (mode or DB_MODE_SETTING).upper()
+
+    if mode == "MOCK":
+        for merchant in merchants.MERCHANTS.values():
+            use_backend(MemoryBackend(_mock_store(merchant)), merchant.merchant_id)
+        print("✅ Using in-memory MOCK storage.")
+        return DB_MODE
 
-def init_db():
-    """Initializes the database and tables."""
-    global DB_MODE
-    
     # Attempt 1: Try MySQL
-    try:
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST", "localhost"),
-            user=os.getenv("DB_USER", "root"),
-            password=os.getenv("DB_PASS", "")
-        )
-        cursor = conn.cursor()
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {os.getenv('DB_NAME', 'nutritious_theory')}")
-        conn.close()
-        
-        # Check if we can connect to the DB specifically
-        test_conn = create_connection()
-        if test_conn:
-            DB_MODE = "MYSQL"
-            test_conn.close()
-            print("✅ Using MySQL Database.")
-            _init_mysql_tables()
-            return
-    except:
-        pass
+    if mode in ("AUTO", "MYSQL"):
+        if _mysql_reachable(MYSQL_CONNECT_TIMEOUT):
+            try:
+                for merchant in merchants.MERCHANTS.values():
+                    _init_mysql(merchant)
+                return DB_MODE
+            except Exception as e:
+                if mode == "MYSQL":
+                    raise RuntimeError(f"DB_MODE=MYSQL but MySQL is unavailable: {e}")
+        elif mode == "MYSQL":
+            raise RuntimeError("DB_MODE=MYSQL but MySQL is unreachable.")
+        # Attempt 2: Fallback to SQLite
+        print("⚠️ MySQL not available. Switching to SQLite.")
 
-    # Attempt 2: Fallback to SQLite
-    print("⚠️ MySQL not available. Switching to SQLite.")
-    DB_MODE = "SQLITE"
-    _init_sqlite_tables()
-    
-    # MIGRATION: Check if 'items' column exists in SQLite orders table, if not, add it.
-    if DB_MODE == "SQLITE":
+    for merchant in merchants.MERCHANTS.values():
+        backend = SQLiteBackend(merchant.sqlite_path, merchant_id=merchant.merchant_id)
+        use_backend(backend, merchant.merchant_id)
         try:
-            conn = create_sqlite_connection()
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(orders)")
-            columns = [info[1] for info in cursor.fetchall()]
-            if "items" not in columns:
-                print("🔄 Migrating DB: Adding 'items' column to orders table...")
-                cursor.execute("ALTER TABLE orders ADD COLUMN items TEXT")
-                conn.commit()
-            conn.close()
+            backend.init_schema()
+            print(f"✅ SQLite initialized successfully ({merchant.sqlite_path}).")
         except Exception as e:
-            print(f"Migration Warning: {e}")
-
-def _init_mysql_tables():
-    conn = create_connection()
-    if not conn: return
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS members (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            member_id VARCHAR(20) UNIQUE NOT NULL,
-            pin VARCHAR(10) NOT NULL,
-            name VARCHAR(100),
-            coins INT DEFAULT 0
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            member_id VARCHAR(20),
-            amount INT,
-            type VARCHAR(50),
-            time DATETIME,
-            delivery_date VARCHAR(20),
-            status VARCHAR(20)
-        )
-        """)
-        
-        # Seed Data
-        cursor.execute("SELECT count(*) FROM members")
-        if cursor.fetchone()[0] == 0:
-            demo_members = [
-                ("97011", "1234", "Member 1", 1500),
-                ("77452", "1234", "Member 2", 50),
-            ]
-            cursor.executemany("INSERT INTO members (member_id, pin, name, coins) VALUES (%s, %s, %s, %s)", demo_members)
-            conn.commit()
-        conn.close()
-    except Error as e:
-        print(f"Error init MySQL: {e}")
+            print(f"Error init SQLite: {e}")
+    return DB_MODE
 
-def _init_sqlite_tables():
-    conn = create_sqlite_connection()
-    if not conn: return
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS members (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            member_id TEXT UNIQUE NOT NULL,
-            pin TEXT NOT NULL,
-            name TEXT,
-            coins INTEGER DEFAULT 0
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            member_id TEXT,
-            amount INTEGER,
-            items TEXT,
-            type TEXT,
-            time TIMESTAMP,
-            delivery_date TEXT,
-            status TEXT
-        )
-        """)
-        
-        # Seed Data
-        cursor.execute("SELECT count(*) FROM members")
-        if cursor.fetchone()[0] == 0:
-            demo_members = [
-                ("97011", "1234", "Member 1", 1500),
-                ("77452", "1234", "Member 2", 50),
-            ]
-            cursor.executemany("INSERT INTO members (member_id, pin, name, coins) VALUES (?, ?, ?, ?)", demo_members)
-            conn.commit()
-        conn.close()
-        print("✅ SQLite initialized successfully.")
-    except Exception as e:
-        print(f"Error init SQLite: {e}")
-
-def check_member(member_id, pin):
+def check_member(member_id, pin, merchant_id=None):
     """Verifies member credentials and returns data."""
-    if DB_MODE == "MOCK":
-        member = MOCK_MEMBERS.get(member_id)
-        if member and member["pin"] == pin:
-            return member
-        return None
-
-    conn = get_db_connection()
-    if not conn: return None
-    try:
-        # SQLite returns tuples by default unless row_factory is set
-        if DB_MODE == "SQLITE":
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM members WHERE member_id = ? AND pin = ?", (member_id, pin))
-            row = cursor.fetchone()
-            conn.close()
-            if row:
-                return dict(row)
-            return None
-        else:
-            # MySQL
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM members WHERE member_id = %s AND pin = %s", (member_id, pin))
-            result = cursor.fetchone()
-            conn.close()
-            return result
+    try:
+        return _backend(merchant_id).check_member(member_id, pin)
     except Exception:
         return None
 
-def get_member_balance(member_id):
+def get_member_balance(member_id, merchant_id=None):
     """Gets current coin balance."""
-    if DB_MODE == "MOCK":
-        return MOCK_MEMBERS.get(member_id, {}).get("coins", 0)
-
-    conn = get_db_connection()
-    if not conn: return 0
-    try:
-        cursor = conn.cursor()
-        query = "SELECT coins FROM members WHERE member_id = ?" if DB_MODE == "SQLITE" else "SELECT coins FROM members WHERE member_id = %s"
-        cursor.execute(query, (member_id,))
-        res = cursor.fetchone()
-        conn.close()
-        return res[0] if res else 0
+    try:
+        return _backend(merchant_id).get_balance(member_id)
     except Exception:
         return 0
 
-def update_member_coins(member_id, new_balance):
-    """Updates member coins."""
-    if DB_MODE == "MOCK":
-        if member_id in MOCK_MEMBERS:
-            MOCK_MEMBERS[member_id]["coins"] = new_balance
-        return
+def update_member_coins(member_id, new_balance, merchant_id=None):
+    """Sets member coins, recording the difference as a top-up or adjustment."""
+    try:
+        if _backend(merchant_id).set_coins(member_id, new_balance):
+            _bump(merchant_id, "members")
+    except Exception:
+        pass
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            query = "UPDATE members SET coins = ? WHERE member_id = ?" if DB_MODE == "SQLITE" else "UPDATE members SET coins = %s WHERE member_id = %s"
-            cursor.execute(query, (new_balance, member_id))
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
-
-def save_order(member_id, amount, type_label, delivery_date_str=None, items_summary=None):
-    """Saves a new order."""
-    import datetime
+def _replayed_order(backend, idempotency_key, amount, type_label, items_summary, member_id=None):
+    """The order already placed under idempotency_key, marked replayed, or None.
+
+    Raises ValueError if that order is not the one being asked for again.
+    """
+    try:
+        order = backend.order_by_idempotency_key(idempotency_key)
+    except Exception as e:
+        print(f"Error looking up idempotency key: {e}")
+        return None
+    if not order:
+        return None
+    if (float(order["amount"]) != float(amount) or order["type"] != type_label or order["items"] != items_summary
+            or (member_id is not None and order["member_id"] != member_id)):
+        raise ValueError(f"Idempotency key {idempotency_key!r} was used for a different order")
+    return dict(order, replayed=True)
+
+def save_order(member_id, amount, type_label, delivery_date_str=None, items_summary=None, chat_id=None, merchant_id=None,
+               idempotency_key=None):
+    """Saves a new order. chat_id is the Telegram chat told about status changes.
+
+    With an idempotency_key, a repeat of an earlier call returns that call's
+    order (with replayed=True) and writes nothing. Raises ValueError if the
+    key was used for a different order.
+    """
+    backend = _backend(merchant_id)
+    if idempotency_key:
+        order = _replayed_order(backend, idempotency_key, amount, type_label, items_summary)
+        if order:
+            return order
     now = datetime.datetime.now()
-    
-    if DB_MODE == "MOCK":
-        order = {
-            "id": len(MOCK_ORDERS) + 1,
-            "member_id": member_id,
-            "amount": amount,
-            "items": items_summary,
-            "type": type_label, # 'Immediate' or 'Pre-order'
-            "time": now,
-            "delivery_date_str": delivery_date_str,
-            "status": "Active"
-        }
-        MOCK_ORDERS.append(order)
+    deadline = cancel_deadline_for(type_label, delivery_date_str, now)
+    try:
+        order = backend.insert_order(member_id, amount, type_label, delivery_date_str, items_summary, now, deadline, chat_id,
+                                     idempotency_key)
+        _bump(merchant_id, "orders")
         return order
-        
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            if DB_MODE == "SQLITE":
-                cursor.execute("""
-                    INSERT INTO orders (member_id, amount, items, type, time, delivery_date, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (member_id, amount, items_summary, type_label, now, delivery_date_str, "Active"))
-            else:
-                cursor.execute("""
-                    INSERT INTO orders (member_id, amount, items, type, time, delivery_date, status)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (member_id, amount, items_summary, type_label, now, delivery_date_str, "Active"))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Error saving order: {e}")
+    except Exception as e:
+        # Lost a race with a concurrent repeat: the unique index kept its order
+        if idempotency_key:
+            order = _replayed_order(backend, idempotency_key, amount, type_label, items_summary)
+            if order:
+                return order
+        print(f"Error saving order: {e}")
     return None
 
-def get_last_active_order(member_id):
-    """Gets the last active order for a member."""
-    if DB_MODE == "MOCK":
-        for order in reversed(MOCK_ORDERS):
-            if order["member_id"] == member_id and order["status"] == "Active":
+def place_member_order(member_id, amount, type_label, delivery_date_str=None, items_summary=None, chat_id=None,
+                       merchant_id=None, idempotency_key=None):
+    """Debits the member and saves the order in one transaction.
+
+    Returns the saved order, or None if the balance does not cover the amount.
+    idempotency_key works as in save_order: a repeat is not debited again.
+    """
+    backend = _backend(merchant_id)
+    if idempotency_key:
+        order = _replayed_order(backend, idempotency_key, amount, type_label, items_summary, member_id)
+        if order:
+            return order
+    now = datetime.datetime.now()
+    deadline = cancel_deadline_for(type_label, delivery_date_str, now)
+    try:
+        order = backend.place_member_order(member_id, amount, type_label, delivery_date_str, items_summary, now, deadline,
+                                           chat_id, idempotency_key)
+        if order:
+            _bump(merchant_id, "orders", "members")
+        return order
+    except Exception as e:
+        # The losing transaction was rolled back, debit included
+        if idempotency_key:
+            order = _replayed_order(backend, idempotency_key, amount, type_label, items_summary, member_id)
+            if order:
                 return order
+        print(f"Error placing order: {e}")
         return None
 
-    conn = get_db_connection()
-    if not conn: return None
-    try:
-        # Dictionary cursor/row factory
-        if DB_MODE == "SQLITE":
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM orders WHERE member_id = ? AND status = 'Active' ORDER BY id DESC LIMIT 1", (member_id,))
-            row = cursor.fetchone()
-            conn.close()
-            if row:
-                # Convert SQLite row to dict and parse time
-                d = dict(row)
-                 # Ensure time is datetime object
-                if isinstance(d['time'], str):
-                    import dateutil.parser
-                    try: 
-                        from datetime import datetime
-                        # SQLite stores as YYYY-MM-DD HH:MM:SS.ssssss
-                        d['time'] = datetime.strptime(d['time'].split('.')[0], "%Y-%m-%d %H:%M:%S")
-                    except: pass
-                return d
-            return None
-        else:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM orders WHERE member_id = %s AND status = 'Active' ORDER BY id DESC LIMIT 1", (member_id,))
-            return cursor.fetchone()
+def get_order(order_id, merchant_id=None):
+    """One order by id from the primary, or None."""
+    try:
+        return _backend(merchant_id).get_order(order_id)
     except Exception as e:
         print(e)
         return None
 
-def cancel_order_refund(order_id, member_id, refund_amount):
-    """Cancels order and refunds coins."""
-    if DB_MODE == "MOCK":
-        for order in MOCK_ORDERS:
-            if order["id"] == order_id:
-                order["status"] = "Cancelled"
-                break
-        current = MOCK_MEMBERS[member_id]["coins"]
-        MOCK_MEMBERS[member_id]["coins"] = current + refund_amount
-        return True
+def get_last_active_order(member_id, merchant_id=None):
+    """Gets the last active order for a member."""
+    try:
+        # time is already a datetime in every mode (see backends._decode_timestamp)
+        return _backend(merchant_id).last_active_order(member_id)
+    except Exception as e:
+        print(e)
+        return None
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            # Update order
-            q1 = "UPDATE orders SET status = 'Cancelled' WHERE id = ?" if DB_MODE == "SQLITE" else "UPDATE orders SET status = 'Cancelled' WHERE id = %s"
-            cursor.execute(q1, (order_id,))
-            
-            # Update coins
-            # We need to fetch current again or just do an increment
-            q2 = "UPDATE members SET coins = coins + ? WHERE member_id = ?" if DB_MODE == "SQLITE" else "UPDATE members SET coins = coins + %s WHERE member_id = %s"
-            cursor.execute(q2, (refund_amount, member_id))
-            
-            conn.commit()
-            conn.close()
-            return True
-        except Exception:
+def cancel_order_refund(order_id, member_id, refund_amount, merchant_id=None):
+    """Cancels an active order and refunds coins.
+
+    Fails (False) once the order's cancel_deadline has passed, so a late
+    cancel is rejected by the same indexed check whichever path it comes from.
+    """
+    now = datetime.datetime.now()
+    try:
+        if not _backend(merchant_id).cancel_refund(order_id, member_id, refund_amount, now):
             return False
-    return False
-
-def update_order_status(order_id, new_status):
-    """Updates the status of an order."""
-    if DB_MODE == "MOCK":
-        for order in MOCK_ORDERS:
-            if order["id"] == int(order_id):
-                order["status"] = new_status
-                return True
+        _bump(merchant_id, "orders", "members")
+        return True
+    except Exception:
         return False
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            query = "UPDATE orders SET status = ? WHERE id = ?" if DB_MODE == "SQLITE" else "UPDATE orders SET status = %s WHERE id = %s"
-            cursor.execute(query, (new_status, order_id))
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"Error updating status: {e}")
-            return False
-    return False
-
-def get_all_orders():
-    """Fetches all orders for the dashboard."""
-    if DB_MODE == "MOCK":
-        return MOCK_ORDERS
-
-    conn = get_db_connection()
-    if not conn: return []
-    try:
-        if DB_MODE == "SQLITE":
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM orders ORDER BY id DESC")
-            rows = cursor.fetchall()
-            conn.close()
-            return [dict(row) for row in rows]
-        else:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM orders ORDER BY id DESC")
-            res = cursor.fetchall()
-            conn.close()
-            return res
+def transition_orders(order_ids, new_status, merchant_id=None):
+    """Moves orders to new_status in one transaction, as ORDER_TRANSITIONS allows.
+
+    Orders whose current status cannot move to new_status are left as they are.
+    Returns the orders that changed, with their new status. Raises ValueError
+    for an unknown status or more than MAX_BULK_ORDERS ids.
+    """
+    if new_status not in ORDER_TRANSITIONS:
+        raise ValueError(f"Unknown order status '{new_status}'")
+    if len(order_ids) > MAX_BULK_ORDERS:
+        raise ValueError(f"At most {MAX_BULK_ORDERS} orders per request")
+    from_statuses = [status for status, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+    try:
+        refund = new_status == "Cancelled"
+        changed = _backend(merchant_id).transition_orders(order_ids, new_status, from_statuses, refund)
+        if changed:
+            _bump(merchant_id, *(("orders", "members") if refund else ("orders",)))
+        return changed
+    except Exception as e:
+        print(f"Error updating status: {e}")
+        return []
+
+def update_order_status(order_id, new_status, merchant_id=None):
+    """Updates the status of an order; False if the move is not allowed."""
+    try:
+        return bool(transition_orders([order_id], new_status, merchant_id))
+    except ValueError as e:
+        print(f"Error updating status: {e}")
+        return False
+
+def lock_preorders(delivery_date_str, merchant_id=None):
+    """Moves Active pre-orders for a delivery date to 'Preparing'.
+
+    Returns every pre-order now Preparing for that date, i.e. the day's prep set.
+    """
+    try:
+        locked = _backend(merchant_id).lock_preorders(delivery_date_str)
+        if locked:
+            _bump(merchant_id, "orders")
+        return locked
+    except Exception as e:
+        print(f"Error locking pre-orders: {e}")
+        return []
+
+def get_preparing_preorders(delivery_date_str, merchant_id=None):
+    """Pre-orders for a delivery date already locked (Preparing) at the cutoff."""
+    try:
+        return _backend(merchant_id).preparing_preorders(delivery_date_str)
+    except Exception as e:
+        print(f"Error fetching pre-orders: {e}")
+        return []
+
+def expire_stale_orders(max_age_hours, merchant_id=None):
+    """Marks same-day orders still Active after max_age_hours as 'Expired'."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)
+    try:
+        expired = _backend(merchant_id).expire_stale(cutoff)
+        if expired:
+            _bump(merchant_id, "orders")
+        return expired
+    except Exception as e:
+        print(f"Error expiring orders: {e}")
+        return 0
+
+def get_orders_past_cancel_deadline(since, until=None, merchant_id=None):
+    """Active orders whose cancel window closed in (since, until], oldest first.
+
+    These can no longer be cancelled by the customer, so the kitchen can
+    start on them. until defaults to now.
+    """
+    until = until or datetime.datetime.now()
+    try:
+        return _backend(merchant_id).closed_cancel_windows(since, until)
+    except Exception as e:
+        print(f"Error fetching closed cancel windows: {e}")
+        return []
+
+def archive_cutoff():
+    """Orders placed before this moment may live in orders_archive."""
+    return datetime.datetime.now() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+
+def get_all_orders(start=None, end=None, fresh=False, merchant_id=None):
+    """Fetches orders for the dashboard, newest first.
+
+    Without a range only the live table is read. When start reaches back
+    past the archive cutoff, archived orders are included as well.
+    fresh=True reads from the primary even if a replica is configured.
+    """
+    include_archive = start is not None and start < archive_cutoff()
+    try:
+        return _backend(merchant_id).orders_in_range(start, end, include_archive, fresh)
     except Exception:
         return []
 
-def get_all_members():
+def get_all_orders_rows(start=None, end=None, merchant_id=None):
+    """Like get_all_orders, but returns plain tuples in ORDER_COLUMNS order
+    with time already as an ISO 8601 string, ready for JSON encoding."""
+    include_archive = start is not None and start < archive_cutoff()
+    try:
+        return _backend(merchant_id).order_rows(start, end, include_archive)
+    except Exception:
+        return []
+
+def archive_orders(max_age_days=None, batch_size=None, merchant_id=None):
+    """Moves old Completed/Cancelled orders into orders_archive.
+
+    Works in batches, committing after each one, so the live table is never
+    locked for long. Returns the number of orders archived.
+    """
+    max_age_days = ARCHIVE_AFTER_DAYS if max_age_days is None else max_age_days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=max_age_days)
+    try:
+        archived = _backend(merchant_id).archive_orders(ARCHIVE_STATUSES, cutoff, now, batch_size)
+        if archived:
+            _bump(merchant_id, "orders")
+        return archived
+    except Exception as e:
+        print(f"Error archiving orders: {e}")
+        # Earlier batches may already be committed
+        _bump(merchant_id, "orders")
+        return 0
+
+def get_pending_notifications(limit, merchant_id=None):
+    """Oldest unsent customer notifications (order_id, chat_id, status, items), up to limit.
+
+    Rows are queued in notification_outbox by the same transaction that
+    changes an order's status, so none are lost if the process stops
+    before they are sent.
+    """
+    try:
+        return _backend(merchant_id).pending_notifications(NOTIFY_MAX_ATTEMPTS, limit)
+    except Exception as e:
+        print(f"Error reading notification outbox: {e}")
+        return []
+
+def finish_notifications(sent_ids, failed_ids, merchant_id=None):
+    """Marks notifications sent, and counts a failed attempt for the others."""
+    try:
+        _backend(merchant_id).finish_notifications(sent_ids, failed_ids, datetime.datetime.now())
+    except Exception as e:
+        print(f"Error updating notification outbox: {e}")
+
+def prune_notifications(max_age_days=None, merchant_id=None):
+    """Deletes sent or abandoned notifications older than max_age_days."""
+    max_age_days = ARCHIVE_AFTER_DAYS if max_age_days is None else max_age_days
+    before = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
+    try:
+        return _backend(merchant_id).prune_notifications(before, NOTIFY_MAX_ATTEMPTS)
+    except Exception as e:
+        print(f"Error pruning notification outbox: {e}")
+        return 0
+
+def load_stock(day, merchant_id=None):
+    """{item: (daily_limit, sold)} recorded for a date, or None on error."""
+    try:
+        return _backend(merchant_id).load_stock(day.isoformat())
+    except Exception as e:
+        print(f"Error loading stock: {e}")
+        return None
+
+def add_stock_sold(day, deltas, merchant_id=None):
+    """Adds {item: qty} (negative to put back) to a date's sold counts; False on error."""
+    try:
+        _backend(merchant_id).add_stock_sold(day.isoformat(), deltas)
+        return True
+    except Exception as e:
+        print(f"Error saving stock: {e}")
+        return False
+
+def set_stock_limits(day, limits, merchant_id=None):
+    """Sets {item: daily_limit} for a date; None means the merchant's default."""
+    try:
+        _backend(merchant_id).set_stock_limits(day.isoformat(), limits)
+        return True
+    except Exception as e:
+        print(f"Error saving stock limits: {e}")
+        return False
+
+def record_login_failure(chat_key, member_key, merchant_id=None):
+    """Logs a failed PIN check for the shared login throttle (see throttle.py)."""
+    try:
+        _backend(merchant_id).record_login_failure(str(chat_key), str(member_key), datetime.datetime.now())
+        return True
+    except Exception as e:
+        print(f"Error recording login failure: {e}")
+        return False
+
+def get_login_failures(chat_key, member_key, since, merchant_id=None):
+    """{"chat": n, "member": n} failed PIN checks since `since`, or None on error."""
+    try:
+        return _backend(merchant_id).login_failures(str(chat_key), str(member_key), since)
+    except Exception as e:
+        print(f"Error reading login failures: {e}")
+        return None
+
+def prune_login_failures(before, merchant_id=None):
+    """Deletes logged login failures older than before."""
+    try:
+        return _backend(merchant_id).prune_login_failures(before)
+    except Exception as e:
+        print(f"Error pruning login failures: {e}")
+        return 0
+
+def get_all_members(merchant_id=None):
     """Fetches all members for the dashboard."""
-    if DB_MODE == "MOCK":
-        return list(MOCK_MEMBERS.values())
-
-    conn = get_db_connection()
-    if not conn: return []
-    try:
-        if DB_MODE == "SQLITE":
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM members")
-            rows = cursor.fetchall()
-            conn.close()
-            return [dict(row) for row in rows]
-        else:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM members")
-            res = cursor.fetchall()
-            conn.close()
-            return res
+    try:
+        return _backend(merchant_id).list_members()
+    except Exception:
+        return []
+
+def get_all_members_rows(merchant_id=None):
+    """Like get_all_members, but returns plain tuples in MEMBER_COLUMNS order."""
+    try:
+        return _backend(merchant_id).member_rows()
+    except Exception:
+        return []
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if key == ["name"]:
+        return "name", None
+    if isinstance(key, list) and len(key) == 2 and key[0] == "member_id" and isinstance(key[1], str):
+        return "member_id", key[1]
+    if isinstance(key, list) and len(key) == 3 and key[0] == "name" and all(isinstance(k, str) for k in key[1:]):
+        return "name", (key[1], key[2])
+    raise ValueError("Invalid cursor")
+
+def search_members(query, limit=20, cursor=None, fields=None, merchant_id=None):
+    """Members whose member_id or name starts with query, without PINs.
+
+    Members matched by member_id come first (by member_id), then those matched
+    only by name (by name, ignoring case). Each page is read along an index.
+    Pass the returned next_cursor for the following page; it is None on the
+    last one. fields picks columns from MEMBER_PUBLIC_COLUMNS (all if None).
+    Raises ValueError for a bad cursor or field; returns None if the lookup fails.
+    """
+    fields = tuple(fields or MEMBER_PUBLIC_COLUMNS)
+    unknown = [f for f in fields if f not in MEMBER_PUBLIC_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown member fields: {', '.join(unknown)}")
+    limit = max(1, min(limit, MAX_SEARCH_PAGE))
+    field, after = _decode_cursor(cursor) if cursor else ("member_id", None)
+    backend = _backend(merchant_id)
+    members = []
+    next_key = None
+    try:
+        # One extra row tells whether another page follows
+        if field == "member_id":
+            members = backend.search_members("member_id", query, after, limit + 1)
+            if len(members) > limit:
+                members = members[:limit]
+                next_key = ["member_id", members[-1]["member_id"]]
+            field, after = "name", None
+        if next_key is None:
+            wanted = limit - len(members)
+            by_name = backend.search_members("name", query, after, wanted + 1)
+            members += by_name[:wanted]
+            if len(by_name) > wanted:
+                next_key = ["name", members[-1]["name"], members[-1]["member_id"]] if wanted else ["name"]
+    except Exception as e:
+        print(f"Error searching members: {e}")
+        return None
+    return {
+        "members": [{f: m.get(f) for f in fields} for m in members],
+        "next_cursor": _encode_cursor(next_key) if next_key else None,
+    }
+
+def get_coin_transactions(member_id, limit=50, merchant_id=None):
+    """Returns the most recent ledger entries for a member, newest first."""
+    try:
+        return _backend(merchant_id).member_transactions(member_id, limit)
     except Exception:
         return []
+
+def get_member_orders(member_id, before=None, limit=20, merchant_id=None):
+    """One page of a member's order history, newest first.
+
+    Pass the returned next_before to get the following page; it is None on
+    the last page. Each page costs the same however long the history is.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE))
+    try:
+        # One extra row tells whether another page follows
+        orders = _backend(merchant_id).member_orders(member_id, before, limit + 1)
+    except Exception as e:
+        print(f"Error fetching order history: {e}")
+        orders = []
+    next_before = orders[limit - 1]["id"] if len(orders) > limit else None
+    return {"orders": orders[:limit], "next_before": next_before}
+
+def get_ledger_balance(member_id, merchant_id=None):
+    """Balance derived from the ledger: latest snapshot plus the delta since it."""
+    try:
+        return _backend(merchant_id).ledger_balance(member_id)
+    except Exception:
+        return 0
+
+def save_mock_store():
+    """Writes MOCK_STORE to MOCK_SNAPSHOT_PATH; False if not in MOCK mode or no path is set."""
+    if DB_MODE != "MOCK":
+        return False
+    try:
+        return MOCK_STORE.save()
+    except Exception as e:
+        print(f"Error saving MOCK snapshot: {e}")
+        return False
+
+def snapshot_balances(merchant_id=None):
+    """Rolls every member's snapshot forward over the ledger rows added since.
+
+    Returns the number of snapshots advanced.
+    """
+    try:
+        return _backend(merchant_id).snapshot_balances(datetime.datetime.now())
+    except Exception as e:
+        print(f"Error taking balance snapshots: {e}")
+        return 0
+
+def reconcile_balances(merchant_id=None):
+    """Compares stored coins with the ledger; returns members that drifted."""
+    try:
+        return _backend(merchant_id).reconcile()
+    except Exception as e:
+        print(f"Error reconciling balances: {e}")
+        return []
@@ -1,18 +1,29 @@
 
+import asyncio
 import logging
 import os
 import contextlib
-from fastapi import FastAPI, HTTPException
+import functools
+import time
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, List, Optional
 import datetime
 import uvicorn
 from dotenv import load_dotenv
 
 # Import Project Modules
 import database
-import bot
+from admission import ADMISSION, Overloaded
+import merchants
+import profiling
+import scheduler
+import stock
+import traffic
+from serialization import FastJSONResponse, rows_to_records
+from throttle import LOGIN_THROTTLE
 
 # Configure Logging
 logging.basicConfig(
@@ -23,38 +34,125 @@ logger = logging.getLogger(__name__)
 # Load Env
 load_dotenv()
 
-# Lifecycle Manager for Bot + API
-@contextlib.asynccontextmanager
-async def lifespan(app: FastAPI):
-    # --- Startup ---
-    logger.info("Initializing Database...")
-    database.init_db()
-    
-    logger.info("Starting Telegram Bot...")
-    bot_app = bot.get_application()
-    
-    if bot_app:
+# What this process runs:
+#   combined - dashboard API, Telegram bots and background jobs (default)
+#   api      - the dashboard API only; may run with several uvicorn workers
+#   bot      - the Telegram bots and background jobs only; run exactly one
+# Split roles share state only through the database, so they need SQLite or MySQL.
+ROLES = ("combined", "api", "bot")
+APP_ROLE = None
+
+def set_role(role):
+    global APP_ROLE
+    role = role.lower()
+    if role not in ROLES:
+        raise ValueError(f"APP_ROLE must be one of {', '.join(ROLES)}, not '{role}'")
+    APP_ROLE = role
+    # Writes made by another process must still change this one's ETags
+    database.VERSIONS_IN_DB = role != "combined"
+
+set_role(os.getenv("APP_ROLE", "combined"))
+
+# Cutoff, expiry, archival and ledger jobs (see scheduler.py)
+job_scheduler = scheduler.build_scheduler()
+
+# Running bot applications by merchant_id, filled in by lifespan
+BOT_APPS = {}
+
+async def start_bot(bot_app):
+    """Connects the bot to Telegram; runs as a task so the API is not held up by it."""
+    started = time.perf_counter()
+    try:
         await bot_app.initialize()
         await bot_app.start()
         
         # Start Polling (Non-blocking mode via updater)
         # allowed_updates=None (all), drop_pending_updates=False
         await bot_app.updater.start_polling(drop_pending_updates=True)
-        
-        logger.info("Telegram Bot Started via Polling.")
-        
-        # yield control back to FastAPI
-        yield
-        
-        # --- Shutdown ---
-        logger.info("Stopping Telegram Bot...")
+    except Exception as e:
+        logger.error(f"Telegram Bot Failed to Start: {e}")
+        return
+    
+    logger.info(f"Telegram Bot Started via Polling ({(time.perf_counter() - started) * 1000:.0f} ms).")
+
+async def stop_bot(bot_app, bot_task):
+    if not bot_task.done():
+        bot_task.cancel()
+        await asyncio.gather(bot_task, return_exceptions=True)
+    logger.info("Stopping Telegram Bot...")
+    if bot_app.updater.running:
         await bot_app.updater.stop()
+    if bot_app.running:
         await bot_app.stop()
-        await bot_app.shutdown()
-        logger.info("Telegram Bot Stopped.")
-    else:
-        logger.warning("Telegram Bot Failed to Initialize (Check Token).")
+    await bot_app.shutdown()
+    logger.info("Telegram Bot Stopped.")
+
+# Lifecycle Manager for Bot + API
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- Startup ---
+    timings = {}
+    phase_start = time.perf_counter()
+    def phase_done(name):
+        nonlocal phase_start
+        now = time.perf_counter()
+        timings[name] = (now - phase_start) * 1000
+        phase_start = now
+
+    logger.info("Initializing Database...")
+    database.init_db()
+    if APP_ROLE != "combined" and database.DB_MODE == "MOCK":
+        raise RuntimeError(f"APP_ROLE={APP_ROLE} needs SQLite or MySQL: MOCK storage cannot be shared between processes.")
+    phase_done("database")
+
+    # The bots and jobs run in exactly one process; API workers only serve requests
+    bots = []
+    if APP_ROLE != "api":
+        logger.info("Starting Telegram Bot...")
+        # Imported here: python-telegram-bot is the slowest import in the process
+        import bot
+        phase_done("bot_import")
+        # Carts reserve against these, so they are loaded before any chat starts
+        stock.start(merchants.MERCHANTS)
+        phase_done("stock")
+        # One Application per merchant token
+        for merchant in merchants.MERCHANTS.values():
+            bot_app = bot.get_application(merchant)
+            if bot_app:
+                BOT_APPS[merchant.merchant_id] = bot_app
+                bots.append((bot_app, asyncio.create_task(start_bot(bot_app))))
+            else:
+                logger.warning(f"Telegram Bot for {merchant.merchant_id} Failed to Initialize (Check Token).")
+        phase_done("bot_build")
+
+        logger.info("Starting Background Jobs...")
+        # Customer notifications are sent by whichever process owns the bots
+        job_scheduler.add_interval("notify_customers", functools.partial(bot.drain_outbox, BOT_APPS),
+                                   bot.NOTIFY_INTERVAL_SECONDS)
+        job_scheduler.start()
+        phase_done("scheduler")
+
+    breakdown = ", ".join(f"{name}={ms:.0f}ms" for name, ms in timings.items())
+    logger.info(f"Startup ({APP_ROLE}, {database.DB_MODE}) took {sum(timings.values()):.0f} ms: {breakdown}")
+
+    # yield control back to FastAPI
+    try:
         yield
+    finally:
+        # --- Shutdown ---
+        for bot_app, bot_task in bots:
+            await stop_bot(bot_app, bot_task)
+        BOT_APPS.clear()
+        await job_scheduler.stop()
+        # Sales counted since the last stock_flush
+        stock.flush_job()
+        database.save_mock_store()
+        traffic.close_recorders()
+
+async def run_bot_only():
+    """APP_ROLE=bot: the Telegram bots and background jobs, without the HTTP server."""
+    async with lifespan(app):
+        await asyncio.Event().wait()
 
 # Initialize FastAPI with Lifespan
 app = FastAPI(title="Merchant Bot API", lifespan=lifespan)
@@ -68,6 +166,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """X-Profile: 1 (with X-Admin-Token) samples the process while this request runs.
+
+    The profile is kept for GET /debug/profiles/{id}; the response names it in
+    X-Profile-Id. Other requests running at the same time show up in it too.
+    """
+    if request.headers.get("x-profile") != "1" or not profiling.admin_allowed(request.headers.get("x-admin-token")):
+        return await call_next(request)
+    sampler = profiling.Sampler().start()
+    try:
+        response = await call_next(request)
+    finally:
+        sampler.stop()
+    response.headers["X-Profile-Id"] = str(profiling.keep_profile(request.method, request.url.path, sampler))
+    return response
+
+@app.exception_handler(Overloaded)
+def overloaded_handler(request: Request, exc: Overloaded):
+    """Shed requests get a 503 instead of queueing behind a slow database."""
+    return JSONResponse(status_code=503, content={"detail": "Server busy, please retry"},
+                        headers={"Retry-After": str(exc.retry_after)})
+
 # -----------------------------------------------------------------------------
 # API MODELS & ENDPOINTS (Copied/Adapted from api.py)
 # -----------------------------------------------------------------------------
@@ -78,54 +199,339 @@ class OrderRequest(BaseModel):
     items: str
     type: str # 'Immediate' or 'Pre-order' or 'Takeaway'
     delivery_date: Optional[str] = None
+    merchant_id: Optional[str] = None
+
+class StockUpdate(BaseModel):
+    limits: Dict[str, Optional[int]] # item -> today's limit; null restores the merchant default
+    merchant_id: Optional[str] = None
+
+class StatusUpdate(BaseModel):
+    order_ids: List[int]
+    status: str # 'Ready', 'Completed', 'Cancelled', ... (see database.ORDER_TRANSITIONS)
+    merchant_id: Optional[str] = None
+
+# Identifies this process so ETags from a previous run never match. Versions
+# kept in the database survive restarts and are shared by every worker, so
+# split roles leave it out.
+BOOT_ID = os.urandom(4).hex()
+
+def _merchant_id(merchant_id):
+    """Validates a merchant_id query parameter; None means the default merchant."""
+    try:
+        return merchants.get_merchant(merchant_id).merchant_id
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown merchant")
+
+def _etag(table, merchant_id):
+    boot_id = "db" if database.VERSIONS_IN_DB else BOOT_ID
+    return f'W/"{table}-{merchant_id}-{boot_id}-{database.get_version(table, merchant_id)}"'
+
+def _conditional_json(request: Request, table, merchant_id, load):
+    """304 if the client already holds this table version, else load() as fast JSON."""
+    with ADMISSION.admit("read"):
+        # Read the version before the rows so a concurrent write is never masked
+        etag = _etag(table, merchant_id)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return FastJSONResponse(load(), headers=headers)
 
 @app.get("/")
 def read_root():
     return {"status": "ok", "service": "Merchant Bot API & Dashboard Backend"}
 
+@app.get("/merchants")
+def get_merchants():
+    """Lists the outlets served by this deployment; the first is the default."""
+    return [merchant.info() for merchant in merchants.MERCHANTS.values()]
+
 @app.get("/orders")
-def get_orders():
-    """Returns all orders."""
-    orders = database.get_all_orders()
-    for o in orders:
-        if isinstance(o.get('time'), datetime.datetime):
-            o['time'] = o['time'].isoformat()
-    return orders
+def get_orders(request: Request, start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+               merchant_id: Optional[str] = None):
+    """Returns live orders, or all orders (archive included) placed in [start, end)."""
+    merchant_id = _merchant_id(merchant_id)
+    return _conditional_json(request, "orders", merchant_id, lambda: rows_to_records(
+        database.ORDER_COLUMNS, database.get_all_orders_rows(start, end, merchant_id=merchant_id)
+    ))
+
+@app.get("/orders/cancel-window-closed")
+def get_cancel_window_closed(since: datetime.datetime, until: Optional[datetime.datetime] = None,
+                             merchant_id: Optional[str] = None):
+    """Active orders whose cancellation window closed in (since, until]; safe to start preparing."""
+    merchant_id = _merchant_id(merchant_id)
+    with ADMISSION.admit("read"):
+        return database.get_orders_past_cancel_deadline(since, until, merchant_id=merchant_id)
 
 @app.get("/members")
-def get_members():
-    """Returns all members."""
-    return database.get_all_members()
+def get_members(request: Request, merchant_id: Optional[str] = None):
+    """Returns all members, without their PINs."""
+    merchant_id = _merchant_id(merchant_id)
+    return _conditional_json(request, "members", merchant_id, lambda: rows_to_records(
+        database.MEMBER_COLUMNS, database.get_all_members_rows(merchant_id=merchant_id)
+    ))
+
+@app.get("/members/search")
+def search_members(q: str, limit: int = 20, cursor: Optional[str] = None, fields: Optional[str] = None,
+                   merchant_id: Optional[str] = None):
+    """Staff lookup: members whose ID or name starts with q, one page at a time.
+
+    fields is a comma-separated subset of database.MEMBER_PUBLIC_COLUMNS;
+    PINs are never returned. Pass next_cursor back as cursor for more.
+    """
+    merchant_id = _merchant_id(merchant_id)
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="q must not be empty")
+    try:
+        with ADMISSION.admit("read"):
+            page = database.search_members(q, limit, cursor, fields.split(",") if fields else None,
+                                           merchant_id=merchant_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=500, detail="Member search failed")
+    return FastJSONResponse(page)
+
+@app.get("/members/{member_id}/transactions")
+def get_member_transactions(member_id: str, limit: int = 50, merchant_id: Optional[str] = None):
+    """Returns the coin ledger (audit trail) for a member."""
+    merchant_id = _merchant_id(merchant_id)
+    with ADMISSION.admit("read"):
+        return database.get_coin_transactions(member_id, limit, merchant_id=merchant_id)
+
+@app.get("/members/{member_id}/orders")
+def get_member_orders(member_id: str, before: Optional[int] = None, limit: int = 20, merchant_id: Optional[str] = None):
+    """One page of a member's order history, newest first; pass next_before as before for the next page."""
+    merchant_id = _merchant_id(merchant_id)
+    with ADMISSION.admit("read"):
+        return database.get_member_orders(member_id, before, limit, merchant_id=merchant_id)
+
+@app.get("/ledger/reconcile")
+def reconcile_ledger(merchant_id: Optional[str] = None):
+    """Lists members whose stored coins disagree with the ledger."""
+    merchant_id = _merchant_id(merchant_id)
+    with ADMISSION.admit("read"):
+        drifted = database.reconcile_balances(merchant_id=merchant_id)
+    return {"status": "ok" if not drifted else "drift", "drifted": drifted}
+
+@app.post("/archive-orders")
+def archive_orders(request: Request, max_age_days: Optional[int] = None, merchant_id: Optional[str] = None):
+    """Moves old Completed/Cancelled orders out of the live table. Admin only."""
+    _require_admin(request)
+    return {"status": "ok", "archived": database.archive_orders(max_age_days, merchant_id=_merchant_id(merchant_id))}
+
+@app.get("/prep-list")
+def get_prep_list(merchant_id: Optional[str] = None):
+    """Returns the prep list precomputed at the delivery cutoff."""
+    return scheduler.get_prep_list(_merchant_id(merchant_id))
+
+@app.get("/jobs")
+def get_jobs():
+    """Returns run-time metrics for the background jobs."""
+    return job_scheduler.metrics()
+
+def _require_admin(request: Request):
+    if not profiling.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if not profiling.admin_allowed(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+# One whole-process profile at a time
+PROFILE_RUNNING = asyncio.Lock()
+
+@app.get("/debug/profile")
+async def profile_process(request: Request, seconds: float = 10, idle: bool = False):
+    """Samples every thread of this process for `seconds`, covering API routes
+    and bot handlers; returns collapsed stacks for a flamegraph viewer."""
+    _require_admin(request)
+    if not 0 < seconds <= profiling.MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {profiling.MAX_PROFILE_SECONDS}]")
+    if PROFILE_RUNNING.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    async with PROFILE_RUNNING:
+        sampler = profiling.Sampler(include_idle=idle).start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+    return PlainTextResponse(sampler.collapsed(), headers={"X-Profile-Samples": str(sampler.samples)})
+
+@app.get("/debug/profiles")
+def list_profiles(request: Request):
+    """Recent per-request profiles (see profile_request), newest last."""
+    _require_admin(request)
+    return [
+        {"id": profile_id, **{k: v for k, v in profile.items() if k != "collapsed"}}
+        for profile_id, profile in list(profiling.PROFILES.items())
+    ]
+
+@app.get("/debug/profiles/{profile_id}")
+def get_profile(request: Request, profile_id: int):
+    _require_admin(request)
+    profile = profiling.PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired profile")
+    return PlainTextResponse(profile["collapsed"])
+
+@app.get("/admission")
+def get_admission():
+    """Concurrency limits and accepted/shed counters per route (see admission.py)."""
+    return ADMISSION.stats()
+
+@app.get("/stock")
+def get_stock(merchant_id: Optional[str] = None):
+    """Today's limit, sold, reserved and available count per item."""
+    merchant_id = _merchant_id(merchant_id)
+    counter = stock.get_counter(merchant_id)
+    if counter:
+        return counter.stats()
+    # API-only process: no carts here, so nothing is reserved
+    rows = database.load_stock(datetime.date.today(), merchant_id=merchant_id)
+    if rows is None:
+        raise HTTPException(status_code=500, detail="Failed to load stock")
+    limits = dict(merchants.get_merchant(merchant_id).stock)
+    sold = {}
+    for item, (limit, sold_qty) in rows.items():
+        sold[item] = sold_qty
+        if limit is not None:
+            limits[item] = limit
+    return [
+        {
+            "item": item,
+            "limit": limits.get(item),
+            "sold": sold.get(item, 0),
+            "reserved": None,
+            "available": None if limits.get(item) is None else max(0, limits[item] - sold.get(item, 0)),
+        }
+        for item in sorted(set(limits) | set(sold))
+    ]
+
+@app.put("/stock")
+def set_stock(update: StockUpdate):
+    """Sets today's limits; the bot process picks them up at its next stock flush."""
+    merchant_id = _merchant_id(update.merchant_id)
+    if any(limit is not None and limit < 0 for limit in update.limits.values()):
+        raise HTTPException(status_code=400, detail="Limits cannot be negative")
+    if not database.set_stock_limits(datetime.date.today(), update.limits, merchant_id=merchant_id):
+        raise HTTPException(status_code=500, detail="Failed to set stock limits")
+    counter = stock.get_counter(merchant_id)
+    if counter:
+        counter.set_limits(update.limits)
+    return get_stock(merchant_id)
+
+@app.get("/bot/sessions")
+def get_bot_sessions():
+    """Live chat sessions per merchant bot (idle ones are evicted)."""
+    import bot
+    return {merchant_id: bot.session_stats(bot_app) for merchant_id, bot_app in BOT_APPS.items()}
+
+@app.get("/bot/login-throttle")
+def get_login_throttle():
+    """Allowed, failed and blocked PIN attempts (see throttle.py)."""
+    return LOGIN_THROTTLE.stats()
+
+@app.post("/jobs/{name}/run")
+async def run_job(request: Request, name: str):
+    """Runs a background job immediately. Admin only."""
+    _require_admin(request)
+    if name not in job_scheduler.jobs:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return await job_scheduler.run_now(name)
 
 @app.post("/place-order")
-def place_order(order: OrderRequest):
-    """Allows staff/admin to place an order manually."""
-    
-    # Check Member Balance
-    if order.member_id and order.member_id.lower() != "non-member":
-        balance = database.get_member_balance(order.member_id)
-        if balance < order.amount:
-            raise HTTPException(status_code=400, detail="Insufficient member balance")
-            
-        new_bal = balance - order.amount
-        database.update_member_coins(order.member_id, new_bal)
-        saved_order = database.save_order(order.member_id, order.amount, order.type, order.delivery_date, order.items)
-    else:
-        # Guest
-        import random
-        guest_id = random.randint(1000, 9999)
-        db_id = f"Guest-{guest_id}"
-        saved_order = database.save_order(db_id, order.amount, order.type, order.delivery_date, order.items)
+def place_order(order: OrderRequest, request: Request, response: Response):
+    """Allows staff/admin to place an order manually.
+
+    An Idempotency-Key header makes retries safe: a repeat with the same key
+    returns the order already placed (with an Idempotent-Replayed: true
+    header) and debits nothing; the same key with a different order is a 409.
+    """
+    merchant_id = _merchant_id(order.merchant_id)
+    idempotency_key = request.headers.get("idempotency-key") or None
+    if idempotency_key and len(idempotency_key) > database.MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400,
+                            detail=f"Idempotency-Key is longer than {database.MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+
+    try:
+        with ADMISSION.admit("checkout"):
+            # Check Member Balance
+            if order.member_id and order.member_id.lower() != "non-member":
+                # Debit and order are written together so the ledger links them
+                saved_order = database.place_member_order(order.member_id, order.amount, order.type, order.delivery_date,
+                                                          order.items, merchant_id=merchant_id,
+                                                          idempotency_key=idempotency_key)
+                if not saved_order:
+                    raise HTTPException(status_code=400, detail="Insufficient member balance")
+            else:
+                # Guest
+                import random
+                guest_id = random.randint(1000, 9999)
+                db_id = f"Guest-{guest_id}"
+                saved_order = database.save_order(db_id, order.amount, order.type, order.delivery_date, order.items,
+                                                  merchant_id=merchant_id, idempotency_key=idempotency_key)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if saved_order and saved_order.get("replayed"):
+        response.headers["Idempotent-Replayed"] = "true"
+    elif saved_order:
+        stock.record_sale(merchant_id, order.items)
 
     return {"status": "Order Placed", "order": saved_order}
 
+@app.post("/orders/status")
+def update_orders_status(update: StatusUpdate):
+    """Moves a batch of orders to one status in a single transaction.
+
+    Returns only the orders that changed, so the dashboard can patch its list
+    instead of refetching; ids whose current status does not allow the move
+    come back in 'rejected'.
+    """
+    merchant_id = _merchant_id(update.merchant_id)
+    try:
+        # Cancelling refunds coins, so this competes as a checkout
+        with ADMISSION.admit("checkout"):
+            changed = database.transition_orders(update.order_ids, update.status, merchant_id=merchant_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if update.status == "Cancelled":
+        for order in changed:
+            stock.record_cancel(merchant_id, order["items"], order["time"])
+    changed_ids = {order["id"] for order in changed}
+    return {
+        "changed": changed,
+        "rejected": [order_id for order_id in dict.fromkeys(update.order_ids) if order_id not in changed_ids],
+    }
+
 @app.post("/complete-order/{order_id}")
-def complete_order(order_id: int):
-    success = database.update_order_status(order_id, "Completed")
+def complete_order(order_id: int, merchant_id: Optional[str] = None):
+    success = database.update_order_status(order_id, "Completed", merchant_id=_merchant_id(merchant_id))
     if success:
         return {"status": "Order Completed"}
     raise HTTPException(status_code=400, detail="Failed to complete order")
 
 if __name__ == "__main__":
-    # Local Dev Run
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    import argparse
+    parser = argparse.ArgumentParser(description="Merchant Bot API & Dashboard Backend")
+    parser.add_argument("--role", choices=ROLES, default=APP_ROLE)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (api role only)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    if args.workers > 1 and args.role != "api":
+        # Every worker would start its own pollers for the same bot tokens
+        parser.error("--workers > 1 needs --role api; run the bots once with --role bot")
+
+    set_role(args.role)
+    if args.role == "bot":
+        try:
+            asyncio.run(run_bot_only())
+        except KeyboardInterrupt:
+            pass
+    else:
+        # uvicorn imports main afresh in each worker; the role reaches it through the environment
+        os.environ["APP_ROLE"] = args.role
+        if args.workers > 1:
+            uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+        else:
+            # Local Dev Run
+            uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
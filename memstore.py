@@ -0,0 +1,472 @@
+import datetime
+import os
+import pickle
+import threading
+
+# Ledger entry kinds. 'amount' is always the signed change to the balance.
+TXN_DEBIT = "debit"
+TXN_REFUND = "refund"
+TXN_TOPUP = "topup"
+TXN_ADJUSTMENT = "adjustment"
+
+
+class MemoryStore:
+    """In-memory storage engine behind DB_MODE 'MOCK'.
+
+    Orders are kept by id with a (member_id, status) index, so lookups that
+    the SQL backends answer from an index are not list scans here either.
+    Every public method takes the store lock, because FastAPI runs sync
+    endpoints in a threadpool next to the bot's event loop. Rows handed out
+    are copies, as they would be from a real cursor.
+    """
+
+    def __init__(self, members=(), snapshot_path=None, merchant_id=None):
+        self.lock = threading.RLock()
+        self.snapshot_path = snapshot_path
+        self.merchant_id = merchant_id
+        self.members = {}
+        self.orders = {}             # id -> order dict (live table)
+        self.archive = {}            # id -> order dict (orders_archive)
+        self.by_member_status = {}   # (member_id, status) -> {order_id: None}
+        self.by_idempotency_key = {} # idempotency_key -> order_id (live orders only)
+        self.transactions = []       # coin ledger, id == position + 1
+        self.txns_by_member = {}     # member_id -> [txn, ...] in id order
+        self.snapshots = {}          # member_id -> {member_id, balance, last_txn_id, taken_at}
+        self.outbox = {}             # id -> customer notification (notification_outbox)
+        self.stock = {}              # (stock_date, item) -> [daily_limit, sold] (item_stock)
+        self.login_failures_log = [] # (scope, key, failed_at) (login_failures), not snapshotted
+        self.next_order_id = 1
+        self.next_notification_id = 1
+        for member in members:
+            self.add_member(member)
+
+    # --- persistence ------------------------------------------------------
+
+    STATE_FIELDS = ("members", "orders", "archive", "transactions", "snapshots", "next_order_id",
+                    "outbox", "next_notification_id", "stock")
+
+    def save(self, path=None):
+        """Writes the whole store to disk atomically."""
+        path = path or self.snapshot_path
+        if not path:
+            return False
+        with self.lock:
+            state = {name: getattr(self, name) for name in self.STATE_FIELDS}
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        return True
+
+    def load(self, path=None):
+        """Replaces the store with a snapshot written by save(); rebuilds the indexes."""
+        path = path or self.snapshot_path
+        if not path or not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        with self.lock:
+            for name in self.STATE_FIELDS:
+                # Snapshots from older versions lack the newer fields
+                if name in state:
+                    setattr(self, name, state[name])
+            self.by_member_status = {}
+            self.by_idempotency_key = {}
+            for order in self.orders.values():
+                self._index(order)
+                if order.get("idempotency_key") is not None:
+                    self.by_idempotency_key[order["idempotency_key"]] = order["id"]
+            self.txns_by_member = {}
+            for txn in self.transactions:
+                self.txns_by_member.setdefault(txn["member_id"], []).append(txn)
+        return True
+
+    # --- indexes ----------------------------------------------------------
+
+    def _index(self, order):
+        self.by_member_status.setdefault((order["member_id"], order["status"]), {})[order["id"]] = None
+
+    def _unindex(self, order):
+        key = (order["member_id"], order["status"])
+        ids = self.by_member_status.get(key)
+        if ids is not None:
+            ids.pop(order["id"], None)
+            if not ids:
+                del self.by_member_status[key]
+
+    def _with_status(self, status):
+        """Live orders in a status, found through the index rather than a scan."""
+        return [
+            self.orders[order_id]
+            for (_, order_status), ids in list(self.by_member_status.items()) if order_status == status
+            for order_id in list(ids)
+        ]
+
+    def _set_status(self, order, status):
+        self._unindex(order)
+        order["status"] = status
+        self._index(order)
+
+    def _notify(self, order):
+        """Queues a status notification for the customer who placed order."""
+        if order.get("chat_id") is None:
+            return
+        self.outbox[self.next_notification_id] = {
+            "id": self.next_notification_id,
+            "order_id": order["id"],
+            "chat_id": order["chat_id"],
+            "status": order["status"],
+            "created_at": datetime.datetime.now(),
+            "attempts": 0,
+            "sent_at": None,
+        }
+        self.next_notification_id += 1
+
+    # --- members & ledger -------------------------------------------------
+
+    def add_member(self, member):
+        with self.lock:
+            member = dict(member)
+            member.setdefault("id", len(self.members) + 1)
+            member.setdefault("merchant_id", self.merchant_id)
+            self.members[member["member_id"]] = member
+            # Opening balance predates the ledger, as in _open_missing_snapshots
+            self.snapshots.setdefault(member["member_id"], {
+                "member_id": member["member_id"], "balance": member["coins"],
+                "last_txn_id": len(self.transactions), "taken_at": None,
+            })
+
+    def _record(self, member_id, kind, amount, order_id=None, now=None):
+        txn = {
+            "id": len(self.transactions) + 1,
+            "member_id": member_id,
+            "kind": kind,
+            "amount": amount,
+            "order_id": order_id,
+            "created_at": now or datetime.datetime.now(),
+        }
+        self.transactions.append(txn)
+        self.txns_by_member.setdefault(member_id, []).append(txn)
+        return txn
+
+    def check_member(self, member_id, pin):
+        with self.lock:
+            member = self.members.get(member_id)
+            if member and member["pin"] == pin:
+                return dict(member)
+            return None
+
+    def get_balance(self, member_id):
+        with self.lock:
+            member = self.members.get(member_id)
+            return member["coins"] if member else 0
+
+    def set_coins(self, member_id, new_balance):
+        """Sets coins, recording the difference; returns True if anything changed."""
+        with self.lock:
+            member = self.members.get(member_id)
+            if not member:
+                return False
+            delta = new_balance - member["coins"]
+            member["coins"] = new_balance
+            if delta:
+                self._record(member_id, TXN_TOPUP if delta > 0 else TXN_ADJUSTMENT, delta)
+            return bool(delta)
+
+    def list_members(self):
+        with self.lock:
+            return [dict(m) for m in self.members.values()]
+
+    def search_members(self, field, prefix, after, limit):
+        """SQLBackend.search_members over the members dict (a scan; MOCK data is small)."""
+        with self.lock:
+            if field == "member_id":
+                found = sorted((m for m in self.members.values() if m["member_id"].startswith(prefix)),
+                               key=lambda m: m["member_id"])
+                if after is not None:
+                    found = [m for m in found if m["member_id"] > after]
+            else:
+                folded = prefix.lower()
+                # Members without a name sort first, as NULLs do in SQL
+                name_key = lambda m: ((m.get("name") or "").lower(), m["member_id"])
+                found = sorted(
+                    (m for m in self.members.values()
+                     if name_key(m)[0].startswith(folded) and not m["member_id"].startswith(prefix)),
+                    key=name_key)
+                if after is not None:
+                    name, member_id = after
+                    cursor_key = name_key({"name": name, "member_id": member_id})
+                    found = [m for m in found if name_key(m) > cursor_key]
+            return [{k: v for k, v in m.items() if k != "pin"} for m in found[:limit]]
+
+    def member_transactions(self, member_id, limit):
+        with self.lock:
+            rows = self.txns_by_member.get(member_id, [])
+            return [dict(t) for t in reversed(rows[-limit:])] if limit else []
+
+    def _txns_after(self, member_id, last_txn_id, upto=None):
+        """Ledger rows with last_txn_id < id <= upto; walks back from the newest."""
+        rows = self.txns_by_member.get(member_id, [])
+        start = len(rows)
+        while start > 0 and rows[start - 1]["id"] > last_txn_id:
+            start -= 1
+        return [t for t in rows[start:] if upto is None or t["id"] <= upto]
+
+    def ledger_balance(self, member_id):
+        with self.lock:
+            snap = self.snapshots.get(member_id, {"balance": 0, "last_txn_id": 0})
+            return snap["balance"] + sum(t["amount"] for t in self._txns_after(member_id, snap["last_txn_id"]))
+
+    def snapshot_balances(self, now):
+        with self.lock:
+            advanced = 0
+            last_id = len(self.transactions)
+            for member_id in self.members:
+                snap = self.snapshots.setdefault(member_id, {"member_id": member_id, "balance": 0, "last_txn_id": 0, "taken_at": None})
+                new_rows = self._txns_after(member_id, snap["last_txn_id"], last_id)
+                if new_rows:
+                    snap["balance"] += sum(t["amount"] for t in new_rows)
+                    snap["last_txn_id"] = new_rows[-1]["id"]
+                    snap["taken_at"] = now
+                    advanced += 1
+            return advanced
+
+    def reconcile(self):
+        with self.lock:
+            drifted = []
+            for member_id, member in self.members.items():
+                ledger = self.ledger_balance(member_id)
+                if ledger != member["coins"]:
+                    drifted.append({"member_id": member_id, "coins": member["coins"], "ledger_balance": ledger})
+            return drifted
+
+    # --- orders -----------------------------------------------------------
+
+    def _check_idempotency_key(self, idempotency_key):
+        # Same failure as the SQL backends' unique index
+        if idempotency_key is not None and idempotency_key in self.by_idempotency_key:
+            raise ValueError(f"Duplicate idempotency_key {idempotency_key!r}")
+
+    def insert_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline=None,
+                     chat_id=None, idempotency_key=None):
+        with self.lock:
+            self._check_idempotency_key(idempotency_key)
+            order = {
+                "id": self.next_order_id,
+                "member_id": member_id,
+                "amount": amount,
+                "items": items_summary,
+                "type": type_label, # 'Immediate' or 'Pre-order'
+                "time": now,
+                "delivery_date": delivery_date_str,
+                "status": "Active",
+                "merchant_id": self.merchant_id,
+                "cancel_deadline": cancel_deadline,
+                "chat_id": chat_id,
+                "idempotency_key": idempotency_key,
+            }
+            self.next_order_id += 1
+            self.orders[order["id"]] = order
+            self._index(order)
+            if idempotency_key is not None:
+                self.by_idempotency_key[idempotency_key] = order["id"]
+            return dict(order)
+
+    def place_member_order(self, member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline=None,
+                           chat_id=None, idempotency_key=None):
+        """Debit and insert under one lock hold; None if funds are short."""
+        with self.lock:
+            self._check_idempotency_key(idempotency_key)
+            member = self.members.get(member_id)
+            if not member or member["coins"] < amount:
+                return None
+            member["coins"] -= amount
+            order = self.insert_order(member_id, amount, type_label, delivery_date_str, items_summary, now, cancel_deadline,
+                                      chat_id, idempotency_key)
+            self._record(member_id, TXN_DEBIT, -amount, order["id"], now)
+            return order
+
+    def get_order(self, order_id):
+        with self.lock:
+            order = self.orders.get(order_id)
+            return dict(order) if order else None
+
+    def order_by_idempotency_key(self, idempotency_key):
+        with self.lock:
+            order_id = self.by_idempotency_key.get(idempotency_key)
+            return dict(self.orders[order_id]) if order_id is not None else None
+
+    def last_active_order(self, member_id):
+        with self.lock:
+            ids = self.by_member_status.get((member_id, "Active"))
+            return dict(self.orders[max(ids)]) if ids else None
+
+    def cancel_refund(self, order_id, member_id, refund_amount, now):
+        with self.lock:
+            order = self.orders.get(order_id)
+            if not order or order["status"] != "Active":
+                return False
+            deadline = order.get("cancel_deadline")
+            if deadline is None or deadline <= now:
+                return False
+            self._set_status(order, "Cancelled")
+            # Guests have no member record, so there is nothing to credit
+            if member_id in self.members:
+                self.members[member_id]["coins"] += refund_amount
+                self._record(member_id, TXN_REFUND, refund_amount, order_id)
+            return True
+
+    def transition_orders(self, order_ids, new_status, from_statuses, refund):
+        with self.lock:
+            changed = []
+            for order_id in sorted(set(order_ids)):
+                order = self.orders.get(order_id)
+                if not order or order["status"] not in from_statuses:
+                    continue
+                self._set_status(order, new_status)
+                member = self.members.get(order["member_id"])
+                if refund and member:
+                    member["coins"] += order["amount"]
+                    self._record(order["member_id"], TXN_REFUND, order["amount"], order_id)
+                self._notify(order)
+                changed.append(dict(order))
+            return changed
+
+    def lock_preorders(self, delivery_date_str):
+        """Moves the date's Active pre-orders to Preparing; returns all Preparing ones."""
+        with self.lock:
+            for order in self._with_status("Active"):
+                if order["type"] == "Pre-order" and order["delivery_date"] == delivery_date_str:
+                    self._set_status(order, "Preparing")
+                    self._notify(order)
+            return self.preparing_preorders(delivery_date_str)
+
+    def preparing_preorders(self, delivery_date_str):
+        with self.lock:
+            return [
+                dict(order) for order in self._with_status("Preparing")
+                if order["type"] == "Pre-order" and order["delivery_date"] == delivery_date_str
+            ]
+
+    def closed_cancel_windows(self, since, until):
+        """Active orders whose cancel deadline fell in (since, until]."""
+        with self.lock:
+            closed = [
+                dict(order) for order in self._with_status("Active")
+                if order.get("cancel_deadline") and since < order["cancel_deadline"] <= until
+            ]
+            closed.sort(key=lambda o: o["cancel_deadline"])
+            return closed
+
+    def expire_stale(self, cutoff):
+        with self.lock:
+            expired = 0
+            for order in self._with_status("Active"):
+                if order["type"] != "Pre-order" and order["time"] < cutoff:
+                    self._set_status(order, "Expired")
+                    self._notify(order)
+                    expired += 1
+            return expired
+
+    def member_orders(self, member_id, before, limit):
+        """Up to limit of a member's orders (archive included) with id < before, newest first."""
+        with self.lock:
+            ids = [
+                order_id
+                for (order_member, _), ids in self.by_member_status.items() if order_member == member_id
+                for order_id in ids
+            ]
+            orders = [self.orders[order_id] for order_id in ids]
+            orders += [o for o in self.archive.values() if o["member_id"] == member_id]
+            if before is not None:
+                orders = [o for o in orders if o["id"] < before]
+            orders.sort(key=lambda o: o["id"], reverse=True)
+            return [dict(o) for o in orders[:limit]]
+
+    def pending_notifications(self, max_attempts, limit):
+        with self.lock:
+            pending = []
+            for note in self.outbox.values():
+                if note["sent_at"] is None and note["attempts"] < max_attempts:
+                    order = self.orders.get(note["order_id"]) or self.archive.get(note["order_id"]) or {}
+                    pending.append({
+                        "id": note["id"], "order_id": note["order_id"], "chat_id": note["chat_id"],
+                        "status": note["status"], "attempts": note["attempts"], "items": order.get("items"),
+                    })
+                    if len(pending) == limit:
+                        break
+            return pending
+
+    def finish_notifications(self, sent_ids, failed_ids, now):
+        with self.lock:
+            for note_id in sent_ids:
+                self.outbox[note_id]["sent_at"] = now
+            for note_id in failed_ids:
+                self.outbox[note_id]["attempts"] += 1
+
+    def prune_notifications(self, before, max_attempts):
+        with self.lock:
+            done = [
+                note_id for note_id, note in self.outbox.items()
+                if note["created_at"] < before and (note["sent_at"] is not None or note["attempts"] >= max_attempts)
+            ]
+            for note_id in done:
+                del self.outbox[note_id]
+            return len(done)
+
+    def load_stock(self, stock_date):
+        with self.lock:
+            return {item: tuple(row) for (day, item), row in self.stock.items() if day == stock_date}
+
+    def add_stock_sold(self, stock_date, deltas):
+        with self.lock:
+            for item, qty in deltas.items():
+                self.stock.setdefault((stock_date, item), [None, 0])[1] += qty
+
+    def set_stock_limits(self, stock_date, limits):
+        with self.lock:
+            for item, limit in limits.items():
+                self.stock.setdefault((stock_date, item), [None, 0])[0] = limit
+
+    def orders_in_range(self, start, end, include_archive):
+        """Orders newest first, optionally limited to [start, end)."""
+        with self.lock:
+            orders = list(self.orders.values())
+            if include_archive:
+                orders += list(self.archive.values())
+            if start is not None or end is not None:
+                orders = [o for o in orders if (start is None or o["time"] >= start) and (end is None or o["time"] < end)]
+            orders.sort(key=lambda o: o["id"], reverse=True)
+            return [dict(o) for o in orders]
+
+    def archive_orders(self, statuses, cutoff, now):
+        with self.lock:
+            moved = [o for o in self.orders.values() if o["status"] in statuses and o["time"] < cutoff]
+            for order in moved:
+                self._unindex(order)
+                self.by_idempotency_key.pop(order.get("idempotency_key"), None)
+                del self.orders[order["id"]]
+                self.archive[order["id"]] = dict(order, archived_at=now)
+            return len(moved)
+
+    # --- login throttling ---------------------------------------------------
+
+    def record_login_failure(self, chat_key, member_key, now):
+        with self.lock:
+            self.login_failures_log.append(("chat", chat_key, now))
+            self.login_failures_log.append(("member", member_key, now))
+
+    def login_failures(self, chat_key, member_key, since):
+        with self.lock:
+            counts = {}
+            for scope, key, failed_at in self.login_failures_log:
+                if failed_at >= since and key == (chat_key if scope == "chat" else member_key):
+                    counts[scope] = counts.get(scope, 0) + 1
+            return counts
+
+    def prune_login_failures(self, before):
+        with self.lock:
+            kept = [entry for entry in self.login_failures_log if entry[2] >= before]
+            pruned = len(self.login_failures_log) - len(kept)
+            self.login_failures_log = kept
+            return pruned
@@ -0,0 +1,107 @@
+import json
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Outlets served by this deployment. Without the file, the deployment is the
+# single original shop configured from .env as before. The file is a JSON list:
+#
+#   [{"merchant_id": "main", "name": "Neutrious Theory", "token_env": "TELEGRAM_BOT_TOKEN"},
+#    {"merchant_id": "hsr", "name": "Neutrious Theory HSR", "token_env": "HSR_BOT_TOKEN",
+#     "sqlite_path": "merchant_hsr.db", "mysql_database": "nutritious_theory_hsr",
+#     "menu_member": {"Protein Bowl": 60}, "menu_non_member": {"Protein Bowl": 70},
+#     "stock": {"Protein Bowl": 40}}]
+#
+# The first entry is the default merchant. Storage keys are optional.
+# "stock" is the default daily limit per item; items without one are unlimited.
+MERCHANTS_FILE = os.getenv("MERCHANTS_FILE", "merchants.json")
+
+# MEMBER MENU (Rupees)
+DEFAULT_MENU_MEMBER = {
+    "Sprouts Salad": 50,
+    "Protein Bowl": 55,
+    "Chia Pudding": 65,
+    "Oats + Chia": 65,
+    "Papaya Bowl": 50,
+    "Pineapple Bowl": 50,
+    "Muskmelon Bowl": 50,
+    "Watermelon Bowl": 50,
+    "Mixed Fruit Bowl": 65,
+    "Protein Veg Salad": 155
+}
+
+# NON-MEMBER MENU (Rupees)
+DEFAULT_MENU_NON_MEMBER = {
+    "Sprouts Salad": 50,
+    "Protein Bowl": 55,
+    "Chia Pudding": 65,
+    "Oats + Chia": 65,
+    "Papaya Bowl": 50,
+    "Pineapple Bowl": 50,
+    "Muskmelon Bowl": 50,
+    "Watermelon Bowl": 50,
+    "Mixed Fruit Bowl": 65,
+    "Protein Veg Salad": 155
+}
+
+
+class Merchant:
+    """One outlet: its bot token, menus and where its data lives.
+
+    Every merchant is its own shard, a separate SQLite file or MySQL schema,
+    so one outlet's rush never queues behind another's queries. The default
+    merchant keeps the original merchant.db / DB_NAME storage.
+    """
+
+    def __init__(self, merchant_id, name, token_env=None, token=None, menu_member=None,
+                 menu_non_member=None, sqlite_path=None, mysql_database=None, stock=None, default=False):
+        self.merchant_id = merchant_id
+        self.name = name
+        self.token = token or (os.getenv(token_env) if token_env else None)
+        self.menu_member = menu_member or DEFAULT_MENU_MEMBER
+        self.menu_non_member = menu_non_member or DEFAULT_MENU_NON_MEMBER
+        self.stock = stock or {}
+        db_name = os.getenv("DB_NAME", "nutritious_theory")
+        if default:
+            self.sqlite_path = sqlite_path or "merchant.db"
+            self.mysql_database = mysql_database or db_name
+        else:
+            self.sqlite_path = sqlite_path or f"merchant_{merchant_id}.db"
+            self.mysql_database = mysql_database or f"{db_name}_{merchant_id}"
+
+    def info(self):
+        """Public description for the API (no token)."""
+        return {"merchant_id": self.merchant_id, "name": self.name}
+
+
+def load_merchants(path=None):
+    """Reads MERCHANTS_FILE; returns {merchant_id: Merchant}, default first."""
+    path = path or MERCHANTS_FILE
+    if not os.path.exists(path):
+        merchant_id = os.getenv("DEFAULT_MERCHANT_ID", "main")
+        return {merchant_id: Merchant(merchant_id, "Neutrious Theory", token_env="TELEGRAM_BOT_TOKEN", default=True)}
+
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    merchants = {}
+    for i, entry in enumerate(entries):
+        merchant = Merchant(default=(i == 0), **entry)
+        merchants[merchant.merchant_id] = merchant
+    if not merchants:
+        raise ValueError(f"{path} lists no merchants")
+    return merchants
+
+
+MERCHANTS = load_merchants()
+DEFAULT_MERCHANT_ID = next(iter(MERCHANTS))
+
+
+def get_merchant(merchant_id=None):
+    """The merchant with this id (default merchant for None); KeyError if unknown."""
+    return MERCHANTS[merchant_id or DEFAULT_MERCHANT_ID]
@@ -0,0 +1,121 @@
+import collections
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Profiling, job runs and archiving over the API are admin-only: requests must
+# send this in X-Admin-Token. Unset leaves them disabled.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+MAX_PROFILE_SECONDS = 60
+# Per-request profiles kept for /debug/profiles/{id}
+PROFILE_HISTORY = 20
+
+# Innermost frames of a thread with nothing to do: the event loop waiting in
+# select(), an idle threadpool worker waiting for a job
+IDLE_FRAMES = {("selectors.py", "select"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+
+def admin_allowed(token):
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def _thread_label(name):
+    # Worker threads differ only by a trailing number; one label merges them
+    return name.rstrip("0123456789_-") or name
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(frame):
+    # The innermost frame outside threading.py (Condition.wait etc.)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) == "threading.py":
+        frame = frame.f_back
+    return frame is not None and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+class Sampler:
+    """Samples the stack of every thread at a fixed interval.
+
+    Covers the whole process: API routes running in the threadpool, and bot
+    handler coroutines on the event loop while they hold it (a coroutine
+    suspended in an await is not on any stack). Stacks are counted in the
+    collapsed format flamegraph.pl, speedscope and most flamegraph viewers
+    read: one "root;caller;callee count" line per distinct stack, rooted at
+    the thread's name. Idle threads are left out unless include_idle.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL_SECONDS, include_idle=False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (not self.include_idle and _is_idle(frame)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(_thread_label(names.get(ident, "thread")))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+# Finished per-request profiles, newest last: id -> {"method", "path", ...}
+PROFILES = collections.OrderedDict()
+_profile_ids = itertools.count(1)
+_profiles_lock = threading.Lock()
+
+
+def keep_profile(method, path, sampler):
+    """Stores a request's profile; returns its id."""
+    with _profiles_lock:
+        profile_id = next(_profile_ids)
+        PROFILES[profile_id] = {
+            "method": method,
+            "path": path,
+            "seconds": sampler.elapsed,
+            "samples": sampler.samples,
+            "collapsed": sampler.collapsed(),
+        }
+        while len(PROFILES) > PROFILE_HISTORY:
+            PROFILES.popitem(last=False)
+        return profile_id
@@ -0,0 +1,212 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import database
+import merchants
+import stock
+import throttle
+from cart import parse_summary
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Today's delivery closes at 8 AM (see bot.ask_member_delivery_option)
+CUTOFF_HOUR = int(os.getenv("CUTOFF_HOUR", "8"))
+# Immediate/Takeaway orders still Active after this long are expired
+STALE_ORDER_HOURS = int(os.getenv("STALE_ORDER_HOURS", "12"))
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", "3"))
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "3600"))
+EXPIRY_INTERVAL_SECONDS = int(os.getenv("EXPIRY_INTERVAL_SECONDS", "900"))
+
+# Latest prep list per merchant, computed at the cutoff:
+# {merchant_id: {"date": "dd-mm-YYYY", "orders": n, "items": {name: qty}}}
+PREP_LISTS = {}
+
+def get_prep_list(merchant_id=None):
+    merchant_id = merchant_id or merchants.DEFAULT_MERCHANT_ID
+    prep = PREP_LISTS.get(merchant_id)
+    if prep is not None:
+        return prep
+    # The cutoff job ran in another process (main.APP_ROLE=bot) or not yet:
+    # rebuild today's list from the orders it locked.
+    now = datetime.now()
+    if now.hour < CUTOFF_HOUR:
+        return {"date": None, "orders": 0, "items": {}}
+    today = now.strftime("%d-%m-%Y")
+    orders = database.get_preparing_preorders(today, merchant_id=merchant_id)
+    return {"date": today, "orders": len(orders), "items": build_prep_list(orders)}
+
+# -----------------------------------------------------------------------------
+# SCHEDULER
+# -----------------------------------------------------------------------------
+
+class Job:
+    """A named callable run either every `interval` seconds or daily `at` (hour, minute)."""
+
+    def __init__(self, name, func, interval=None, at=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.at = at
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.last_result = None
+        self.last_error = None
+
+    def seconds_until_next(self, now=None):
+        now = now or datetime.now()
+        if self.interval is not None:
+            return self.interval
+        hour, minute = self.at
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        return (next_run - now).total_seconds()
+
+    async def run(self):
+        """Runs the job once (sync jobs in a worker thread) and records its metrics."""
+        started = time.perf_counter()
+        self.last_run = datetime.now()
+        try:
+            if inspect.iscoroutinefunction(self.func):
+                # Async jobs (e.g. Telegram sends) run on the event loop itself
+                self.last_result = await self.func()
+            else:
+                self.last_result = await asyncio.to_thread(self.func)
+            self.last_error = None
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.error(f"Job '{self.name}' failed: {e}")
+        finally:
+            self.last_duration = time.perf_counter() - started
+            self.total_duration += self.last_duration
+            self.runs += 1
+        logger.info(f"Job '{self.name}' finished in {self.last_duration * 1000:.1f} ms")
+
+    def metrics(self):
+        return {
+            "name": self.name,
+            "schedule": f"every {self.interval}s" if self.interval is not None else f"daily {self.at[0]:02d}:{self.at[1]:02d}",
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_duration_ms": round(self.last_duration * 1000, 2) if self.last_duration is not None else None,
+            "avg_duration_ms": round(self.total_duration * 1000 / self.runs, 2) if self.runs else None,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
+
+
+class Scheduler:
+    """Runs jobs on the FastAPI event loop, each in its own task, off the request path."""
+
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = []
+
+    def add_interval(self, name, func, seconds):
+        self.jobs[name] = Job(name, func, interval=seconds)
+
+    def add_daily(self, name, func, hour, minute=0):
+        self.jobs[name] = Job(name, func, at=(hour, minute))
+
+    async def _loop(self, job):
+        while True:
+            await asyncio.sleep(job.seconds_until_next())
+            await job.run()
+
+    def start(self):
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._loop(job), name=f"job:{job.name}"))
+        logger.info(f"Scheduler started with {len(self.jobs)} jobs.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Scheduler stopped.")
+
+    async def run_now(self, name):
+        job = self.jobs[name]
+        await job.run()
+        return job.metrics()
+
+    def metrics(self):
+        return [job.metrics() for job in self.jobs.values()]
+
+# -----------------------------------------------------------------------------
+# JOBS
+# -----------------------------------------------------------------------------
+
+def build_prep_list(orders):
+    """Totals item quantities from order summaries like 'Protein Bowl x2, Chia Pudding x1'."""
+    items = {}
+    for order in orders:
+        for name, qty in parse_summary(order.get("items")).items():
+            items[name] = items.get(name, 0) + qty
+    return items
+
+def cutoff_job():
+    """At the delivery cutoff, locks each merchant's pre-orders for today and precomputes its prep list."""
+    today = datetime.now().strftime("%d-%m-%Y")
+    locked = items = 0
+    for merchant_id in merchants.MERCHANTS:
+        orders = database.lock_preorders(today, merchant_id=merchant_id)
+        prep = {"date": today, "orders": len(orders), "items": build_prep_list(orders)}
+        PREP_LISTS[merchant_id] = prep
+        locked += len(orders)
+        items += sum(prep["items"].values())
+    return {"locked": locked, "items": items}
+
+def expiry_job():
+    return {"expired": sum(
+        database.expire_stale_orders(STALE_ORDER_HOURS, merchant_id=merchant_id) for merchant_id in merchants.MERCHANTS
+    )}
+
+def archive_job():
+    login_cutoff = datetime.now() - timedelta(seconds=throttle.LOGIN_WINDOW_SECONDS)
+    return {
+        "archived": sum(database.archive_orders(merchant_id=merchant_id) for merchant_id in merchants.MERCHANTS),
+        "notifications_pruned": sum(database.prune_notifications(merchant_id=merchant_id) for merchant_id in merchants.MERCHANTS),
+        # Only LOGIN_THROTTLE_SHARED writes these; older than a window they count for nothing
+        "login_failures_pruned": sum(
+            database.prune_login_failures(login_cutoff, merchant_id=merchant_id) for merchant_id in merchants.MERCHANTS
+        ),
+    }
+
+def ledger_job():
+    """Rolls balance snapshots forward and reports any ledger drift."""
+    advanced = drifted = 0
+    for merchant_id in merchants.MERCHANTS:
+        advanced += database.snapshot_balances(merchant_id=merchant_id)
+        drift = database.reconcile_balances(merchant_id=merchant_id)
+        if drift:
+            logger.warning(f"Ledger drift for {len(drift)} members of {merchant_id}: {drift}")
+        drifted += len(drift)
+    return {"snapshots": advanced, "drifted": drifted}
+
+def mock_snapshot_job():
+    return {"saved": database.save_mock_store()}
+
+def build_scheduler():
+    scheduler = Scheduler()
+    scheduler.add_daily("preorder_cutoff", cutoff_job, CUTOFF_HOUR)
+    scheduler.add_interval("expire_stale_orders", expiry_job, EXPIRY_INTERVAL_SECONDS)
+    scheduler.add_daily("archive_orders", archive_job, ARCHIVE_HOUR)
+    scheduler.add_interval("ledger_snapshot", ledger_job, SNAPSHOT_INTERVAL_SECONDS)
+    scheduler.add_interval("stock_flush", stock.flush_job, stock.STOCK_FLUSH_SECONDS)
+    if database.MOCK_STORE.snapshot_path:
+        scheduler.add_interval("mock_snapshot", mock_snapshot_job, database.MOCK_SNAPSHOT_SECONDS)
+    return scheduler
@@ -0,0 +1,34 @@
+import json
+
+from fastapi.responses import Response
+
+# orjson is optional: it is several times faster on large lists, but the
+# stdlib encoder keeps the API working where it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content):
+    """Encodes already JSON-ready content (no datetimes) to bytes."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def rows_to_records(columns, rows):
+    """Turns tuple rows into the list-of-objects shape the dashboard expects."""
+    return [dict(zip(columns, row)) for row in rows]
+
+
+class FastJSONResponse(Response):
+    """JSON response that skips FastAPI's jsonable_encoder pass.
+
+    Content must already be plain JSON types; the database *_rows helpers
+    convert timestamps once so nothing is left to encode per field.
+    """
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,200 @@
+import datetime
+import os
+import threading
+
+import database
+from cart import parse_summary
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# How often sold counts are written to item_stock (and other processes' sales read back)
+STOCK_FLUSH_SECONDS = int(os.getenv("STOCK_FLUSH_SECONDS", "10"))
+
+
+class StockCounter:
+    """Today's stock of one merchant's items, counted in memory.
+
+    Per item: the daily limit (None = unlimited), what has been sold today,
+    and what sits reserved in live carts. Reserving and releasing never
+    touch the database; sales are written to item_stock by flush(), which
+    also reads back sales and limits recorded by other processes. An order
+    counts against the stock of the day it was placed.
+    """
+
+    def __init__(self, merchant):
+        self.merchant_id = merchant.merchant_id
+        self.default_limits = dict(merchant.stock)
+        self.lock = threading.Lock()
+        self.day = datetime.date.today()
+        self.limits = dict(self.default_limits)
+        self.sold = {}
+        self.reserved = {}
+        self.unflushed = {}  # (day, item) -> change in sold not yet in the database
+
+    def _roll(self):
+        # Called with the lock held. Carts that live across midnight keep
+        # their reservations; sales start again from zero.
+        today = datetime.date.today()
+        if today != self.day:
+            self.day = today
+            self.limits = dict(self.default_limits)
+            self.sold = {}
+
+    def _available(self, item):
+        limit = self.limits.get(item)
+        if limit is None:
+            return None
+        return max(0, limit - self.sold.get(item, 0) - self.reserved.get(item, 0))
+
+    def _add_sold(self, item, qty):
+        self.sold[item] = self.sold.get(item, 0) + qty
+        key = (self.day, item)
+        self.unflushed[key] = self.unflushed.get(key, 0) + qty
+
+    def available(self, item):
+        """Units still on sale today, or None if the item is unlimited."""
+        with self.lock:
+            self._roll()
+            return self._available(item)
+
+    def reserve(self, item, qty):
+        """Reserves up to qty for a cart; returns how many were granted."""
+        with self.lock:
+            self._roll()
+            available = self._available(item)
+            granted = qty if available is None else min(qty, available)
+            if granted > 0:
+                self.reserved[item] = self.reserved.get(item, 0) + granted
+            return granted
+
+    def release(self, item, qty):
+        with self.lock:
+            self.reserved[item] = max(0, self.reserved.get(item, 0) - qty)
+
+    def commit(self, items):
+        """Checkout of a cart's reserved {item: qty}."""
+        with self.lock:
+            self._roll()
+            for item, qty in items.items():
+                self.reserved[item] = max(0, self.reserved.get(item, 0) - qty)
+                self._add_sold(item, qty)
+
+    def sell(self, items):
+        """Records a sale that was never reserved (orders placed from the dashboard)."""
+        with self.lock:
+            self._roll()
+            for item, qty in items.items():
+                self._add_sold(item, qty)
+
+    def unsell(self, items, day):
+        """Puts a cancelled order's items back on sale, if it was placed today."""
+        with self.lock:
+            self._roll()
+            if day != self.day:
+                return
+            for item, qty in items.items():
+                self._add_sold(item, -min(qty, self.sold.get(item, 0)))
+
+    def _set_limit(self, item, limit):
+        # None falls back to the merchant's default limit, if any
+        limit = self.default_limits.get(item) if limit is None else limit
+        if limit is None:
+            self.limits.pop(item, None)
+        else:
+            self.limits[item] = limit
+
+    def set_limits(self, limits):
+        """Today's limits, {item: n}; None restores the merchant's default."""
+        with self.lock:
+            self._roll()
+            for item, limit in limits.items():
+                self._set_limit(item, limit)
+
+    def flush(self):
+        """Writes pending sales to item_stock, then reloads today's counts from it."""
+        with self.lock:
+            pending, self.unflushed = self.unflushed, {}
+        by_day = {}
+        for (day, item), qty in pending.items():
+            if qty:
+                by_day.setdefault(day, {})[item] = qty
+        for day, deltas in by_day.items():
+            if not database.add_stock_sold(day, deltas, merchant_id=self.merchant_id):
+                # Kept for the next flush
+                with self.lock:
+                    for item, qty in deltas.items():
+                        self.unflushed[(day, item)] = self.unflushed.get((day, item), 0) + qty
+
+        day = datetime.date.today()
+        rows = database.load_stock(day, merchant_id=self.merchant_id)
+        if rows is None:
+            return len(pending)
+        with self.lock:
+            self._roll()
+            if self.day != day:
+                return len(pending)
+            for item, (limit, sold) in rows.items():
+                # Sales made here since the snapshot are still unflushed
+                self.sold[item] = sold + self.unflushed.get((day, item), 0)
+                self._set_limit(item, limit)
+        return len(pending)
+
+    def stats(self):
+        with self.lock:
+            self._roll()
+            items = set(self.limits) | set(self.sold) | set(self.reserved)
+            return [
+                {
+                    "item": item,
+                    "limit": self.limits.get(item),
+                    "sold": self.sold.get(item, 0),
+                    "reserved": self.reserved.get(item, 0),
+                    "available": self._available(item),
+                }
+                for item in sorted(items)
+            ]
+
+
+# Live counters by merchant_id, only in the process that runs the bots (main.APP_ROLE)
+COUNTERS = {}
+
+
+def start(merchants):
+    """Creates and loads a counter for each merchant."""
+    for merchant in merchants.values():
+        counter = COUNTERS[merchant.merchant_id] = StockCounter(merchant)
+        counter.flush()
+
+
+def get_counter(merchant_id):
+    return COUNTERS.get(merchant_id)
+
+
+def flush_job():
+    return {"flushed": sum(counter.flush() for counter in list(COUNTERS.values()))}
+
+
+def record_sale(merchant_id, items_summary):
+    """Counts an order placed without a cart reservation."""
+    items = parse_summary(items_summary)
+    counter = COUNTERS.get(merchant_id)
+    if counter is not None:
+        counter.sell(items)
+    elif items:
+        # API-only process: the bot process picks this up at its next flush
+        database.add_stock_sold(datetime.date.today(), items, merchant_id=merchant_id)
+
+
+def record_cancel(merchant_id, items_summary, placed_at):
+    """Puts a cancelled order's items back on sale if it was placed today."""
+    day = placed_at.date() if placed_at else None
+    if day != datetime.date.today():
+        return
+    items = parse_summary(items_summary)
+    counter = COUNTERS.get(merchant_id)
+    if counter is not None:
+        counter.unsell(items, day)
+    elif items:
+        database.add_stock_sold(day, {item: -qty for item, qty in items.items()}, merchant_id=merchant_id)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import merchants
+from backends import MemoryBackend, SQLiteBackend
+from memstore import MemoryStore
+
+# Seeded in both backends (DEMO_MEMBERS / MOCK_MEMBERS) with 1500 coins
+MEMBER_ID = "97011"
+
+
+@pytest.fixture(params=["SQLITE", "MOCK"])
+def storage(request, tmp_path):
+    """The default merchant on a fresh SQLite file or a fresh MemoryStore."""
+    merchant_id = merchants.DEFAULT_MERCHANT_ID
+    if request.param == "SQLITE":
+        backend = SQLiteBackend(str(tmp_path / "merchant.db"), merchant_id=merchant_id)
+        backend.init_schema()
+    else:
+        backend = MemoryBackend(MemoryStore(database.MOCK_MEMBERS, merchant_id=merchant_id))
+    previous = database.BACKENDS.get(merchant_id)
+    database.use_backend(backend, merchant_id)
+    yield request.param
+    if previous is not None:
+        database.use_backend(previous, merchant_id)
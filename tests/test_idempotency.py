@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import main
+from conftest import MEMBER_ID
+
+
+def test_repeat_returns_original_order_without_debit(storage):
+    first = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1", idempotency_key="k1")
+    again = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1", idempotency_key="k1")
+
+    assert again["id"] == first["id"]
+    assert again["replayed"] and not first.get("replayed")
+    assert database.get_member_balance(MEMBER_ID) == 1400
+    assert len(database.get_coin_transactions(MEMBER_ID)) == 1
+
+
+def test_key_reused_for_different_order_is_rejected(storage):
+    database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1", idempotency_key="k1")
+    with pytest.raises(ValueError):
+        database.place_member_order(MEMBER_ID, 200, "Immediate", items_summary="Tea x2", idempotency_key="k1")
+    assert database.get_member_balance(MEMBER_ID) == 1400
+
+
+def test_guest_repeat_keeps_first_guest_id(storage):
+    first = database.save_order("Guest-1", 40, "Takeaway", items_summary="Cake x1", idempotency_key="g1")
+    again = database.save_order("Guest-2", 40, "Takeaway", items_summary="Cake x1", idempotency_key="g1")
+    assert again["id"] == first["id"]
+    assert again["member_id"] == "Guest-1"
+
+
+def test_concurrent_repeats_place_one_order(storage):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            database.place_member_order(MEMBER_ID, 10, "Immediate", items_summary="Tea x1", idempotency_key="race")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({order["id"] for order in results}) == 1
+    assert database.get_member_balance(MEMBER_ID) == 1490
+
+
+def test_place_order_api_replays_and_rejects_mismatch(storage):
+    client = TestClient(main.app)
+    body = {"member_id": MEMBER_ID, "amount": 7, "items": "Juice x1", "type": "Immediate"}
+    headers = {"Idempotency-Key": "api-1"}
+
+    first = client.post("/place-order", json=body, headers=headers)
+    again = client.post("/place-order", json=body, headers=headers)
+    assert first.status_code == again.status_code == 200
+    assert again.json()["order"]["id"] == first.json()["order"]["id"]
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert database.get_member_balance(MEMBER_ID) == 1493
+
+    assert client.post("/place-order", json=dict(body, amount=8), headers=headers).status_code == 409
+    too_long = {"Idempotency-Key": "x" * (database.MAX_IDEMPOTENCY_KEY_LENGTH + 1)}
+    assert client.post("/place-order", json=body, headers=too_long).status_code == 400
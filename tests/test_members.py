@@ -0,0 +1,43 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import main
+from memstore import MemoryStore
+
+
+def test_members_listing_has_no_pins(storage):
+    response = TestClient(main.app).get("/members")
+    assert response.status_code == 200
+    members = response.json()
+    assert {m["member_id"] for m in members} >= {"97011", "77452"}
+    assert all("pin" not in m for m in members)
+
+
+def test_search_pages_by_id_then_name_without_pins(storage):
+    first = database.search_members("9", limit=1)
+    assert [m["member_id"] for m in first["members"]] == ["97011"]
+    assert all("pin" not in m for m in first["members"])
+
+    # Both seeded members share the first word of their name
+    word = database.get_all_members()[0]["name"].split()[0].lower()
+    by_name = database.search_members(word, limit=1)
+    second = database.search_members(word, limit=1, cursor=by_name["next_cursor"])
+    assert {by_name["members"][0]["member_id"], second["members"][0]["member_id"]} == {"97011", "77452"}
+    assert second["next_cursor"] is None
+
+
+def test_search_rejects_pin_field(storage):
+    with pytest.raises(ValueError):
+        database.search_members("9", fields=["member_id", "pin"])
+    assert TestClient(main.app).get("/members/search", params={"q": "9", "fields": "pin"}).status_code == 400
+
+
+def test_mock_search_handles_members_without_a_name():
+    store = MemoryStore([
+        {"member_id": "5001", "pin": "1", "name": None, "coins": 0},
+        {"member_id": "5002", "pin": "1", "name": "Asha", "coins": 0},
+    ])
+    assert [m["member_id"] for m in store.search_members("name", "as", None, 10)] == ["5002"]
+    assert store.search_members("name", "as", ["", "0"], 10)[0]["member_id"] == "5002"
+    assert store.search_members("name", "as", [None, "0"], 10)[0]["member_id"] == "5002"
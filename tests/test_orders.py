@@ -0,0 +1,57 @@
+import database
+from conftest import MEMBER_ID
+
+
+def _refunds(member_id):
+    return [t for t in database.get_coin_transactions(member_id) if t["kind"] == "refund"]
+
+
+def test_cancel_refunds_member_and_ledger(storage):
+    order = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1")
+    assert database.get_member_balance(MEMBER_ID) == 1400
+
+    assert database.cancel_order_refund(order["id"], MEMBER_ID, 100)
+    assert database.get_order(order["id"])["status"] == "Cancelled"
+    assert database.get_member_balance(MEMBER_ID) == 1500
+    assert len(_refunds(MEMBER_ID)) == 1
+    assert database.reconcile_balances() == []
+
+
+def test_cancel_twice_refunds_once(storage):
+    order = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1")
+    assert database.cancel_order_refund(order["id"], MEMBER_ID, 100)
+    assert not database.cancel_order_refund(order["id"], MEMBER_ID, 100)
+    assert database.get_member_balance(MEMBER_ID) == 1500
+    assert len(_refunds(MEMBER_ID)) == 1
+
+
+def test_cancel_guest_order_writes_no_ledger_row(storage):
+    order = database.save_order("Guest-1234", 40, "Takeaway", items_summary="Cake x1")
+
+    assert database.cancel_order_refund(order["id"], "Guest-1234", 40)
+    assert database.get_order(order["id"])["status"] == "Cancelled"
+    assert database.get_coin_transactions("Guest-1234") == []
+    database.snapshot_balances()
+    assert database.reconcile_balances() == []
+
+
+def test_transition_orders_rejects_disallowed_moves(storage):
+    active = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1")
+    done = database.save_order("Guest-1", 40, "Takeaway", items_summary="Cake x1")
+    assert database.transition_orders([done["id"]], "Completed")
+
+    changed = database.transition_orders([active["id"], done["id"]], "Preparing")
+    assert [o["id"] for o in changed] == [active["id"]]
+    assert changed[0]["status"] == "Preparing"
+    assert database.get_order(done["id"])["status"] == "Completed"
+
+
+def test_transition_to_cancelled_refunds_members_only(storage):
+    member_order = database.place_member_order(MEMBER_ID, 100, "Immediate", items_summary="Tea x1")
+    guest_order = database.save_order("Guest-1", 40, "Takeaway", items_summary="Cake x1")
+
+    changed = database.transition_orders([member_order["id"], guest_order["id"]], "Cancelled")
+    assert sorted(o["id"] for o in changed) == sorted([member_order["id"], guest_order["id"]])
+    assert database.get_member_balance(MEMBER_ID) == 1500
+    assert database.get_coin_transactions("Guest-1") == []
+    assert database.reconcile_balances() == []
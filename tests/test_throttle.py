@@ -0,0 +1,56 @@
+from throttle import LoginThrottle, SlidingWindowLimiter
+
+
+def test_sliding_window_allows_limit_then_blocks():
+    limiter = SlidingWindowLimiter(limit=2, window=60)
+    limiter.hit("a")
+    assert limiter.retry_after("a") == 0
+    limiter.hit("a")
+    assert 0 < limiter.retry_after("a") <= 60
+    assert limiter.retry_after("b") == 0
+
+
+def test_chat_is_blocked_after_its_wrong_pins():
+    throttle = LoginThrottle(window=60, per_chat=3, per_member=10, shared=False)
+    for _ in range(3):
+        assert throttle.check(1, "97011") == 0
+        throttle.failed(1, "97011")
+    assert throttle.check(1, "97011") > 0
+    # Another chat may still try the same member
+    assert throttle.check(2, "97011") == 0
+    assert throttle.stats()["blocked"]["chat"] == 1
+
+
+def test_member_is_blocked_across_chats():
+    throttle = LoginThrottle(window=60, per_chat=5, per_member=3, shared=False)
+    for chat_id in range(3):
+        throttle.failed(chat_id, "97011")
+    assert throttle.check(99, "97011") > 0
+    assert throttle.check(99, "77452") == 0
+    assert throttle.stats()["blocked"]["member"] == 1
+
+
+def test_success_clears_both_windows():
+    throttle = LoginThrottle(window=60, per_chat=2, per_member=2, shared=False)
+    throttle.failed(1, "97011")
+    throttle.failed(1, "97011")
+    assert throttle.check(1, "97011") > 0
+    throttle.succeeded(1, "97011")
+    assert throttle.check(1, "97011") == 0
+
+
+def test_limits_are_per_merchant():
+    throttle = LoginThrottle(window=60, per_chat=1, per_member=1, shared=False)
+    throttle.failed(1, "97011", merchant_id="a")
+    assert throttle.check(1, "97011", merchant_id="a") > 0
+    assert throttle.check(1, "97011", merchant_id="b") == 0
+
+
+def test_shared_limits_count_failures_in_the_database(storage):
+    throttle = LoginThrottle(window=60, per_chat=2, per_member=10, shared=True)
+    throttle.failed(1, "97011")
+    throttle.failed(1, "97011")
+    # A second process sees the failures through the login_failures table
+    other_process = LoginThrottle(window=60, per_chat=2, per_member=10, shared=True)
+    assert other_process.check(1, "97011") > 0
+    assert other_process.check(2, "97011") == 0
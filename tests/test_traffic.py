@@ -0,0 +1,33 @@
+import asyncio
+import types
+
+import traffic
+
+
+def _update(chat_id, text):
+    return types.SimpleNamespace(
+        message=types.SimpleNamespace(text=text),
+        effective_chat=types.SimpleNamespace(id=chat_id),
+        effective_user=types.SimpleNamespace(id=chat_id),
+    )
+
+
+def test_recording_is_anonymized_and_closed(tmp_path):
+    path = str(tmp_path / "updates.jsonl")
+    kinds = {"97011": "member_id", "1234": "pin"}
+    recorder = traffic.get_recorder(path, lambda update, context: kinds.get(update.message.text))
+    context = types.SimpleNamespace(bot_data={})
+
+    for text in ("/start", "97011", "1234", "1 x 2"):
+        asyncio.run(recorder.record(_update(555000111, text), context))
+    traffic.close_recorders()
+    assert traffic.RECORDERS == {}
+
+    entries = list(traffic.read_recording(path))
+    assert [e["x"] for e in entries] == ["/start", "{member:1}", "{pin}", "1 x 2"]
+    assert {e["c"] for e in entries} == {1}
+
+    # Updates arriving after shutdown are skipped, not written to a closed file
+    asyncio.run(recorder.record(_update(555000111, "late"), context))
+    assert recorder.stats()["skipped"] == 1
+    assert len(list(traffic.read_recording(path))) == 4
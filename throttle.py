@@ -0,0 +1,149 @@
+import collections
+import datetime
+import os
+import threading
+import time
+
+import database
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Wrong PINs allowed in any LOGIN_WINDOW_SECONDS, per chat and per membership ID
+LOGIN_WINDOW_SECONDS = int(os.getenv("LOGIN_WINDOW_SECONDS", "300"))
+LOGIN_MAX_FAILURES_PER_CHAT = int(os.getenv("LOGIN_MAX_FAILURES_PER_CHAT", "5"))
+LOGIN_MAX_FAILURES_PER_MEMBER = int(os.getenv("LOGIN_MAX_FAILURES_PER_MEMBER", "10"))
+# Also log failures in the shard's login_failures table, so processes that
+# share a database share the limits (at the cost of one indexed count per login)
+LOGIN_THROTTLE_SHARED = os.getenv("LOGIN_THROTTLE_SHARED", "0") == "1"
+
+
+class SlidingWindowLimiter:
+    """At most `limit` events per key in any `window` seconds.
+
+    Keeps the times of each key's recent events; keys whose events have all
+    aged out are dropped by a sweep that runs at most once per window.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.events = {}  # key -> deque of monotonic times, oldest first
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def _prune(self, key, now):
+        events = self.events.get(key)
+        if events is None:
+            return None
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if not events:
+            del self.events[key]
+            return None
+        return events
+
+    def _sweep(self, now):
+        if now - self.last_sweep < self.window:
+            return
+        self.last_sweep = now
+        for key in list(self.events):
+            self._prune(key, now)
+
+    def retry_after(self, key):
+        """Seconds until key may have another event; 0 if it may now."""
+        with self.lock:
+            now = time.monotonic()
+            self._sweep(now)
+            events = self._prune(key, now)
+            if events is None or len(events) < self.limit:
+                return 0
+            return events[-self.limit] + self.window - now
+
+    def hit(self, key):
+        with self.lock:
+            self.events.setdefault(key, collections.deque()).append(time.monotonic())
+
+    def reset(self, key):
+        with self.lock:
+            self.events.pop(key, None)
+
+
+class LoginThrottle:
+    """Limits wrong PINs per chat and per membership ID, in memory.
+
+    handle_login asks check() before database.check_member, so a chat or a
+    membership ID that has used up its wrong PINs is turned away without a
+    query. A correct PIN clears both windows.
+    """
+
+    def __init__(self, window=LOGIN_WINDOW_SECONDS, per_chat=LOGIN_MAX_FAILURES_PER_CHAT,
+                 per_member=LOGIN_MAX_FAILURES_PER_MEMBER, shared=LOGIN_THROTTLE_SHARED):
+        self.window = window
+        self.limits = {"chat": per_chat, "member": per_member}
+        self.limiters = {scope: SlidingWindowLimiter(limit, window) for scope, limit in self.limits.items()}
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.failed_attempts = 0
+        self.blocked = {"chat": 0, "member": 0}
+
+    def _keys(self, chat_id, member_id, merchant_id):
+        # Membership IDs are per merchant shard
+        return {"chat": (merchant_id, chat_id), "member": (merchant_id, member_id)}
+
+    def _shared_retry_after(self, chat_id, member_id, merchant_id):
+        since = datetime.datetime.now() - datetime.timedelta(seconds=self.window)
+        counts = database.get_login_failures(chat_id, member_id, since, merchant_id=merchant_id)
+        for scope, count in (counts or {}).items():
+            if count >= self.limits[scope]:
+                # The database count does not say when the oldest failure ages out
+                return scope, self.window
+        return None, 0
+
+    def check(self, chat_id, member_id, merchant_id=None):
+        """Seconds until this chat may try a PIN for member_id; 0 means go ahead."""
+        keys = self._keys(chat_id, member_id, merchant_id)
+        blocked_by, wait = None, 0
+        for scope, key in keys.items():
+            wait = self.limiters[scope].retry_after(key)
+            if wait:
+                blocked_by = scope
+                break
+        if not wait and self.shared:
+            blocked_by, wait = self._shared_retry_after(chat_id, member_id, merchant_id)
+        with self.lock:
+            if wait:
+                self.blocked[blocked_by] += 1
+            else:
+                self.allowed += 1
+        return wait
+
+    def failed(self, chat_id, member_id, merchant_id=None):
+        for scope, key in self._keys(chat_id, member_id, merchant_id).items():
+            self.limiters[scope].hit(key)
+        with self.lock:
+            self.failed_attempts += 1
+        if self.shared:
+            database.record_login_failure(chat_id, member_id, merchant_id=merchant_id)
+
+    def succeeded(self, chat_id, member_id, merchant_id=None):
+        for scope, key in self._keys(chat_id, member_id, merchant_id).items():
+            self.limiters[scope].reset(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "window_seconds": self.window,
+                "limits": dict(self.limits),
+                "shared": self.shared,
+                "allowed": self.allowed,
+                "failed": self.failed_attempts,
+                "blocked": dict(self.blocked),
+                "tracked_keys": {scope: len(limiter.events) for scope, limiter in self.limiters.items()},
+            }
+
+
+# Shared by every merchant's bot in the process
+LOGIN_THROTTLE = LoginThrottle()
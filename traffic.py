@@ -0,0 +1,117 @@
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# CONFIGURATION
+# -----------------------------------------------------------------------------
+
+# Append every incoming text message to this file (see UpdateRecorder); unset
+# leaves recording off. benchmarks/replay_updates.py plays a recording back.
+RECORD_UPDATES_FILE = os.getenv("RECORD_UPDATES_FILE")
+
+# Placeholders written instead of login credentials
+MEMBER_PLACEHOLDER = "{member:%d}"
+PIN_PLACEHOLDER = "{pin}"
+MEMBER_PLACEHOLDER_RE = re.compile(r"\{member:(\d+)\}")
+
+
+class UpdateRecorder:
+    """Writes incoming text messages to a JSON-lines file, anonymized.
+
+    One line per message: {"t": epoch seconds, "m": merchant_id, "c": chat,
+    "u": user, "x": text}. Chat and user ids are replaced by small numbers
+    (a private chat and its user get the same one), names and usernames are
+    never written, and login input is replaced by placeholders: each distinct
+    membership ID becomes {member:N}, every PIN becomes {pin}. Other text is
+    kept as typed, since replaying it must walk the same conversation path.
+
+    `classify(update, context)` tells which messages are login input: it
+    returns "member_id", "pin" or None.
+    """
+
+    def __init__(self, path, classify):
+        self.path = path
+        self.classify = classify
+        self.lock = threading.Lock()
+        self.ids = {}      # Telegram chat/user id -> pseudonym
+        self.members = {}  # membership ID -> placeholder number
+        self.recorded = 0
+        self.skipped = 0
+        # Line-buffered, so a crash loses at most the message being written
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def _pseudonym(self, real_id):
+        return self.ids.setdefault(real_id, len(self.ids) + 1)
+
+    def _anonymized(self, text, kind):
+        if kind == "member_id":
+            return MEMBER_PLACEHOLDER % self.members.setdefault(text.strip(), len(self.members) + 1)
+        if kind == "pin":
+            return PIN_PLACEHOLDER
+        return text
+
+    async def record(self, update, context):
+        """TypeHandler callback; runs before the conversation sees the update."""
+        message = update.message
+        if not message or message.text is None or not update.effective_user:
+            self.skipped += 1
+            return
+        kind = self.classify(update, context)
+        merchant = context.bot_data.get("merchant")
+        with self.lock:
+            if self.file.closed:
+                self.skipped += 1
+                return
+            line = {
+                "t": round(time.time(), 3),
+                "m": merchant.merchant_id if merchant else None,
+                "c": self._pseudonym(update.effective_chat.id),
+                "u": self._pseudonym(update.effective_user.id),
+                "x": self._anonymized(message.text, kind),
+            }
+            self.file.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.recorded += 1
+
+    def stats(self):
+        return {"path": self.path, "recorded": self.recorded, "skipped": self.skipped,
+                "chats": len(self.ids), "members": len(self.members)}
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+# One recorder per file, shared by every merchant's bot in the process
+RECORDERS = {}
+
+
+def get_recorder(path, classify):
+    if path not in RECORDERS:
+        RECORDERS[path] = UpdateRecorder(path, classify)
+    return RECORDERS[path]
+
+
+def close_recorders():
+    for recorder in RECORDERS.values():
+        recorder.close()
+    RECORDERS.clear()
+
+
+def read_recording(path, start=None, end=None):
+    """Yields recorded messages in order, optionally only those whose local
+    time of day is within [start, end) (datetime.time values)."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if start or end:
+                at = datetime.datetime.fromtimestamp(entry["t"]).time()
+                if (start and at < start) or (end and at >= end):
+                    continue
+            yield entry